@@ -0,0 +1,78 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Independent prompts to Claude from a service: sync FFAnthropic clients in a thread pool,
+versus FFAnthropicAsync / FFAnthropicCachedAsync generate_batch on one event loop, at the
+same concurrency.
+
+Runs against the suite's mock Anthropic server (benchmarks/suite/mock_servers.py), with
+50 ms to the first token, so it needs no key.
+
+    python -m benchmarks.bench_async_anthropic [--prompts 400] [--concurrency 32]
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import logging
+import threading
+import time
+
+from benchmarks.common import print_results
+from benchmarks.suite.clients import point_sdks_at
+from benchmarks.suite.mock_servers import MockServer, MockConfig
+from lib.AI.FFAnthropic import FFAnthropic
+from lib.AI.FFAnthropicAsync import FFAnthropicAsync
+from lib.AI.FFAnthropicCachedAsync import FFAnthropicCachedAsync
+
+
+def thread_pool(prompts, concurrency):
+    local = threading.local()
+
+    def answer(prompt):
+        if not hasattr(local, 'client'):
+            local.client = FFAnthropic(api_key='benchmark')
+        response = local.client.generate_response(prompt)
+        local.client.clear_conversation()
+        return response
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return sum(1 for response in executor.map(answer, prompts.values()) if response)
+
+
+async def batch(client_class, prompts, concurrency):
+    client = client_class(api_key='benchmark', max_concurrency=concurrency)
+    try:
+        return sum([result['status'] == 'succeeded' async for result in client.generate_batch(prompts)])
+    finally:
+        await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prompts', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+    logging.getLogger('lib.AI').setLevel(logging.WARNING)
+    prompts = {f"q{i}": f"Question {i}: name one risk of the plan." for i in range(args.prompts)}
+
+    results = {}
+    with MockServer(MockConfig(first_token_latency=0.05, completion_tokens=50)) as server:
+        point_sdks_at(server)
+        runs = (('FFAnthropic in a thread pool', lambda: thread_pool(prompts, args.concurrency)),
+                ('FFAnthropicAsync.generate_batch', lambda: asyncio.run(batch(FFAnthropicAsync, prompts, args.concurrency))),
+                ('FFAnthropicCachedAsync.generate_batch',
+                 lambda: asyncio.run(batch(FFAnthropicCachedAsync, prompts, args.concurrency))))
+        for label, run in runs:
+            start_cpu, start = time.process_time(), time.perf_counter()
+            succeeded = run()
+            elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+            results[label] = (f"{args.prompts / elapsed:7.1f} prompts/s, CPU {cpu / args.prompts * 1000:5.2f} ms/prompt, "
+                              f"{succeeded}/{args.prompts} answered")
+
+    print_results(f"{args.prompts} prompts, {args.concurrency} at a time, 50 ms server latency", results)
+
+
+if __name__ == '__main__':
+    main()
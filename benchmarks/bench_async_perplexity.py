@@ -0,0 +1,102 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Research fan-out over Perplexity: independent queries through FFPerplexity one after
+another, versus FFPerplexityAsync.generate_batch; and the time to the first text of an
+answer, from generate_response versus stream_response. Each run counts the answers that
+came back with their citations.
+
+Runs against the suite's mock server (benchmarks/suite/mock_servers.py), with 50 ms to the
+first token and 500 tokens/s, so it needs no key.
+
+    python -m benchmarks.bench_async_perplexity [--queries 120] [--concurrency 32]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import time
+
+from benchmarks.common import print_results
+from benchmarks.suite.mock_servers import MockServer, MockConfig
+from lib.AI.FFPerplexity import FFPerplexity
+from lib.AI.FFPerplexityAsync import FFPerplexityAsync
+
+CITATIONS = ['https://example.com/report', 'https://example.org/filing', 'https://example.net/news']
+
+
+def sequential(server, queries):
+    client = FFPerplexity(api_key='benchmark')
+    client.client = client.client.with_options(base_url=server.url)
+    cited = 0
+    for query in queries.values():
+        client.generate_response(query)
+        cited += client.last_citations == CITATIONS
+        client.clear_conversation()
+    return cited
+
+
+async def batch(server, queries, concurrency):
+    client = FFPerplexityAsync(api_key='benchmark', max_concurrency=concurrency)
+    client.client = client.client.with_options(base_url=server.url)
+    try:
+        return sum([result['citations'] == CITATIONS async for result in client.generate_batch(queries)])
+    finally:
+        await client.aclose()
+
+
+async def first_text(server, queries, stream):
+    """Median seconds until the caller has text, and the answers whose citations reached the history"""
+    client = FFPerplexityAsync(api_key='benchmark')
+    client.client = client.client.with_options(base_url=server.url)
+    times, cited = [], 0
+    try:
+        for query in queries.values():
+            start = time.perf_counter()
+            if stream:
+                async with contextlib.aclosing(client.stream_response(query)) as deltas:
+                    async for _ in deltas:
+                        times.append(time.perf_counter() - start)
+                        break
+            else:
+                await client.generate_response(query)
+                times.append(time.perf_counter() - start)
+            cited += client.conversation_history[-1]['citations'] == CITATIONS
+            client.clear_conversation()
+    finally:
+        await client.aclose()
+    return sorted(times)[len(times) // 2], cited
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=120)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+    logging.getLogger('lib.AI').setLevel(logging.WARNING)
+    queries = {f"q{i}": f"Question {i}: what changed in the sector this quarter?" for i in range(args.queries)}
+
+    fan_out, ttft = {}, {}
+    with MockServer(MockConfig(first_token_latency=0.05, tokens_per_second=500, completion_tokens=100),
+                    citations=CITATIONS) as server:
+        runs = (('FFPerplexity, one after another', lambda: sequential(server, queries)),
+                ('FFPerplexityAsync.generate_batch', lambda: asyncio.run(batch(server, queries, args.concurrency))))
+        for label, run in runs:
+            start = time.perf_counter()
+            cited = run()
+            elapsed = time.perf_counter() - start
+            fan_out[label] = f"{elapsed:6.2f} s, {args.queries / elapsed:6.1f} queries/s, {cited}/{args.queries} with citations"
+
+        sample = dict(list(queries.items())[:20])
+        for label, stream in (('generate_response', False), ('stream_response', True)):
+            median, cited = asyncio.run(first_text(server, sample, stream))
+            ttft[label] = f"{median * 1000:6.1f} ms to the first text, {cited}/{len(sample)} with citations in history"
+
+    print_results(f"{args.queries} queries, {args.concurrency} at a time, 50 ms + 100 tokens at 500 tokens/s", fan_out)
+    print_results("Time to the first text of an answer", ttft)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Memory held by FFAI_AzureOpenAI histories with and without the shared BlobStore.
+
+The session mimics a RAG workload: every prompt embeds one of a few dozen retrieved
+context blocks, questions repeat, and most responses are JSON with fanned-out attributes.
+Each prompt and response is built fresh, as it would be when read off the network.
+
+    python -m benchmarks.bench_blob_store [--interactions 10000]
+"""
+
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from benchmarks.common import EchoClient, print_results
+
+
+def make_session(interactions: int, questions: int, seed: int = 7):
+    rng = random.Random(seed)
+    contexts = [
+        "\n".join(f"Document {c} passage {i}: " + "retrieved context text " * 8 for i in range(40))
+        for c in range(50)
+    ]
+    questions = [f"Question {q}: summarize the findings relevant to topic {q} and list the risks." for q in range(questions)]
+    answers = [
+        json.dumps({
+            'summary': f"Finding {a}: " + "the documents agree on the main conclusion. " * 10,
+            'risks': f"Risk {a % 20}: " + "supplier concentration and pricing exposure. " * 4,
+            'confidence': "high" if a % 3 else "medium"
+        })
+        for a in range(300)
+    ]
+
+    session = []
+    for _ in range(interactions):
+        context = rng.choice(contexts)
+        question = rng.choice(questions)
+        session.append((context, question, rng.choice(answers)))
+    return session
+
+
+def run_session(session, dedupe_text: bool) -> int:
+    """Bytes still allocated after replaying the session into a fresh wrapper"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    # copy the answer so every response is a distinct string, like a decoded HTTP body
+    client = EchoClient(response=lambda prompt: "".join(list(prompt_answers[prompt])))
+    ffai = FFAI_AzureOpenAI(client, dedupe_text=dedupe_text)
+    prompt_answers = {}
+    for i, (context, question, answer) in enumerate(session):
+        prompt = f"<RAG>\n{context}\n</RAG>\n{question}"
+        prompt_answers[prompt] = answer
+        ffai.generate_response(prompt, prompt_name=f"q{i}")
+        prompt_answers.pop(prompt)
+
+    # reading the cleaned histories parses responses and fans out attributes
+    ffai.clean_history
+    ffai.prompt_attr_history
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del ffai
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--interactions', type=int, default=10_000)
+    parser.add_argument('--questions', type=int, default=200,
+                        help="distinct questions; with 50 contexts, fewer questions means more repeated prompts")
+    args = parser.parse_args()
+
+    session = make_session(args.interactions, args.questions)
+    without_store = run_session(session, dedupe_text=False)
+    with_store = run_session(session, dedupe_text=True)
+
+    distinct = len({(context, question) for context, question, _ in session})
+    print_results(f"History memory, {args.interactions} interactions, {distinct} distinct prompts", {
+        'without BlobStore': f"{without_store / 2**20:8.1f} MiB",
+        'with BlobStore': f"{with_store / 2**20:8.1f} MiB",
+        'reduction': f"{(1 - with_store / without_store) * 100:8.1f} %"
+    })
+
+
+if __name__ == '__main__':
+    main()
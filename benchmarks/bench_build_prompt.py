@@ -0,0 +1,64 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+FFAI_AzureOpenAI._build_prompt when many downstream prompts reference the same upstream prompts.
+
+    python -m benchmarks.bench_build_prompt [--interactions 5000] [--iterations 200]
+"""
+
+import argparse
+import json
+
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from benchmarks.common import EchoClient, time_per_call, print_results
+
+
+def legacy_build_prompt(ffai: FFAI_AzureOpenAI, prompt: str, history) -> str:
+    # the original implementation: scan prompt_attr_history and re-render every block
+    history_entries = []
+    for prompt_name in history:
+        matching_entries = [entry for entry in ffai.prompt_attr_history if entry.get('prompt_name') == prompt_name]
+        if matching_entries:
+            latest = matching_entries[-1]
+            history_entries.append({'prompt_name': latest.get('prompt_name'), 'prompt': latest['prompt'],
+                                    'response': latest['response']})
+
+    formatted_history = [
+        f"<interaction prompt_name='{entry['prompt_name']}'>\n"
+        f"USER: {entry['prompt']}\n"
+        f"SYSTEM: {entry['response']}\n"
+        f"</interaction>"
+        for entry in history_entries
+    ]
+    if not formatted_history:
+        return prompt
+    return ("<conversation_history>\n" + "\n".join(formatted_history) + "\n</conversation_history>\n" +
+            "===\n" + "Based on the conversation history above, please answer: " + prompt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--interactions', type=int, default=5_000)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    text_answer = "The upstream analysis found three issues. " * 20
+    json_answer = json.dumps({'summary': text_answer, 'score': 7})
+    # every tenth upstream response is JSON and fans out into 'summary' and 'score'
+    ffai = FFAI_AzureOpenAI(EchoClient(response=lambda prompt: json_answer if prompt.endswith("0") else text_answer))
+    for i in range(1, args.interactions + 1):
+        ffai.generate_response(f"Analyze record {i}", prompt_name=f"upstream{i}")
+
+    history = [f"upstream{i}" for i in range(1, args.interactions, args.interactions // 20)] + ['summary']
+    prompt = "Write the final report."
+    assert legacy_build_prompt(ffai, prompt, history) == ffai._build_prompt(prompt, history)
+
+    print_results(f"_build_prompt, {len(history)} referenced names, {len(ffai.prompt_attr_history)} attr entries", {
+        'legacy scan + render': time_per_call(lambda i: legacy_build_prompt(ffai, prompt, history), args.iterations),
+        'index + cached blocks': time_per_call(lambda i: ffai._build_prompt(prompt, history), args.iterations)
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+JSON extraction and parsing of ~1 MB model responses.
+
+    python -m benchmarks.bench_clean_response [--size-mb 1] [--iterations 20]
+"""
+
+import argparse
+import json
+
+from lib.AI import ResponseParser
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from benchmarks.common import EchoClient, time_per_call, print_results
+
+
+def make_response(size_bytes: int) -> str:
+    records = []
+    body_size = 0
+    i = 0
+    while body_size < size_bytes:
+        record = {"id": i, "name": f"item {i}", "score": i * 0.5, "tags": ["a", "b", "c"], "ok": i % 2 == 0}
+        records.append(record)
+        body_size += len(json.dumps(record)) + 2
+        i += 1
+    return "```json\n" + json.dumps({"items": records, "count": len(records)}) + "\n```"
+
+
+def legacy_clean(response: str):
+    # the pre-extractor implementation, for comparison
+    if response.startswith('```json'):
+        return json.loads(response[response.find('{'):response.rfind('}') + 1])
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=1.0)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    response = make_response(int(args.size_mb * 1024 * 1024))
+    n = args.iterations
+    results = {'response size': f"{len(response) / 1024 / 1024:.2f} MB"}
+
+    results['legacy slice + json.loads'] = time_per_call(lambda i: legacy_clean(response), n)
+    results['extract_json_text'] = time_per_call(lambda i: ResponseParser.extract_json_text(response), n)
+
+    orjson = ResponseParser.orjson
+    ResponseParser.orjson = None
+    results['parse_response (json)'] = time_per_call(lambda i: ResponseParser.parse_response(response), n)
+    ResponseParser.orjson = orjson
+    if orjson is not None:
+        results['parse_response (orjson)'] = time_per_call(lambda i: ResponseParser.parse_response(response), n)
+    else:
+        results['parse_response (orjson)'] = "orjson not installed"
+
+    # recording is lazy: generate_response does not parse until clean_history is read
+    ffai = FFAI_AzureOpenAI(EchoClient(response=lambda prompt: response))
+    results['generate_response (not read)'] = time_per_call(lambda i: ffai.generate_response(f"q{i}"), n)
+    results['first read of clean_history'] = time_per_call(lambda i: ffai.clean_history, 1) / n
+
+    print_results("JSON response handling, per call", results)
+
+
+if __name__ == "__main__":
+    main()
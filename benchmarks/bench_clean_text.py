@@ -0,0 +1,65 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Microbenchmarks for OrderedPromptHistory text cleaning on RAG-heavy prompts.
+
+    python -m benchmarks.bench_clean_text [--iterations 50]
+"""
+
+import argparse
+import re
+
+from lib.AI import OrderedPromptHistory as oph
+from lib.AI.OrderedPromptHistory import OrderedPromptHistory
+from benchmarks.common import time_per_call, print_results
+
+
+def legacy_clean_text(text: str) -> str:
+    # the original two-regex, line-by-line implementation, for comparison
+    cleaned = re.sub(r'<RAG>[\s\S]*?</RAG>', '', text)
+    cleaned = re.sub(r'========\s*PROMPT\s*========[\s\S]*', '', cleaned)
+    cleaned_lines = []
+    for line in cleaned.splitlines():
+        cleaned_line = ' '.join(line.split())
+        if cleaned_line:
+            cleaned_lines.append(cleaned_line)
+    return '\n'.join(cleaned_lines).strip()
+
+
+def make_prompt(size_bytes: int, rag_share: float = 0.8) -> str:
+    rag_line = "retrieved   passage text with\tsome   irregular spacing\n"
+    question_line = "  Please summarize   the key points\tabove.  \n\n"
+    rag = "<RAG>\n" + rag_line * max(1, int(size_bytes * rag_share) // len(rag_line)) + "</RAG>\n"
+    question = question_line * max(1, int(size_bytes * (1 - rag_share)) // len(question_line))
+    return rag + question + "======== PROMPT ========\ninternal template notes\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+    n = args.iterations
+
+    for size in (1_000, 20_000, 200_000):
+        prompt = make_prompt(size)
+        assert legacy_clean_text(prompt) == oph.clean_text_uncached(prompt)
+
+        results = {}
+        results['legacy regex + lines'] = time_per_call(lambda i: legacy_clean_text(prompt), n)
+        results['clean_text_uncached'] = time_per_call(lambda i: oph.clean_text_uncached(prompt), n)
+
+        oph.clear_clean_cache()
+        oph.clean_text(prompt)
+        results['clean_text (memo hit)'] = time_per_call(lambda i: oph.clean_text(prompt), n)
+
+        # full add_interaction with the same RAG-heavy prompt every time
+        history = OrderedPromptHistory()
+        results['add_interaction'] = time_per_call(
+            lambda i: history.add_interaction("gpt-4o", prompt, "short answer", prompt_name=f"p{i}"), n)
+
+        print_results(f"{len(prompt) / 1000:.0f} KB prompt", results)
+
+
+if __name__ == "__main__":
+    main()
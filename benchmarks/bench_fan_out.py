@@ -0,0 +1,71 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Asking several models the same question (as in try_ai_azureopenai_script_o1.py): one after
+another, with generate_responses (all answers), and with generate_first_response.
+
+Uses a fake transport with a fixed latency per model, so it runs without keys.
+
+    python -m benchmarks.bench_fan_out [--rounds 5]
+"""
+
+import argparse
+import os
+import time
+from types import SimpleNamespace
+
+from lib.AI.FFAzureOpenAI import FFAzureOpenAI
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from benchmarks.common import print_results
+
+# seconds per call, roughly in the ratio seen for these deployments
+MODEL_LATENCY = {'o1-mini': 0.30, 'gpt-4o': 0.15, 'gpt-4o-mini': 0.08}
+
+
+class SlowCompletions:
+    def create(self, model, messages, **kwargs):
+        time.sleep(MODEL_LATENCY[model])
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=f"{model} says 4"), finish_reason='stop')],
+            usage=SimpleNamespace(prompt_tokens=10, completion_tokens=3, prompt_tokens_details=None)
+        )
+
+
+def make_wrapper() -> FFAI_AzureOpenAI:
+    os.environ.setdefault('AZUREOPENAI_BASE', 'http://localhost')
+    client = FFAzureOpenAI(api_key='benchmark')
+    client.client = SimpleNamespace(chat=SimpleNamespace(completions=SlowCompletions()))
+    return FFAI_AzureOpenAI(client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    models = list(MODEL_LATENCY)
+    ffai = make_wrapper()
+
+    def timed(run):
+        start = time.perf_counter()
+        for i in range(args.rounds):
+            run(i)
+        return (time.perf_counter() - start) / args.rounds
+
+    sequential = timed(lambda i: [ffai.generate_response("what is 2 + 2?", model=model, prompt_name=f"seq{i}")
+                                  for model in models])
+    gathered = timed(lambda i: ffai.generate_responses("what is 2 + 2?", models, prompt_name=f"all{i}"))
+    first = timed(lambda i: ffai.generate_first_response("what is 2 + 2?", models, prompt_name=f"first{i}"))
+    time.sleep(max(MODEL_LATENCY.values()))  # let abandoned calls finish before counting
+
+    recorded = {model: len(ffai.get_model_interactions(model)) for model in models}
+    print_results(f"{len(models)} models {MODEL_LATENCY}, {args.rounds} rounds", {
+        'one after another': f"{sequential * 1000:8.1f} ms",
+        'generate_responses': f"{gathered * 1000:8.1f} ms",
+        'generate_first_response': f"{first * 1000:8.1f} ms",
+        'interactions recorded per model': recorded,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+OrderedPromptHistory.get_formatted_responses on pipeline-shaped dependency chains.
+
+    python -m benchmarks.bench_formatted_responses [--steps 200] [--iterations 50]
+"""
+
+import argparse
+import random
+
+from lib.AI.OrderedPromptHistory import OrderedPromptHistory
+from benchmarks.common import time_per_call, print_results
+
+
+def legacy_formatted_responses(history: OrderedPromptHistory, prompt_names) -> str:
+    # the original recursive implementation, for comparison
+    formatted_outputs = []
+    processed_prompts = set()
+
+    def process_prompt_chain(prompt_name):
+        if prompt_name in processed_prompts:
+            return
+        processed_prompts.add(prompt_name)
+        latest = history.get_latest_interaction_by_prompt_name(prompt_name)
+        if latest:
+            if latest.history:
+                for history_prompt in latest.history:
+                    process_prompt_chain(history_prompt)
+            if latest.prompt and latest.response:
+                formatted_outputs.append(f"<prompt:{latest.prompt}>{latest.response}</prompt:{latest.prompt}>")
+
+    for prompt_name in prompt_names:
+        process_prompt_chain(prompt_name)
+    return '\n'.join(formatted_outputs)
+
+
+def make_pipeline(steps: int, seed: int = 3) -> OrderedPromptHistory:
+    """Each step depends on a few earlier steps, some of which are missing or cyclic"""
+    rng = random.Random(seed)
+    history = OrderedPromptHistory()
+    for i in range(steps):
+        depends_on = [f"step{rng.randrange(max(1, i + 3))}" for _ in range(rng.randint(0, 3))]
+        history.add_interaction("gpt-4o", f"Step {i}: refine the analysis. " * 5, f"Result of step {i}. " * 20,
+                                prompt_name=f"step{i}", history=depends_on)
+    return history
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    history = make_pipeline(args.steps)
+    roots = [f"step{i}" for i in range(args.steps - 5, args.steps)]
+    assert legacy_formatted_responses(history, roots) == history.get_formatted_responses(roots)
+
+    results = {
+        'legacy recursive': time_per_call(lambda i: legacy_formatted_responses(history, roots), args.iterations),
+        'iterative + block cache': time_per_call(lambda i: history.get_formatted_responses(roots), args.iterations)
+    }
+
+    # a linear chain far deeper than the default recursion limit
+    deep = OrderedPromptHistory()
+    for i in range(5_000):
+        deep.add_interaction("gpt-4o", f"p{i}", f"r{i}", prompt_name=f"d{i}", history=[f"d{i - 1}"] if i else None)
+    results['5000-deep chain'] = time_per_call(lambda i: deep.get_formatted_responses(["d4999"]), 5)
+
+    print_results(f"get_formatted_responses, {args.steps} steps", results)
+
+
+if __name__ == '__main__':
+    main()
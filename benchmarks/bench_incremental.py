@@ -0,0 +1,81 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Rerunning a pipeline of named prompts (each reading earlier ones through history) after an
+edit: every prompt again, versus incremental=True over the previous run's saved state.
+
+    python -m benchmarks.bench_incremental [--stages 6] [--width 5]
+"""
+
+import argparse
+import pickle
+import random
+import time
+
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from lib.AI.BlobStore import content_key
+from benchmarks.common import EchoClient, print_results
+
+
+def pipeline(stages: int, width: int, rng: random.Random):
+    """(prompt_name, prompt, history): stages of prompts, each reading two from the stage before"""
+    steps = []
+    for stage in range(stages):
+        previous = [name for name, _, _ in steps[-width:]] if stage else []
+        for i in range(width):
+            history = rng.sample(previous, 2) if previous else None
+            steps.append((f"s{stage}_{i}", f"Stage {stage}, part {i}: summarize what you are given.", history))
+    return steps
+
+
+def run(steps, state=None, incremental=False):
+    calls = [0]
+
+    def respond(prompt):
+        calls[0] += 1
+        return "summary " + content_key(prompt).hex()[:16]
+
+    ffai = FFAI_AzureOpenAI(EchoClient(response=respond), stateless=True, incremental=incremental)
+    if state is not None:
+        ffai.load_state(pickle.loads(state))
+    start = time.perf_counter()
+    for name, prompt, history in steps:
+        ffai.generate_response(prompt, prompt_name=name, history=history)
+    return calls[0], time.perf_counter() - start, pickle.dumps(ffai.export_state())
+
+
+def descendants(steps, name):
+    found = {name}
+    for step_name, _, history in steps:
+        if history and found.intersection(history):
+            found.add(step_name)
+    return len(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', type=int, default=6)
+    parser.add_argument('--width', type=int, default=5)
+    args = parser.parse_args()
+    steps = pipeline(args.stages, args.width, random.Random(2))
+
+    full_calls, _, state = run(steps, incremental=True)
+    results = {'first run': f"{full_calls} calls"}
+
+    unchanged_calls, unchanged_time, _ = run(steps, state, incremental=True)
+    results['rerun, nothing edited'] = f"{unchanged_calls} calls ({unchanged_time * 1000:.1f} ms)"
+
+    for label, edited in (('a last-stage prompt', len(steps) - 1), ('a middle-stage prompt', len(steps) // 2),
+                          ('a first-stage prompt', 0)):
+        name, prompt, history = steps[edited]
+        changed = steps[:edited] + [(name, prompt + " Be brief.", history)] + steps[edited + 1:]
+        calls, _, _ = run(changed, state, incremental=True)
+        results[f'rerun, edited {label}'] = f"{calls} calls (prompts it reaches: {descendants(steps, name)})"
+
+    results['rerun without incremental'] = f"{run(steps, state)[0]} calls"
+    print_results(f"{len(steps)} named prompts in {args.stages} stages", results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Per-call logging overhead of FFAI_AzureOpenAI.generate_response with 10k-entry histories.
+
+    python -m benchmarks.bench_logging_overhead [--entries 10000] [--calls 200]
+"""
+
+import argparse
+import logging
+
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from lib.AI.Diagnostics import configure_diagnostics
+from benchmarks.common import EchoClient, FormattingNullHandler, time_per_call, print_results
+
+RAG_BLOCK = "<RAG>" + ("retrieved context line\n" * 200) + "</RAG>\n"
+
+
+def build_wrapper(entries: int) -> FFAI_AzureOpenAI:
+    ffai = FFAI_AzureOpenAI(EchoClient())
+    for i in range(entries):
+        ffai.generate_response(RAG_BLOCK + f"question {i}", prompt_name=f"p{i % 100}")
+    return ffai
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=10_000)
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+
+    root = logging.getLogger()
+    root.handlers = [FormattingNullHandler()]
+    root.setLevel(logging.WARNING)
+
+    ffai = build_wrapper(args.entries)
+
+    def call(i):
+        ffai.generate_response(RAG_BLOCK + f"follow up {i}", prompt_name=f"f{i}", history=["p1", "p2", "p3"])
+
+    results = {}
+    root.setLevel(logging.WARNING)
+    results['WARNING (logging off)'] = time_per_call(call, args.calls)
+
+    root.setLevel(logging.INFO)
+    results['INFO'] = time_per_call(call, args.calls)
+
+    root.setLevel(logging.DEBUG)
+    results['DEBUG, truncated payloads'] = time_per_call(call, max(1, args.calls // 10))
+
+    configure_diagnostics(max_chars=0)
+    results['DEBUG, full payloads'] = time_per_call(call, max(1, args.calls // 10))
+
+    print_results(f"generate_response per-call time, {args.entries} history entries", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Merging per-worker OrderedPromptHistory instances at the end of a parallel job.
+
+    python -m benchmarks.bench_merge_histories [--workers 8] [--interactions 2000]
+"""
+
+import argparse
+import time
+from copy import deepcopy
+
+from lib.AI.OrderedPromptHistory import OrderedPromptHistory
+from benchmarks.common import print_results
+
+
+def legacy_merge(history: OrderedPromptHistory, other: OrderedPromptHistory) -> None:
+    # the original implementation: copy, sort, clear and re-add (re-cleaning) everything
+    for prompt_name, interactions in other.prompt_dict.items():
+        if prompt_name not in history.prompt_dict:
+            history.prompt_dict[prompt_name] = []
+        history.prompt_dict[prompt_name].extend(deepcopy(interactions))
+
+    all_interactions = history.get_all_interactions()
+    history._current_sequence = 0
+    history.prompt_dict.clear()
+    history._usage_by_model.clear()
+    history._usage_by_prompt_name.clear()
+
+    for interaction in all_interactions:
+        history.add_interaction(
+            model=interaction.model,
+            prompt=interaction.prompt,
+            response=interaction.response,
+            prompt_name=interaction.prompt_name,
+            history=interaction.history,
+            usage=interaction.usage()
+        )
+
+
+def make_worker_histories(workers: int, interactions: int):
+    prompt = "<RAG>\n" + "retrieved passage text\n" * 50 + "</RAG>\nClassify row {row} for step {step}."
+    histories = []
+    for w in range(workers):
+        history = OrderedPromptHistory()
+        for i in range(interactions):
+            history.add_interaction("gpt-4o", prompt.format(row=i, step=w), f"label {i % 7}",
+                                    prompt_name=f"w{w}-row{i}",
+                                    usage={'prompt_tokens': 400, 'completion_tokens': 5, 'latency': 0.2})
+        histories.append(history)
+    return histories
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--interactions', type=int, default=2_000)
+    args = parser.parse_args()
+
+    histories = make_worker_histories(args.workers, args.interactions)
+
+    target = deepcopy(histories[0])
+    start = time.perf_counter()
+    for other in histories[1:]:
+        legacy_merge(target, other)
+    legacy = time.perf_counter() - start
+
+    target = deepcopy(histories[0])
+    start = time.perf_counter()
+    target.merge_histories(*histories[1:])
+    k_way = time.perf_counter() - start
+    assert len(target.get_all_interactions()) == args.workers * args.interactions
+
+    print_results(f"Merge {args.workers} histories x {args.interactions} interactions", {
+        'legacy pairwise merge': f"{legacy * 1000:10.1f} ms",
+        'k-way merge_histories': f"{k_way * 1000:10.1f} ms",
+        'speedup': f"{legacy / k_way:10.1f} x"
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Many tiny classification prompts: one request each with generate_response, versus
+generate_packed_responses.
+
+Uses a fake transport over FFAzureOpenAI (system instructions included) that counts tokens
+as characters / 4 and takes 10 ms per request plus 0.1 ms per completion token, so it runs
+without keys. The fake leaves out about 2% of the keys of a packed reply, to exercise the
+individual retries.
+
+    python -m benchmarks.bench_packing [--prompts 200] [--pack-size 20]
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import time
+from types import SimpleNamespace
+
+from lib.AI.FFAzureOpenAI import FFAzureOpenAI
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from benchmarks.common import print_results
+
+LABELS = ['positive', 'negative', 'neutral']
+OPINIONS = {'positive': ["loved it", "works great", "would buy again"],
+            'negative': ["broke in a week", "waste of money", "very disappointed"],
+            'neutral': ["arrived on tuesday", "it is blue", "came in a box"]}
+_PACKED = re.compile(r'<prompts>\n(.*)\n</prompts>', re.S)
+
+
+def label_of(prompt: str) -> str:
+    return next(label for label, phrases in OPINIONS.items() if any(phrase in prompt for phrase in phrases))
+
+
+class ClassifyingCompletions:
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.requests = 0
+
+    def create(self, model, messages, **kwargs):
+        self.requests += 1
+        prompt = messages[-1]['content']
+        packed = _PACKED.search(prompt)
+        if packed:
+            prompts = json.loads(packed.group(1))
+            content = json.dumps({name: label_of(text) for name, text in prompts.items()
+                                  if self.rng.random() >= 0.02})
+        else:
+            content = label_of(prompt)
+
+        prompt_tokens = sum(len(message['content']) for message in messages) // 4
+        completion_tokens = len(content) // 4
+        time.sleep(0.010 + completion_tokens * 0.0001)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason='stop')],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                  prompt_tokens_details=None)
+        )
+
+
+def make_wrapper(rng: random.Random):
+    os.environ.setdefault('AZUREOPENAI_BASE', 'http://localhost')
+    client = FFAzureOpenAI(api_key='benchmark')
+    completions = ClassifyingCompletions(rng)
+    client.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    # stateless, so neither mode pays for a growing client conversation
+    return FFAI_AzureOpenAI(client, stateless=True), completions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prompts', type=int, default=200)
+    parser.add_argument('--pack-size', type=int, default=20)
+    args = parser.parse_args()
+    rng = random.Random(11)
+
+    prompts = {}
+    for i in range(args.prompts):
+        label = rng.choice(LABELS)
+        prompts[f"review_{i}"] = ("Classify the sentiment of this review as positive, negative or neutral. "
+                                  f"Answer with the label only. Review: \"{rng.choice(OPINIONS[label])}\"")
+
+    results = {}
+    for label in ('one request per prompt', 'packed'):
+        ffai, completions = make_wrapper(rng)
+        start = time.perf_counter()
+        if label == 'packed':
+            responses = ffai.generate_packed_responses(prompts, pack_size=args.pack_size)
+        else:
+            responses = {name: ffai.generate_response(prompt, prompt_name=name) for name, prompt in prompts.items()}
+        elapsed = time.perf_counter() - start
+
+        usage = ffai.get_token_usage_by_model()[ffai.client.model]
+        correct = sum(1 for name, prompt in prompts.items() if responses[name] == label_of(prompt))
+        results[f'{label}: requests'] = completions.requests
+        results[f'{label}: prompt + completion tokens'] = f"{usage['prompt_tokens']:,} + {usage['completion_tokens']:,}"
+        results[f'{label}: wall time'] = f"{elapsed * 1000:8.1f} ms"
+        results[f'{label}: correct answers'] = f"{correct}/{len(prompts)}"
+
+    print_results(f"{args.prompts} classification prompts, packs of {args.pack_size}", results)
+
+
+if __name__ == '__main__':
+    main()
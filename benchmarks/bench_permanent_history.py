@@ -0,0 +1,93 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+PermanentHistory on a long-running session: tail queries and memory.
+
+    python -m benchmarks.bench_permanent_history [--turns 200000] [--max-memory-turns 10000]
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+from copy import deepcopy
+
+from lib.AI import PermanentHistory as permanent_history_module
+from lib.AI.PermanentHistory import PermanentHistory
+from benchmarks.common import time_per_call, print_results
+
+
+class LegacyPermanentHistory:
+    # the original list-scanning implementation, for comparison
+    def __init__(self):
+        self.turns = []
+
+    def add_turn(self, role, content, timestamp):
+        self.turns.append({"role": role, "content": [{"type": "text", "text": content}], "timestamp": timestamp})
+
+    def get_all_turns(self):
+        return deepcopy(self.turns)
+
+    def get_turns_since(self, timestamp):
+        return [turn for turn in self.turns if turn["timestamp"] > timestamp]
+
+
+def fill(history, turns: int, legacy: bool) -> None:
+    # one turn per second of a session that has been running for days
+    clock = [1_700_000_000.0]
+    permanent_history_module.time.time = lambda: clock[0]
+    text = "a message of typical chat length " * 6
+    for i in range(turns):
+        clock[0] += 1.0
+        role = "user" if i % 2 == 0 else "assistant"
+        if legacy:
+            history.add_turn(role, text, clock[0])
+        elif role == "user":
+            history.add_turn_user(text)
+        else:
+            history.add_turn_assistant(text)
+
+
+def build(turns: int, legacy: bool, max_memory_turns: int):
+    gc.collect()
+    tracemalloc.start()
+    history = LegacyPermanentHistory() if legacy else PermanentHistory(max_memory_turns=max_memory_turns)
+    fill(history, turns, legacy)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return history, used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=200_000)
+    parser.add_argument('--max-memory-turns', type=int, default=10_000)
+    args = parser.parse_args()
+
+    real_time = time.time
+    try:
+        legacy, legacy_memory = build(args.turns, True, args.max_memory_turns)
+        history, memory = build(args.turns, False, args.max_memory_turns)
+    finally:
+        permanent_history_module.time.time = real_time
+
+    last_minute = 1_700_000_000.0 + args.turns - 60
+    last_day = 1_700_000_000.0 + args.turns - 86_400
+    an_hour_a_day_ago = (last_day, last_day + 3_600)
+    assert legacy.get_turns_since(last_minute) == history.get_turns_since(last_minute)
+
+    results = {
+        'legacy memory': f"{legacy_memory / 2**20:8.1f} MiB",
+        'time-indexed memory': f"{memory / 2**20:8.1f} MiB",
+        'legacy get_turns_since(last minute)': time_per_call(lambda i: legacy.get_turns_since(last_minute), 20),
+        'get_turns_since(last minute)': time_per_call(lambda i: history.get_turns_since(last_minute), 200),
+        'get_recent_turns(20)': time_per_call(lambda i: history.get_recent_turns(20), 200),
+        'get_turns_between(an hour, a day ago)': time_per_call(lambda i: history.get_turns_between(*an_hour_a_day_ago), 20),
+    }
+    print_results(f"PermanentHistory, {args.turns} turns, {args.max_memory_turns} in memory", results)
+    history.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Record/replay with a cassette (lib/AI/Cassette.py).
+
+Records many chat completion exchanges, then replays a sample of them from a small cassette
+and from a large one through the transport alone. A lookup is a dict access, so the time per
+replayed request should not depend on the size of the cassette. Then compares FFAzureOpenAI
+calls replayed from a cassette with the same calls recorded from the MockTransport.
+
+The responses come from an httpx MockTransport, so it runs without keys or network.
+
+    python -m benchmarks.bench_replay [--requests 100000] [--small 1000] [--calls 2000]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+from openai import DefaultHttpxClient
+
+from lib.AI.Cassette import Cassette, CassetteTransport, httpx
+from lib.AI.FFAzureOpenAI import FFAzureOpenAI
+from benchmarks.common import print_results
+
+URL = 'http://localhost/openai/deployments/gpt-4o/chat/completions?api-version=2024-08-01-preview'
+
+
+def chat_completion(request: 'httpx.Request') -> 'httpx.Response':
+    prompt = json.loads(request.content)['messages'][-1]['content']
+    return httpx.Response(200, json={
+        'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o',
+        'choices': [{'index': 0, 'finish_reason': 'stop',
+                     'message': {'role': 'assistant', 'content': f"answer to {prompt}"}}],
+        'usage': {'prompt_tokens': 40, 'completion_tokens': 8, 'total_tokens': 48}
+    })
+
+
+def chat_request(prompt: str) -> 'httpx.Request':
+    return httpx.Request('POST', URL, json={
+        'model': 'gpt-4o', 'max_tokens': 4000, 'temperature': 0.5,
+        'messages': [{'role': 'system', 'content': 'Respond accurately to user queries.'},
+                     {'role': 'user', 'content': prompt}]})
+
+
+def send(transport: CassetteTransport, prompts) -> float:
+    """Seconds the transport takes, leaving out building the requests"""
+    requests = [chat_request(prompt) for prompt in prompts]
+    start = time.perf_counter()
+    for request in requests:
+        transport.handle_request(request).read()
+    return time.perf_counter() - start
+
+
+def make_client(cassette: Cassette, network=None) -> FFAzureOpenAI:
+    """FFAzureOpenAI over a cassette; network is the transport recordings are made from"""
+    os.environ.setdefault('AZUREOPENAI_BASE', 'http://localhost')
+    client = FFAzureOpenAI(api_key='benchmark')
+    client.client = client.client.with_options(
+        http_client=DefaultHttpxClient(transport=CassetteTransport(cassette, transport=network)))
+    return client
+
+
+def call(client: FFAzureOpenAI, prompts) -> float:
+    start = time.perf_counter()
+    for prompt in prompts:
+        client.generate_response(prompt)
+        client.clear_conversation()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100000)
+    parser.add_argument('--small', type=int, default=1000)
+    parser.add_argument('--sample', type=int, default=20000, help="requests replayed from each cassette")
+    parser.add_argument('--calls', type=int, default=2000, help="FFAzureOpenAI calls")
+    args = parser.parse_args()
+    logging.getLogger('lib.AI').setLevel(logging.WARNING)
+
+    rng = random.Random(5)
+    prompts = [f"Question {i}: what is {rng.randint(1, 10**6)} squared?" for i in range(args.requests)]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {'small': os.path.join(directory, 'small.cassette'), 'large': os.path.join(directory, 'large.cassette')}
+        sizes = {'small': args.small, 'large': args.requests}
+
+        # TRANSPORT ALONE
+        for label, path in paths.items():
+            cassette = Cassette(path, 'record')
+            elapsed = send(CassetteTransport(cassette, transport=httpx.MockTransport(chat_completion)),
+                           prompts[:sizes[label]])
+            cassette.close()
+            if label == 'large':
+                size = os.path.getsize(path)
+                results[f'record {args.requests:,} requests'] = f"{elapsed:8.2f} s"
+                results['cassette size'] = f"{size / 1e6:8.2f} MB ({size / args.requests:.0f} bytes/exchange)"
+
+        for label, path in paths.items():
+            start = time.perf_counter()
+            cassette = Cassette(path, 'replay')
+            load = time.perf_counter() - start
+            sample = [rng.choice(prompts[:sizes[label]]) for _ in range(args.sample)]
+            elapsed = send(CassetteTransport(cassette), sample)
+            results[f'{label} cassette ({sizes[label]:,}): load'] = f"{load * 1000:8.1f} ms"
+            results[f'{label} cassette ({sizes[label]:,}): replay'] = f"{elapsed / len(sample) * 1e6:8.1f} us/request"
+
+        # THROUGH FFAzureOpenAI
+        calls = prompts[:args.calls]
+        path = os.path.join(directory, 'calls.cassette')
+        recording = Cassette(path, 'record')
+        elapsed = call(make_client(recording, httpx.MockTransport(chat_completion)), calls)
+        recording.close()
+        results['FFAzureOpenAI, recorded from the MockTransport'] = f"{elapsed / len(calls) * 1e6:8.0f} us/call"
+
+        replaying = Cassette(path, 'replay')
+        elapsed = call(make_client(replaying), calls)
+        results['FFAzureOpenAI, replayed'] = f"{elapsed / len(calls) * 1e6:8.0f} us/call"
+        results['FFAzureOpenAI, replayed / recorded'] = f"{replaying.replayed:,} / {len(replaying):,}"
+
+    print_results("Cassette record/replay", results)
+
+
+if __name__ == '__main__':
+    main()
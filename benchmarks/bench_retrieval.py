@@ -0,0 +1,86 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Relevance-ranked history in _build_prompt: index upkeep, query cost, and prompt size and
+precision compared with naming every past interaction.
+
+    python -m benchmarks.bench_retrieval [--interactions 5000] [--topics 50] [--k 5]
+"""
+
+import argparse
+import random
+import time
+from itertools import islice
+
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from lib.AI.RelevanceIndex import BM25Index, estimate_tokens
+from benchmarks.common import EchoClient, time_per_call, print_results
+
+
+def topic_vocabularies(rng: random.Random, topics: int):
+    syllables = ["ka", "lo", "mi", "ne", "ru", "ta", "vo", "shi", "den", "bar", "pel", "gri", "zo", "fu"]
+    words = lambda count: [''.join(rng.choice(syllables) for _ in range(3)) for _ in range(count)]
+    common = words(200)  # shared by every topic
+    return common, [words(15) for _ in range(topics)]
+
+
+def sentence(rng: random.Random, common, vocabulary, length: int = 30) -> str:
+    # a third of the words are topic words, the rest common ones
+    return ' '.join(rng.choice(vocabulary) if rng.random() < 0.33 else rng.choice(common) for _ in range(length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--interactions', type=int, default=5_000)
+    parser.add_argument('--topics', type=int, default=50)
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+    rng = random.Random(3)
+
+    common, vocabularies = topic_vocabularies(rng, args.topics)
+    topics = [rng.randrange(args.topics) for _ in range(args.interactions)]
+    prompts = [sentence(rng, common, vocabularies[topic]) for topic in topics]
+    responses = {prompt: sentence(rng, common, vocabularies[topic], 60) for prompt, topic in zip(prompts, topics)}
+
+    ffai = FFAI_AzureOpenAI(EchoClient(response=lambda prompt: responses.get(prompt, "ok")))
+    for i, prompt in enumerate(prompts):
+        ffai.generate_response(prompt, prompt_name=f"p{i}")
+
+    # index upkeep: one more interaction into the existing index, versus rebuilding it
+    documents = [f"{entry['prompt']}\n{entry['response']}" for entry in ffai.history]
+    index = BM25Index()
+    start = time.perf_counter()
+    for document in documents:
+        index.add(document)
+    build_time = time.perf_counter() - start
+
+    # queries: a new question on a random topic
+    queries = [(topic, sentence(rng, common, vocabularies[topic], 20)) for topic in
+               (rng.randrange(args.topics) for _ in range(200))]
+    with ffai._lock:
+        ffai._sync_relevance_index()
+    retrieve_time = time_per_call(lambda i: ffai._build_prompt(queries[i % len(queries)][1], retrieve=args.k), 200)
+
+    relevant = 0
+    retrieved_tokens = 0
+    for topic, query in queries:
+        with ffai._lock:
+            ranked = list(islice(ffai._relevance_index.ranked(query), args.k))
+        relevant += sum(1 for position, _ in ranked if topics[position] == topic)
+        retrieved_tokens += estimate_tokens(ffai._build_prompt(query, retrieve=args.k))
+    all_names = [f"p{i}" for i in range(args.interactions)]
+    everything_tokens = estimate_tokens(ffai._build_prompt(queries[0][1], history=all_names))
+
+    print_results(f"{args.interactions} interactions, {args.topics} topics, top {args.k}", {
+        'add one interaction (incremental)': build_time / len(documents),
+        'rebuild the index (per new interaction)': build_time,
+        f'_build_prompt(retrieve={args.k})': retrieve_time,
+        f'precision@{args.k} (same topic)': f"{relevant / (len(queries) * args.k):.2f}",
+        'prompt tokens, retrieved': f"{retrieved_tokens // len(queries):,}",
+        'prompt tokens, every interaction named': f"{everything_tokens:,}",
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+SemanticCache: lookup cost as the cache grows, and model calls saved on a workload with
+reformatted repeats.
+
+    python -m benchmarks.bench_semantic_cache [--entries 5000] [--requests 2000]
+"""
+
+import argparse
+import random
+
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from lib.AI.SemanticCache import SemanticCache
+from benchmarks.common import EchoClient, time_per_call, print_results
+
+SUBJECTS = ["password", "invoice", "shipping address", "subscription", "refund", "account email",
+            "two-factor login", "order status", "billing plan", "API key", "team members", "data export"]
+ASKS = ["How do I change my {}?", "Where can I see my {}?", "Why is my {} not working?",
+        "Can you explain the {} settings?", "What happens if I delete my {}?", "Who can update the {}?"]
+
+
+def prompt_pool(rng: random.Random, size: int):
+    """Distinct questions: a template and subject, and a few words of context"""
+    syllables = ["ka", "lo", "mi", "ne", "ru", "ta", "vo", "shi", "den", "bar", "pel", "gri"]
+    vocabulary = sorted({''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(4_000)})
+    pool = set()
+    while len(pool) < size:
+        context = ' '.join(rng.sample(vocabulary, 6))
+        pool.add(f"{rng.choice(ASKS).format(rng.choice(SUBJECTS))} Context: {context}, order 1{rng.randint(0, 999):03d}.")
+    return sorted(pool)
+
+
+def reformat(rng: random.Random, prompt: str) -> str:
+    """The same question with different casing, spacing and punctuation"""
+    variants = [prompt.lower(), prompt.upper(), "  " + prompt.replace(" ", "  "),
+                prompt.replace("?", " ?").rstrip("."), prompt + "\n"]
+    return rng.choice(variants)
+
+
+def near_miss(rng: random.Random, prompt: str) -> str:
+    """A different question that shares most of the text: another subject or order number"""
+    if rng.random() < 0.5:
+        subject = next(subject for subject in SUBJECTS if subject in prompt)
+        return prompt.replace(subject, rng.choice([s for s in SUBJECTS if s not in prompt]))
+    head, number = prompt.rsplit(' 1', 1)
+    return f"{head} 2{number}"
+
+
+def workload(rng: random.Random, pool, requests: int):
+    """(prompt, kind): 40% reformatted repeats, 10% exact repeats, 10% near misses, the rest new"""
+    seen = []
+    fresh = iter(pool)
+    traffic = []
+    for _ in range(requests):
+        roll = rng.random()
+        if seen and roll < 0.4:
+            traffic.append((reformat(rng, rng.choice(seen)), 'reformatted'))
+        elif seen and roll < 0.5:
+            traffic.append((rng.choice(seen), 'repeat'))
+        elif seen and roll < 0.6:
+            traffic.append((near_miss(rng, rng.choice(seen)), 'near miss'))
+        else:
+            prompt = next(fresh)
+            seen.append(prompt)
+            traffic.append((prompt, 'new'))
+    return traffic
+
+
+def answer(prompt: str) -> str:
+    return "answer to: " + ' '.join(prompt.lower().replace(' ?', '?').rstrip('.\n ').split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=5_000)
+    parser.add_argument('--requests', type=int, default=2_000)
+    args = parser.parse_args()
+    rng = random.Random(5)
+
+    # lookup cost in a full cache
+    cache = SemanticCache(max_entries=args.entries)
+    pool = prompt_pool(rng, args.entries + args.requests)
+    for prompt in pool[:args.entries]:
+        cache.add(prompt, "answer", scope='gpt-4o')
+    probes = pool[args.entries:]
+    embed_time = time_per_call(lambda i: cache.vectorizer.embed(probes[i % len(probes)]), 500)
+    lookup_time = time_per_call(lambda i: cache.lookup(probes[i % len(probes)], scope='gpt-4o'), 500)
+
+    # model calls saved on the workload, through the wrapper
+    traffic = workload(rng, pool, args.requests)
+    results = {'embed prompt': embed_time, f'lookup among {args.entries}': lookup_time}
+    for label, semantic_cache in (('without cache', None), ('with cache', SemanticCache())):
+        calls = [0]
+
+        def respond(prompt, calls=calls):
+            calls[0] += 1
+            return answer(prompt)
+
+        ffai = FFAI_AzureOpenAI(EchoClient(response=respond), semantic_cache=semantic_cache)
+        wrong = 0
+        for prompt, kind in traffic:
+            if ffai.generate_response(prompt) != answer(prompt):
+                wrong += 1
+        results[f'model calls {label}'] = calls[0]
+        results[f'wrong answers {label}'] = wrong
+
+    kinds = {kind: sum(1 for _, k in traffic if k == kind) for kind in ('new', 'repeat', 'reformatted', 'near miss')}
+    print_results(f"SemanticCache, {args.entries} entries; {args.requests} requests: {kinds}", results)
+
+
+if __name__ == '__main__':
+    main()
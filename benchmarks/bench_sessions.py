@@ -0,0 +1,95 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Memory and latency of SessionManager as the number of end users grows.
+
+Compares one FFAI_AzureOpenAI per user (all kept in memory) with a SessionManager that keeps
+at most --max-sessions in memory and evicts the rest to a temporary directory.
+
+    python -m benchmarks.bench_sessions [--users 2000] [--turns 5] [--max-sessions 100]
+"""
+
+import argparse
+import gc
+import random
+import tempfile
+import time
+import tracemalloc
+
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from lib.AI.SessionManager import SessionManager, DirectorySessionStore
+from benchmarks.common import EchoClient, print_results
+
+
+def requests(users: int, turns: int, seed: int = 11):
+    """(user, prompt) pairs: every user asks `turns` questions, in random interleaving"""
+    rng = random.Random(seed)
+    pending = [(f"user{u}", t) for u in range(users) for t in range(turns)]
+    rng.shuffle(pending)
+    return [(user, f"Turn {turn}: " + "please look into my account settings. " * 10) for user, turn in pending]
+
+
+def measure(run) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    keep = run()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del keep
+    return used, elapsed
+
+
+def check_session_settings(client: EchoClient) -> None:
+    """A session's fingerprints follow the shared client's settings"""
+    manager = SessionManager(client, store=DirectorySessionStore(tempfile.mkdtemp(prefix='bench_sessions_')))
+    with manager.session('settings') as ffai:
+        client.temperature = 0.2
+        before = ffai._fingerprint("prompt", "prompt", client.model, None, None)
+        client.temperature = 0.9
+        after = ffai._fingerprint("prompt", "prompt", client.model, None, None)
+    del client.temperature
+    assert before != after, "session fingerprint ignores the client's temperature"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2_000)
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--max-sessions', type=int, default=100)
+    args = parser.parse_args()
+
+    traffic = requests(args.users, args.turns)
+    client = EchoClient(response=lambda prompt: "Here is what I found. " * 15)
+    check_session_settings(client)
+
+    def per_user_wrappers():
+        wrappers = {}
+        for user, prompt in traffic:
+            if user not in wrappers:
+                wrappers[user] = FFAI_AzureOpenAI(EchoClient(response=client.response))
+            wrappers[user].generate_response(prompt)
+        return wrappers
+
+    def session_manager():
+        manager = SessionManager(client, max_sessions=args.max_sessions,
+                                 store=DirectorySessionStore(tempfile.mkdtemp(prefix='bench_sessions_')))
+        for user, prompt in traffic:
+            manager.generate_response(user, prompt)
+        return manager
+
+    wrapper_memory, wrapper_time = measure(per_user_wrappers)
+    manager_memory, manager_time = measure(session_manager)
+
+    requests_made = len(traffic)
+    print_results(f"{args.users} users x {args.turns} turns, max_sessions={args.max_sessions}", {
+        'one wrapper per user': f"{wrapper_memory / 2**20:8.1f} MiB  {wrapper_time / requests_made * 1e6:8.1f} us/request",
+        'SessionManager': f"{manager_memory / 2**20:8.1f} MiB  {manager_time / requests_made * 1e6:8.1f} us/request",
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Prompt tokens sent by FFAI_AzureOpenAI over FFAzureOpenAI, with the client's own conversation
+(the default) and in stateless mode, on a workflow that also passes named history.
+
+Uses a fake transport that counts prompt tokens as characters / 4, so it runs without keys.
+
+    python -m benchmarks.bench_stateless [--calls 40]
+"""
+
+import argparse
+import os
+from types import SimpleNamespace
+
+from lib.AI.FFAzureOpenAI import FFAzureOpenAI
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from benchmarks.common import print_results
+
+
+class CountingCompletions:
+    def __init__(self):
+        self.prompt_tokens = []
+
+    def create(self, model, messages, **kwargs):
+        prompt_tokens = sum(len(message['content']) for message in messages) // 4
+        self.prompt_tokens.append(prompt_tokens)
+        content = "Here is a detailed answer. " * 20
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason='stop')],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(content) // 4,
+                                  prompt_tokens_details=None)
+        )
+
+
+def run(calls: int, stateless: bool):
+    os.environ.setdefault('AZUREOPENAI_BASE', 'http://localhost')
+    client = FFAzureOpenAI(api_key='benchmark')
+    completions = CountingCompletions()
+    client.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    ffai = FFAI_AzureOpenAI(client, stateless=stateless)
+
+    for i in range(calls):
+        # every fifth call asks about the previous two answers by name
+        history = [f"step{i - 1}", f"step{i - 2}"] if i >= 2 and i % 5 == 0 else None
+        ffai.generate_response(f"Step {i}: describe the next part of the migration plan in detail.",
+                               prompt_name=f"step{i}", history=history)
+    return completions.prompt_tokens, ffai
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=40)
+    args = parser.parse_args()
+
+    stateful_tokens, _ = run(args.calls, stateless=False)
+    stateless_tokens, ffai = run(args.calls, stateless=True)
+    reported = ffai.get_token_usage_by_model()[ffai.client.model]['context_tokens_saved']
+
+    print_results(f"{args.calls} calls, named history every fifth call", {
+        'prompt tokens, client conversation': f"{sum(stateful_tokens):,} (last call {stateful_tokens[-1]:,})",
+        'prompt tokens, stateless': f"{sum(stateless_tokens):,} (last call {stateless_tokens[-1]:,})",
+        'tokens saved, measured': f"{sum(stateful_tokens) - sum(stateless_tokens):,}",
+        'tokens saved, reported (context_tokens_saved)': f"{reported:,}",
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+import logging
+import time
+from typing import Callable, Dict, Any, Optional
+
+
+class EchoClient:
+    """
+    In-process stand-in for FFAzureOpenAI: no network, fixed-size responses.
+    Lets the benchmarks isolate wrapper and history overhead.
+    """
+
+    def __init__(self, model: str = "gpt-4o", response: Optional[Callable[[str], str]] = None):
+        self.model = model
+        self.conversation_history = []
+        self.last_usage = None
+        self.response = response or (lambda prompt: "ok: " + prompt[-40:])
+
+    def generate_response(self, prompt: str, model: Optional[str] = None, **kwargs) -> str:
+        response = self.response(prompt)
+        self.last_usage = {
+            'prompt_tokens': len(prompt) // 4,
+            'completion_tokens': len(response) // 4,
+            'cached_tokens': 0,
+            'finish_reason': 'stop',
+            'latency': 0.0
+        }
+        return response
+
+    def clear_conversation(self):
+        self.conversation_history = []
+
+
+class FormattingNullHandler(logging.Handler):
+    """Formats every record (so the cost of building messages is paid) and drops it"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.format(record)
+
+
+def time_per_call(fn: Callable[[int], Any], iterations: int) -> float:
+    """Mean seconds per call of fn(i) over the given iterations"""
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    return (time.perf_counter() - start) / iterations
+
+
+def print_results(title: str, results: Dict[str, Any]) -> None:
+    print(f"\n{title}")
+    print("-" * len(title))
+    width = max(len(name) for name in results)
+    for name, value in results.items():
+        if isinstance(value, float):
+            print(f"  {name:<{width}}  {value * 1_000_000:12.1f} us")
+        else:
+            print(f"  {name:<{width}}  {value}")
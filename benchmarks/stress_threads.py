@@ -0,0 +1,125 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Stress test: one FFAI_AzureOpenAI wrapper and one FFAzureOpenAI client shared by a thread pool.
+
+The Azure SDK client is replaced with an in-process fake, so no network or API key is needed.
+Every worker uses its own conversation (conversation_scope='thread'). After the run the
+histories are checked for lost, duplicated or interleaved entries and for usage that was
+recorded against the wrong call. Exits non-zero on any failure.
+
+    python -m benchmarks.stress_threads [--threads 64] [--calls 200]
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from lib.AI.FFAzureOpenAI import FFAzureOpenAI
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+
+
+class FakeCompletions:
+    """Answers chat.completions.create; prompt_tokens encodes the prompt so usage can be checked"""
+
+    def create(self, model, messages, **kwargs):
+        prompt = messages[-1]['content']
+        worker, call = prompt.rsplit(' ', 2)[-2:]
+        time.sleep(0)  # let other threads run mid-call
+        if int(call) % 4 == 0:
+            content = json.dumps({f"w{worker}_value": call, 'turns': len(messages) - 1})
+        else:
+            content = f"answer {worker} {call} after {len(messages) - 1} messages"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason='stop')],
+            usage=SimpleNamespace(prompt_tokens=int(worker) * 100_000 + int(call), completion_tokens=1,
+                                  prompt_tokens_details=None)
+        )
+
+
+def make_wrapper() -> FFAI_AzureOpenAI:
+    os.environ.setdefault('AZUREOPENAI_BASE', 'http://localhost')
+    client = FFAzureOpenAI(api_key='stress', conversation_scope='thread')
+    client.client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+    return FFAI_AzureOpenAI(client)
+
+
+def check(condition: bool, message: str, failures: list) -> None:
+    if not condition:
+        failures.append(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+
+    ffai = make_wrapper()
+    conversations = {}
+    start_barrier = threading.Barrier(args.threads)
+
+    def worker(w: int) -> None:
+        start_barrier.wait()
+        for call in range(args.calls):
+            # reference this worker's previous prompt when it was plain text (JSON responses are
+            # stored by attribute name), and read the lazily built histories now and then
+            history = [f"w{w}-c{call - 1}"] if call and (call - 1) % 4 else None
+            ffai.generate_response(f"Worker {w} {call}", prompt_name=f"w{w}-c{call}", history=history)
+            if call % 50 == 0:
+                ffai.prompt_attr_history
+        conversations[w] = list(ffai.client.conversation_history)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        for future in [pool.submit(worker, w) for w in range(args.threads)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    total = args.threads * args.calls
+    failures = []
+
+    check(len(ffai.history) == total, f"history has {len(ffai.history)} entries, expected {total}", failures)
+    check(len(ffai.clean_history) == total, f"clean_history has {len(ffai.clean_history)} entries", failures)
+
+    interactions = ffai.ordered_history.get_all_interactions()
+    sequences = [i.sequence_number for i in interactions]
+    check(sequences == list(range(1, total + 1)), "ordered_history sequence numbers are not 1..N", failures)
+    for interaction in interactions:
+        w, call = interaction.prompt_name[1:].split('-c')
+        expected_tokens = int(w) * 100_000 + int(call)
+        if interaction.prompt_tokens != expected_tokens:
+            failures.append(f"{interaction.prompt_name} recorded usage of another call")
+            break
+
+    turns = ffai.permanent_history.get_all_turns()
+    check(len(turns) == 2 * total, f"permanent_history has {len(turns)} turns, expected {2 * total}", failures)
+    check(all(turns[i]['role'] == ('user' if i % 2 == 0 else 'assistant') for i in range(len(turns))),
+          "permanent_history turns are interleaved", failures)
+
+    for w, messages in conversations.items():
+        check(len(messages) == 2 * args.calls, f"worker {w} conversation has {len(messages)} messages", failures)
+        check(all(f"Worker {w} " in m['content'] for m in messages[::2]),
+              f"worker {w} conversation contains another worker's prompts", failures)
+
+    attr_names = {entry['prompt_name'] for entry in ffai.prompt_attr_history}
+    check(all(f"w{w}_value" in attr_names for w in range(args.threads)), "JSON responses were not fanned out", failures)
+
+    print(f"{args.threads} threads x {args.calls} calls: {total} interactions in {elapsed:.2f} s "
+          f"({total / elapsed:,.0f} calls/s)")
+    if failures:
+        print("FAILED")
+        for failure in failures[:20]:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
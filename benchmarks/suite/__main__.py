@@ -0,0 +1,75 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Benchmark suite: every FF* client and FFAI_AzureOpenAI against local mock provider servers.
+
+    python -m benchmarks.suite run [-o results.json] [--clients FFAzureOpenAI,FFAnthropic] [--quick]
+    python -m benchmarks.suite compare baseline.json results.json [--threshold 0.10]
+
+run measures, per client: call time and overhead over the bare SDK, throughput at several
+thread counts, time to first text, and success under injected errors; and the memory
+FFAI_AzureOpenAI keeps over many turns. compare exits with status 1 if a metric regressed.
+"""
+
+import argparse
+import json
+import sys
+
+from benchmarks.suite.clients import CLIENTS
+from benchmarks.suite.compare import compare, print_comparison
+from benchmarks.suite.run import run_suite, write_results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.suite', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='measure and write the results')
+    run.add_argument('-o', '--output', default='benchmark_results.json')
+    run.add_argument('--clients', default=','.join(spec.name for spec in CLIENTS),
+                     help='comma-separated client names (default: all)')
+    run.add_argument('--turns', type=int, default=10_000, help='turns for the memory measurement (0 to skip)')
+    run.add_argument('--calls', type=int, default=200, help='calls per client for overhead and errors')
+    run.add_argument('--concurrency', default='1,4,16', help='thread counts for throughput')
+    run.add_argument('--calls-per-worker', type=int, default=10)
+    run.add_argument('--quick', action='store_true', help='fewer calls and turns, for a smoke test')
+
+    comparison = commands.add_parser('compare', help='flag regressions between two result files')
+    comparison.add_argument('baseline')
+    comparison.add_argument('current')
+    comparison.add_argument('--threshold', type=float, default=0.10,
+                            help='relative change that counts as a regression (default 0.10)')
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        rows, regressions = compare(baseline, current, args.threshold)
+        print_comparison(rows)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            return 1
+        print("\nNo regressions")
+        return 0
+
+    clients = [name.strip() for name in args.clients.split(',') if name.strip()]
+    unknown = [name for name in clients if name not in {spec.name for spec in CLIENTS}]
+    if unknown:
+        parser.error(f"unknown clients: {unknown}")
+    if args.quick:
+        args.calls, args.turns, args.calls_per_worker = 40, min(args.turns, 1_000), 4
+    results = run_suite(clients, args.turns, args.calls, [int(level) for level in args.concurrency.split(',')],
+                        args.calls_per_worker)
+    write_results(results, args.output)
+    if results.errors:
+        print("Not measured: " + '; '.join(f"{name}: {error}" for name, error in results.errors.items()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+The clients the suite measures. Each ClientSpec builds a client pointed at a MockServer,
+makes one call with it, and makes the same request with the bare SDK, so the difference is
+the client's own overhead.
+"""
+
+from dataclasses import dataclass
+from typing import Callable, Optional, Any, Dict, List
+import asyncio
+import contextlib
+import importlib
+import os
+import time
+import weakref
+
+from benchmarks.suite.mock_servers import MockServer
+
+
+@dataclass
+class ClientSpec:
+    name: str
+    module: str  # imported lazily; a client whose dependencies are missing is skipped
+    build: Callable[[Any, MockServer], Any]  # (module, server) -> client
+    call: Callable[[Any, str], str]  # (client, prompt) -> response
+    raw_call: Callable[[Any, str], Any]  # (client, prompt) -> the same request through client.client
+    shared: bool = False  # one instance may be used by several threads at once
+    # (client, prompt) -> seconds until the first streamed text, for clients that stream
+    first_text: Optional[Callable[[Any, str], float]] = None
+
+    def load(self) -> Any:
+        return importlib.import_module(self.module)
+
+
+def point_sdks_at(server: MockServer) -> None:
+    """Make every SDK client created from now on call the mock server"""
+    os.environ['AZUREOPENAI_BASE'] = server.url
+    os.environ['OPENAI_BASE_URL'] = server.url + '/v1'
+    os.environ['ANTHROPIC_BASE_URL'] = server.url
+
+
+def _call_and_forget(client: Any, prompt: str) -> str:
+    """One call with an empty conversation, so every measured request is the same size"""
+    response = client.generate_response(prompt)
+    client.clear_conversation()
+    return response
+
+
+# AZURE OPENAI ------------------------------------------------------------------------------
+def _build_azure(module: Any, server: MockServer) -> Any:
+    return module.FFAzureOpenAI(api_key='mock', conversation_scope='thread')
+
+
+def _raw_azure(client: Any, prompt: str) -> Any:
+    return client.client.chat.completions.create(
+        model=client.model,
+        messages=[{"role": "system", "content": client.system_instructions}, {"role": "user", "content": prompt}],
+        max_tokens=client.max_tokens, temperature=client.temperature)
+
+
+def _build_ffai(module: Any, server: MockServer) -> Any:
+    from lib.AI.FFAzureOpenAI import FFAzureOpenAI
+    return module.FFAI_AzureOpenAI(FFAzureOpenAI(api_key='mock', conversation_scope='thread'), stateless=True)
+
+
+def _raw_ffai(ffai: Any, prompt: str) -> Any:
+    return _raw_azure(ffai.client, prompt)
+
+
+# OPENAI ASSISTANTS ---------------------------------------------------------------------------
+def _build_assistant(module: Any, server: MockServer) -> Any:
+    return module.FFOpenAIAssistant(api_key='mock')
+
+
+def _call_assistant(client: Any, prompt: str) -> str:
+    return client.generate_response(prompt)
+
+
+def _raw_assistant(client: Any, prompt: str) -> Any:
+    sdk = client.client
+    sdk.beta.threads.messages.create(thread_id=client.thread_id, role="user", content=prompt)
+    sdk.beta.threads.runs.create(thread_id=client.thread_id, assistant_id=client.assistant_id)
+    return sdk.beta.threads.messages.list(thread_id=client.thread_id).data[0]
+
+
+# PERPLEXITY ----------------------------------------------------------------------------------
+def _build_perplexity(module: Any, server: MockServer) -> Any:
+    client = module.FFPerplexity(api_key='mock')
+    # the Perplexity base URL is fixed in the client
+    client.client = client.client.with_options(base_url=server.url)
+    return client
+
+
+def _raw_perplexity(client: Any, prompt: str) -> Any:
+    return client.client.chat.completions.create(
+        model=client.model,
+        messages=[{"role": "system", "content": client.system_instructions}, {"role": "user", "content": prompt}],
+        max_tokens=client.max_tokens, temperature=client.temperature)
+
+
+def _build_perplexity_async(module: Any, server: MockServer) -> Any:
+    client = module.FFPerplexityAsync(api_key='mock')
+    client.client = client.client.with_options(base_url=server.url)
+    # the client's connections belong to one event loop, so every call runs on this one
+    client.runner = asyncio.Runner()
+    # and they are closed on it when the suite drops the client
+    weakref.finalize(client, _close_async, client.runner, client.client)
+    return client
+
+
+def _close_async(runner: asyncio.Runner, sdk: Any) -> None:
+    runner.run(sdk.close())
+    runner.close()
+
+
+def _call_perplexity_async(client: Any, prompt: str) -> str:
+    response = client.runner.run(client.generate_response(prompt))
+    client.clear_conversation()
+    return response
+
+
+def _raw_perplexity_async(client: Any, prompt: str) -> Any:
+    return client.runner.run(client.client.chat.completions.create(
+        model=client.model,
+        messages=[{"role": "system", "content": client.system_instructions}, {"role": "user", "content": prompt}],
+        max_tokens=client.max_tokens, temperature=client.temperature))
+
+
+def _first_text_perplexity_async(client: Any, prompt: str) -> float:
+    async def first_text() -> float:
+        start = time.perf_counter()
+        async with contextlib.aclosing(client.stream_response(prompt)) as stream:
+            async for _ in stream:
+                return time.perf_counter() - start
+        return time.perf_counter() - start
+
+    elapsed = client.runner.run(first_text())
+    client.clear_conversation()
+    return elapsed
+
+
+# ANTHROPIC -----------------------------------------------------------------------------------
+def _build_anthropic(module: Any, server: MockServer) -> Any:
+    return module.FFAnthropic(api_key='mock')
+
+
+def _raw_anthropic(client: Any, prompt: str) -> Any:
+    from lib.AI.FFAnthropic import temperature_args
+    return client.client.messages.create(
+        model=client.model, max_tokens=client.max_tokens, **temperature_args(client.temperature),
+        system=client.system_instructions, messages=[{"role": "user", "content": prompt}])
+
+
+def _build_anthropic_cached(module: Any, server: MockServer) -> Any:
+    return module.FFAnthropicCached(api_key='mock')
+
+
+def _raw_anthropic_cached(client: Any, prompt: str) -> Any:
+    from lib.AI.FFAnthropic import temperature_args
+    return client.client.messages.create(
+        model=client.model, max_tokens=client.max_tokens, **temperature_args(client.temperature),
+        system=[{"type": "text", "text": client.system_instructions, "cache_control": {"type": "ephemeral"}}],
+        messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+        extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"})
+
+
+# GEMINI --------------------------------------------------------------------------------------
+def _build_gemini(module: Any, server: MockServer) -> Any:
+    client = module.FFGemini()
+    client.client = client.client.with_options(base_url=server.url + '/v1')
+    return client
+
+
+def _call_gemini(client: Any, prompt: str) -> str:
+    response = client.generate_response_sync(prompt)
+    client.clear_conversation()
+    return response
+
+
+def _raw_gemini(client: Any, prompt: str) -> Any:
+    return asyncio.run(client.client.chat.completions.create(
+        model=client.model,
+        messages=[{"role": "system", "content": client.system_instructions}, {"role": "user", "content": prompt}],
+        max_tokens=client.max_tokens, temperature=client.temperature))
+
+
+CLIENTS: List[ClientSpec] = [
+    ClientSpec('FFAzureOpenAI', 'lib.AI.FFAzureOpenAI', _build_azure, _call_and_forget, _raw_azure, shared=True),
+    ClientSpec('FFAI_AzureOpenAI', 'lib.AI.FFAI_AzureOpenAI', _build_ffai,
+               lambda ffai, prompt: ffai.generate_response(prompt), _raw_ffai, shared=True),
+    ClientSpec('FFOpenAIAssistant', 'lib.AI.FFOpenAIAssistant', _build_assistant, _call_assistant, _raw_assistant),
+    ClientSpec('FFPerplexity', 'lib.AI.FFPerplexity', _build_perplexity, _call_and_forget, _raw_perplexity),
+    ClientSpec('FFPerplexityAsync', 'lib.AI.FFPerplexityAsync', _build_perplexity_async, _call_perplexity_async,
+               _raw_perplexity_async, first_text=_first_text_perplexity_async),
+    ClientSpec('FFAnthropic', 'lib.AI.FFAnthropic', _build_anthropic, _call_and_forget, _raw_anthropic),
+    ClientSpec('FFAnthropicCached', 'lib.AI.FFAnthropicCached', _build_anthropic_cached, _call_and_forget,
+               _raw_anthropic_cached),
+    ClientSpec('FFGemini', 'lib.AI.FFGemini', _build_gemini, _call_gemini, _raw_gemini),
+]
+
+CLIENTS_BY_NAME: Dict[str, ClientSpec] = {spec.name: spec for spec in CLIENTS}
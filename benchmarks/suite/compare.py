@@ -0,0 +1,54 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Compare two result files from the suite and flag the metrics that got worse.
+"""
+
+from typing import Dict, Any, List, Tuple
+
+# changes smaller than this are noise whatever their relative size (e.g. 0.02 ms of overhead)
+NOISE_FLOOR = {'ms': 0.05, 'rps': 0.5, 'MB': 0.5, 'bytes': 64, 'ratio': 0.01}
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any],
+            threshold: float = 0.10) -> Tuple[List[Tuple[str, float, float, float, str]], List[str]]:
+    """
+    Returns (rows, regressions). Each row is (metric, baseline, current, relative change, verdict);
+    a metric regresses when it is worse by more than threshold and by more than its unit's noise
+    floor. Metrics in only one of the files are listed as 'new' or 'gone'.
+    """
+    rows = []
+    regressions = []
+    base_metrics = baseline.get('metrics', {})
+    current_metrics = current.get('metrics', {})
+
+    for name in sorted(set(base_metrics) | set(current_metrics)):
+        if name not in current_metrics:
+            rows.append((name, base_metrics[name]['value'], float('nan'), float('nan'), 'gone'))
+            continue
+        if name not in base_metrics:
+            rows.append((name, float('nan'), current_metrics[name]['value'], float('nan'), 'new'))
+            continue
+
+        metric = current_metrics[name]
+        before, after = base_metrics[name]['value'], metric['value']
+        change = (after - before) / abs(before) if before else (0.0 if after == before else float('inf'))
+        worse = (after - before) if metric.get('better', 'lower') == 'lower' else (before - after)
+
+        if worse > NOISE_FLOOR.get(metric.get('unit'), 0.0) and worse > threshold * abs(before):
+            verdict = 'REGRESSION'
+            regressions.append(name)
+        elif -worse > NOISE_FLOOR.get(metric.get('unit'), 0.0) and -worse > threshold * abs(before):
+            verdict = 'improved'
+        else:
+            verdict = ''
+        rows.append((name, before, after, change, verdict))
+    return rows, regressions
+
+
+def print_comparison(rows: List[Tuple[str, float, float, float, str]]) -> None:
+    width = max((len(row[0]) for row in rows), default=10)
+    print(f"{'metric':<{width}}  {'baseline':>12}  {'current':>12}  {'change':>8}")
+    for name, before, after, change, verdict in rows:
+        print(f"{name:<{width}}  {before:12.3f}  {after:12.3f}  {change:+8.1%}  {verdict}")
@@ -0,0 +1,389 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Local HTTP servers that answer like the provider APIs the FF* clients call, so the clients run
+end to end (SDK, HTTP, JSON) without keys or network:
+
+- OpenAI-style chat completions: /chat/completions under any prefix (OpenAI, Perplexity, the
+  Gemini OpenAI endpoint) and /openai/deployments/{model}/chat/completions (Azure OpenAI)
+- Anthropic messages: /v1/messages
+- OpenAI Assistants: assistants, threads, thread messages and runs
+
+Responses can stream (server-sent events). Latency, token rate and error injection are set
+per server with MockConfig.
+"""
+
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, List, Dict, Any, Tuple
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+from urllib.parse import parse_qs
+
+CHARS_PER_TOKEN = 4
+
+
+@dataclass
+class MockConfig:
+    """
+    How a mock server behaves.
+
+    A response of n completion tokens takes first_token_latency + n / tokens_per_second (a
+    streamed one sends its first token after first_token_latency). A share error_rate of
+    requests fail with error_status, telling the SDK to retry after retry_after seconds.
+    """
+    first_token_latency: float = 0.0
+    tokens_per_second: float = 0.0  # 0: no generation time
+    completion_tokens: int = 50
+    error_rate: float = 0.0
+    error_status: int = 500
+    retry_after: float = 0.001
+    seed: int = 0
+
+
+def _prompt_tokens(messages: List[Dict[str, Any]], system: Any = None) -> int:
+    """Characters / 4 of every text in the request"""
+    def text_of(content: Any) -> str:
+        if isinstance(content, str):
+            return content
+        if isinstance(content, list):
+            return ''.join(text_of(part.get('text', '')) for part in content if isinstance(part, dict))
+        return ''
+    chars = len(text_of(system)) + sum(len(text_of(message.get('content'))) for message in messages)
+    return chars // CHARS_PER_TOKEN + 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the SDK connection pools expect
+    disable_nagle_algorithm = True  # headers and body are separate writes; don't hold the body for an ACK
+    server: 'MockServer'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    # ==================================================================================
+    # PLUMBING
+    # ==================================================================================
+    def _body(self) -> Dict[str, Any]:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _send_json(self, payload: Dict[str, Any], status: int = 200, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_events(self) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _send_event(self, data: Dict[str, Any], event: Optional[str] = None) -> None:
+        text = (f"event: {event}\n" if event else '') + f"data: {json.dumps(data)}\n\n"
+        self._send_chunk(text.encode('utf-8'))
+
+    def _send_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_events(self, done: bool = False) -> None:
+        if done:
+            self._send_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _injected_error(self) -> bool:
+        """Answer with the configured error instead, for a share error_rate of requests"""
+        config = self.server.config
+        if not config.error_rate or self.server.roll() >= config.error_rate:
+            return False
+        self.server.count('errors')
+        retry_after = {'retry-after-ms': str(int(config.retry_after * 1000)), 'x-should-retry': 'true'}
+        self._send_json({'error': {'type': 'server_error', 'message': 'injected error'},
+                         'type': 'error'}, status=config.error_status, headers=retry_after)
+        return True
+
+    def _completion_text(self) -> Tuple[List[str], int]:
+        """The response words (one per token) and how many there are"""
+        count = self.server.config.completion_tokens
+        return [f"word{i % 100}" for i in range(count)], count
+
+    def _wait(self, seconds: float) -> None:
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def _token_delay(self) -> float:
+        rate = self.server.config.tokens_per_second
+        return 1.0 / rate if rate else 0.0
+
+    # ==================================================================================
+    # ROUTES
+    # ==================================================================================
+    def do_POST(self) -> None:
+        path = self.path.split('?', 1)[0]
+        self.server.count('requests')
+        body = self._body()
+        if self._injected_error():
+            return
+
+        if path.endswith('/chat/completions'):
+            self._chat_completion(body, path)
+        elif path.endswith('/messages') and '/threads/' not in path:
+            self._anthropic_message(body)
+        elif path.endswith('/assistants'):
+            self._send_json(self.server.assistants.create(body))
+        elif path.endswith('/threads'):
+            self._send_json(self.server.assistants.create_thread())
+        elif match := re.search(r'/threads/([^/]+)/messages$', path):
+            self._send_json(self.server.assistants.add_message(match.group(1), body))
+        elif match := re.search(r'/threads/([^/]+)/runs$', path):
+            self._wait(self.server.config.first_token_latency +
+                       self._token_delay() * self.server.config.completion_tokens)
+            self._send_json(self.server.assistants.run(match.group(1), body, ' '.join(self._completion_text()[0])))
+        else:
+            self._send_json({'error': {'message': f"no route for {path}"}}, status=404)
+
+    def do_GET(self) -> None:
+        path = self.path.split('?', 1)[0]
+        self.server.count('requests')
+        assistants = self.server.assistants
+        if path.endswith('/assistants'):
+            self._send_json(assistants.list())
+        elif match := re.search(r'/assistants/([^/]+)$', path):
+            self._send_json(assistants.get(match.group(1)))
+        elif match := re.search(r'/threads/([^/]+)/runs/([^/]+)$', path):
+            self._send_json(assistants.get_run(match.group(1), match.group(2)))
+        elif match := re.search(r'/threads/([^/]+)/messages$', path):
+            query = parse_qs(self.path.partition('?')[2])
+            self._send_json(assistants.list_messages(match.group(1), int(query.get('limit', ['20'])[0])))
+        else:
+            self._send_json({'error': {'message': f"no route for {path}"}}, status=404)
+
+    # CHAT COMPLETIONS (OpenAI, Azure OpenAI, Perplexity, Gemini) ------------------------
+    def _chat_completion(self, body: Dict[str, Any], path: str) -> None:
+        model = body.get('model') or (re.search(r'/deployments/([^/]+)/', path) or [None, 'mock'])[1]
+        words, completion_tokens = self._completion_text()
+        prompt_tokens = _prompt_tokens(body.get('messages', []))
+        completion_id = f"chatcmpl-{self.server.next_id()}"
+        created = int(time.time())
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                 'total_tokens': prompt_tokens + completion_tokens,
+                 'prompt_tokens_details': {'cached_tokens': 0}}
+        config = self.server.config
+
+        if not body.get('stream'):
+            self._wait(config.first_token_latency + self._token_delay() * completion_tokens)
+            self._send_json({
+                'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': ' '.join(words)}}],
+                'usage': usage,
+                'citations': self.server.citations,
+            })
+            return
+
+        self._start_events()
+        self._wait(config.first_token_latency)
+        chunk = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                 'citations': self.server.citations}
+        for i, word in enumerate(words):
+            if i:
+                self._wait(self._token_delay())
+            content = word if i == 0 else ' ' + word
+            self._send_event({**chunk, 'choices': [{'index': 0, 'delta': {'content': content}, 'finish_reason': None}]})
+        self._send_event({**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}], 'usage': usage})
+        self._end_events(done=True)
+
+    # ANTHROPIC MESSAGES -------------------------------------------------------------------
+    def _anthropic_message(self, body: Dict[str, Any]) -> None:
+        words, completion_tokens = self._completion_text()
+        prompt_tokens = _prompt_tokens(body.get('messages', []), body.get('system'))
+        cached = isinstance(body.get('system'), list) and any('cache_control' in block for block in body['system'])
+        usage = {'input_tokens': prompt_tokens, 'output_tokens': completion_tokens,
+                 'cache_read_input_tokens': 0, 'cache_creation_input_tokens': 0}
+        if cached:
+            # the system prompt is read from the cache after the first request
+            system_tokens = _prompt_tokens([], body['system'])
+            key = 'cache_read_input_tokens' if self.server.count('cached_system') > 1 else 'cache_creation_input_tokens'
+            usage[key] = system_tokens
+            usage['input_tokens'] = max(prompt_tokens - system_tokens, 0)
+        message_id = f"msg_{self.server.next_id()}"
+        config = self.server.config
+
+        tool = None
+        if body.get('tool_choice', {}).get('type') == 'tool':
+            tool = body['tool_choice']['name']
+
+        message = {'id': message_id, 'type': 'message', 'role': 'assistant', 'model': body.get('model'),
+                   'stop_reason': 'tool_use' if tool else 'end_turn', 'stop_sequence': None, 'usage': usage}
+        if not body.get('stream'):
+            self._wait(config.first_token_latency + self._token_delay() * completion_tokens)
+            if tool:
+                message['content'] = [{'type': 'tool_use', 'id': f"toolu_{message_id}", 'name': tool, 'input': {}}]
+            else:
+                message['content'] = [{'type': 'text', 'text': ' '.join(words)}]
+            self._send_json(message)
+            return
+
+        self._start_events()
+        self._wait(config.first_token_latency)
+        self._send_event({'type': 'message_start', 'message': {**message, 'content': [], 'stop_reason': None,
+                                                               'usage': {**usage, 'output_tokens': 0}}},
+                         'message_start')
+        self._send_event({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}},
+                         'content_block_start')
+        for i, word in enumerate(words):
+            if i:
+                self._wait(self._token_delay())
+            self._send_event({'type': 'content_block_delta', 'index': 0,
+                              'delta': {'type': 'text_delta', 'text': word if i == 0 else ' ' + word}},
+                             'content_block_delta')
+        self._send_event({'type': 'content_block_stop', 'index': 0}, 'content_block_stop')
+        self._send_event({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                          'usage': {'output_tokens': completion_tokens}}, 'message_delta')
+        self._send_event({'type': 'message_stop'}, 'message_stop')
+        self._end_events()
+
+
+class _Assistants:
+    """In-memory assistants, threads and runs; runs complete when created"""
+
+    def __init__(self, server: 'MockServer'):
+        self.server = server
+        self._lock = threading.Lock()
+        self.assistants: Dict[str, Dict[str, Any]] = {}
+        self.threads: Dict[str, List[Dict[str, Any]]] = {}
+        self.runs: Dict[str, Dict[str, Any]] = {}
+
+    def create(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        assistant = {'id': f"asst_{self.server.next_id()}", 'object': 'assistant', 'created_at': int(time.time()),
+                     'name': body.get('name'), 'model': body.get('model'), 'instructions': body.get('instructions'),
+                     'tools': [], 'metadata': {}, 'description': None}
+        with self._lock:
+            self.assistants[assistant['id']] = assistant
+        return assistant
+
+    def get(self, assistant_id: str) -> Dict[str, Any]:
+        return self.assistants[assistant_id]
+
+    def list(self) -> Dict[str, Any]:
+        with self._lock:
+            data = list(reversed(self.assistants.values()))
+        return {'object': 'list', 'data': data, 'first_id': None, 'last_id': None, 'has_more': False}
+
+    def create_thread(self) -> Dict[str, Any]:
+        thread_id = f"thread_{self.server.next_id()}"
+        with self._lock:
+            self.threads[thread_id] = []
+        return {'id': thread_id, 'object': 'thread', 'created_at': int(time.time()), 'metadata': {}}
+
+    def _message(self, thread_id: str, role: str, text: str) -> Dict[str, Any]:
+        return {'id': f"msg_{self.server.next_id()}", 'object': 'thread.message', 'created_at': int(time.time()),
+                'thread_id': thread_id, 'role': role, 'status': 'completed', 'metadata': {}, 'attachments': [],
+                'content': [{'type': 'text', 'text': {'value': text, 'annotations': []}}]}
+
+    def add_message(self, thread_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        message = self._message(thread_id, body.get('role', 'user'), body.get('content', ''))
+        with self._lock:
+            self.threads[thread_id].append(message)
+        return message
+
+    def run(self, thread_id: str, body: Dict[str, Any], text: str) -> Dict[str, Any]:
+        with self._lock:
+            messages = self.threads[thread_id]
+            prompt_tokens = _prompt_tokens([{'content': m['content'][0]['text']['value']} for m in messages])
+            messages.append(self._message(thread_id, 'assistant', text))
+        completion_tokens = self.server.config.completion_tokens
+        run = {'id': f"run_{self.server.next_id()}", 'object': 'thread.run', 'created_at': int(time.time()),
+               'thread_id': thread_id, 'assistant_id': body.get('assistant_id'), 'status': 'completed',
+               'model': 'mock', 'instructions': '', 'tools': [], 'metadata': {}, 'parallel_tool_calls': True,
+               'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                         'total_tokens': prompt_tokens + completion_tokens}}
+        with self._lock:
+            self.runs[run['id']] = run
+        return run
+
+    def get_run(self, thread_id: str, run_id: str) -> Dict[str, Any]:
+        return self.runs[run_id]
+
+    def list_messages(self, thread_id: str, limit: int = 20) -> Dict[str, Any]:
+        """Newest first, one page of limit messages, like the API's default listing"""
+        with self._lock:
+            messages = self.threads[thread_id]
+            data = messages[:-limit - 1:-1]
+            has_more = len(messages) > limit
+        return {'object': 'list', 'data': data, 'first_id': None, 'last_id': None, 'has_more': has_more}
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    A mock provider API on a free local port, served from a background thread:
+
+        with MockServer(MockConfig(first_token_latency=0.05)) as server:
+            client = OpenAI(api_key='mock', base_url=server.url + '/v1')
+    """
+    daemon_threads = True
+
+    def __init__(self, config: Optional[MockConfig] = None, citations: Optional[List[str]] = None):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.config = config or MockConfig()
+        # sources online (Perplexity) models return with their answers
+        self.citations = citations if citations is not None else ['https://example.com/a', 'https://example.com/b']
+        self.assistants = _Assistants(self)
+        self._ids = itertools.count(1)
+        self._counts: Dict[str, int] = {}
+        self._counts_lock = threading.Lock()
+        self._random = random.Random(self.config.seed)
+        self._thread: Optional[threading.Thread] = None
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # a client that stops reading a stream early hangs up mid-response
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def count(self, name: str) -> int:
+        with self._counts_lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+            return self._counts[name]
+
+    def counts(self) -> Dict[str, int]:
+        with self._counts_lock:
+            return dict(self._counts)
+
+    def roll(self) -> float:
+        with self._counts_lock:
+            return self._random.random()
+
+    def start(self) -> 'MockServer':
+        self._thread = threading.Thread(target=self.serve_forever, name='mock_server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> 'MockServer':
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
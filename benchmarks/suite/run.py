@@ -0,0 +1,200 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Runs the suite's measurements against the mock servers and writes them as JSON:
+
+    {"meta": {...}, "metrics": {"<client>/<metric>": {"value": x, "unit": "ms", "better": "lower"}},
+     "errors": {"<client>": "why it was not measured"}}
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from statistics import median
+from typing import Dict, Any, List, Optional
+import gc
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from benchmarks.suite.clients import ClientSpec, CLIENTS_BY_NAME, point_sdks_at
+from benchmarks.suite.mock_servers import MockServer, MockConfig
+
+# the server behaviour for each kind of measurement
+OVERHEAD_SERVER = MockConfig(completion_tokens=50)
+THROUGHPUT_SERVER = MockConfig(first_token_latency=0.05, completion_tokens=50)
+TTFT_SERVER = MockConfig(first_token_latency=0.2, tokens_per_second=500, completion_tokens=100)
+ERROR_SERVER = MockConfig(completion_tokens=50, error_rate=0.1, error_status=500)
+
+PROMPT = "Summarize the main risks of the migration plan in three sentences."
+
+
+class Results:
+    def __init__(self, settings: Dict[str, Any]):
+        self.metrics: Dict[str, Dict[str, Any]] = {}
+        self.errors: Dict[str, str] = {}
+        self.settings = settings
+
+    def add(self, client: str, name: str, value: float, unit: str, better: str = 'lower') -> None:
+        self.metrics[f"{client}/{name}"] = {'value': round(value, 4), 'unit': unit, 'better': better}
+        print(f"  {client + '/' + name:<52} {value:12.3f} {unit}", flush=True)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'meta': _meta(self.settings), 'metrics': self.metrics, 'errors': self.errors}
+
+
+def _meta(settings: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'created': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'platform': platform.platform(), 'settings': settings}
+
+
+# ======================================================================================
+# MEASUREMENTS
+# ======================================================================================
+def measure_overhead(spec: ClientSpec, module: Any, results: Results, calls: int) -> None:
+    """Median time of a client call, of the same request through the bare SDK, and their difference"""
+    with MockServer(OVERHEAD_SERVER) as server:
+        point_sdks_at(server)
+        client = spec.build(module, server)
+        for _ in range(min(calls, 20)):
+            spec.call(client, PROMPT)
+            spec.raw_call(client, PROMPT)
+
+        # alternate the two, so drift in the machine's speed affects both alike
+        client_times, raw_times = [], []
+        for _ in range(calls):
+            start = time.perf_counter()
+            spec.call(client, PROMPT)
+            middle = time.perf_counter()
+            spec.raw_call(client, PROMPT)
+            client_times.append(middle - start)
+            raw_times.append(time.perf_counter() - middle)
+
+    results.add(spec.name, 'call_ms', median(client_times) * 1000, 'ms')
+    results.add(spec.name, 'sdk_call_ms', median(raw_times) * 1000, 'ms')
+    results.add(spec.name, 'overhead_ms', median(c - r for c, r in zip(client_times, raw_times)) * 1000, 'ms')
+
+
+def measure_throughput(spec: ClientSpec, module: Any, results: Results, levels: List[int],
+                       calls_per_worker: int) -> None:
+    """Calls per second with that many threads, against a server with 50 ms latency"""
+    with MockServer(THROUGHPUT_SERVER) as server:
+        point_sdks_at(server)
+        for level in levels:
+            if spec.shared:
+                clients = [spec.build(module, server)] * level
+            else:
+                clients = [spec.build(module, server) for _ in range(level)]
+
+            def work(client: Any) -> None:
+                for _ in range(calls_per_worker):
+                    spec.call(client, PROMPT)
+
+            with ThreadPoolExecutor(max_workers=level) as executor:
+                start = time.perf_counter()
+                for future in [executor.submit(work, client) for client in clients]:
+                    future.result()
+                elapsed = time.perf_counter() - start
+            results.add(spec.name, f'throughput_rps@{level}', level * calls_per_worker / elapsed, 'rps', 'higher')
+
+
+def measure_ttft(spec: ClientSpec, module: Any, results: Results, calls: int) -> None:
+    """
+    Time until the caller has the first text, with a 200 ms first token and 500 tokens/s; a
+    client that does not stream gives its caller nothing until the whole response is in
+    """
+    with MockServer(TTFT_SERVER) as server:
+        point_sdks_at(server)
+        client = spec.build(module, server)
+        times = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            if spec.first_text is not None:
+                times.append(spec.first_text(client, PROMPT))
+            else:
+                spec.call(client, PROMPT)
+                times.append(time.perf_counter() - start)
+    results.add(spec.name, 'ttft_ms', median(times) * 1000, 'ms')
+
+
+def measure_errors(spec: ClientSpec, module: Any, results: Results, calls: int) -> None:
+    """Share of calls that succeed when 10% of requests fail with a 500 (the SDKs retry them)"""
+    with MockServer(ERROR_SERVER) as server:
+        point_sdks_at(server)
+        client = spec.build(module, server)
+        succeeded = 0
+        for _ in range(calls):
+            try:
+                spec.call(client, PROMPT)
+                succeeded += 1
+            except Exception:
+                pass
+    results.add(spec.name, 'success_rate@10%_errors', succeeded / calls, 'ratio', 'higher')
+
+
+def measure_memory(results: Results, turns: int) -> None:
+    """Memory FFAI_AzureOpenAI (stateless, over FFAzureOpenAI) keeps per turn over many turns"""
+    spec = CLIENTS_BY_NAME['FFAI_AzureOpenAI']
+    module = spec.load()
+    with MockServer(OVERHEAD_SERVER) as server:
+        point_sdks_at(server)
+        ffai = spec.build(module, server)
+        for i in range(100):
+            ffai.generate_response(f"{PROMPT} ({i})", prompt_name=f"warmup{i}")
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for i in range(turns):
+                # distinct prompts and names, as in a long-running workflow
+                ffai.generate_response(f"{PROMPT} ({i})", prompt_name=f"turn{i}", history=[f"turn{i - 1}"] if i else None)
+            gc.collect()
+            after = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    results.add('FFAI_AzureOpenAI', 'retained_mb', (after - before) / 1_000_000, 'MB')
+    results.add('FFAI_AzureOpenAI', 'retained_bytes_per_turn', (after - before) / turns, 'bytes')
+
+
+def run_suite(clients: List[str], turns: int, calls: int, levels: List[int], calls_per_worker: int) -> Results:
+    results = Results({'clients': clients, 'turns': turns, 'calls': calls, 'levels': levels,
+                       'calls_per_worker': calls_per_worker})
+    for name in clients:
+        spec = CLIENTS_BY_NAME[name]
+        print(f"\n{name}", flush=True)
+        try:
+            module = spec.load()
+        except ImportError as e:
+            results.errors[name] = f"skipped: {e}"
+            print(f"  skipped: {e}")
+            continue
+        try:
+            measure_overhead(spec, module, results, calls)
+            measure_throughput(spec, module, results, levels, calls_per_worker)
+            measure_ttft(spec, module, results, max(calls // 20, 5))
+            measure_errors(spec, module, results, calls)
+        except Exception as e:
+            results.errors[name] = f"failed: {e}"
+            print(f"  failed: {e}")
+
+    if turns and 'FFAI_AzureOpenAI' in clients and 'FFAI_AzureOpenAI' not in results.errors:
+        print(f"\nFFAI_AzureOpenAI over {turns} turns", flush=True)
+        measure_memory(results, turns)
+    return results
+
+
+def write_results(results: Results, path: Optional[str]) -> None:
+    if not path:
+        return
+    with open(path, 'w') as f:
+        json.dump(results.to_dict(), f, indent=1)
+    print(f"\nResults written to {path}")
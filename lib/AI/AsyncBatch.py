@@ -0,0 +1,87 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from typing import Optional, Dict, Any, AsyncIterator, Callable, Awaitable
+import asyncio
+import logging
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def batch_error_type(error: Exception) -> str:
+    """
+    The API error type ('rate_limit_error', 'overloaded_error', ...) of a failed request.
+    Anthropic errors carry the whole error body, OpenAI-style ones its 'error' object.
+    """
+    body = getattr(error, 'body', None)
+    if isinstance(body, dict):
+        if isinstance(body.get('error'), dict):
+            body = body['error']
+        if isinstance(body.get('type'), str):
+            return body['type']
+    return type(error).__name__
+
+
+async def batch_request(custom_id: str, send: Callable[[], Awaitable[Any]],
+                        read_text: Callable[[Any], Optional[str]],
+                        read_usage: Callable[[Any, float], Dict[str, Any]],
+                        read_fields: Optional[Callable[[Optional[Any]], Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    Make one request of a generate_batch with send() and return its result: 'custom_id',
+    'status' ('succeeded' or 'errored'), 'response', 'error' and 'usage', plus the fields
+    read_fields(response) adds (called with None for a failed request).
+
+    A failed request gets its API error type, and an answer read_text() finds no text in gets
+    'empty_response'; either way only that prompt fails, not the batch.
+    """
+    start_time = time.perf_counter()
+    try:
+        response = await send()
+        text = read_text(response)
+        usage = read_usage(response, time.perf_counter() - start_time)
+        fields = read_fields(response) if read_fields else {}
+    except Exception as e:
+        logger.warning("Batch request %s failed: %s", custom_id, e)
+        return {'custom_id': custom_id, 'status': 'errored', 'response': None,
+                'error': batch_error_type(e), 'usage': None, **(read_fields(None) if read_fields else {})}
+    if text is None:
+        # e.g. stopped at max_tokens before any text
+        logger.warning("Batch request %s returned no text", custom_id)
+        return {'custom_id': custom_id, 'status': 'errored', 'response': None,
+                'error': 'empty_response', 'usage': usage, **fields}
+    return {'custom_id': custom_id, 'status': 'succeeded', 'response': text, 'error': None, 'usage': usage, **fields}
+
+
+async def run_bounded(requests: Dict[str, Any], send: Callable[[str, Any], Awaitable[Dict[str, Any]]],
+                      max_concurrency: int) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Run send(custom_id, prompt) for each request, at most max_concurrency at a time, and
+    yield the results as they finish. Requests are started as earlier ones finish, so no
+    more than max_concurrency tasks exist at once however many prompts there are.
+    """
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency must be at least 1")
+    waiting = iter(requests.items())
+    running = set()
+
+    def start_next() -> None:
+        for custom_id, prompt in waiting:
+            running.add(asyncio.ensure_future(send(custom_id, prompt)))
+            return
+
+    for _ in range(max_concurrency):
+        start_next()
+    try:
+        while running:
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                start_next()
+                yield task.result()
+    finally:
+        # the caller stopped iterating, or was cancelled
+        if running:
+            logger.debug("Cancelling %d unfinished batch requests", len(running))
+        for task in running:
+            task.cancel()
@@ -0,0 +1,418 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from typing import Optional, List, Dict, Any, Iterator
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+import csv
+import heapq
+import json
+import logging
+import os
+import time
+
+from .BlobStore import content_key
+from .Diagnostics import Preview
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# 'key' and 'status' come last, so a record cut short by a crash never reads as complete
+OUTPUT_COLUMNS = ('row', 'prompt_name', 'model', 'response', 'error',
+                  'prompt_tokens', 'completion_tokens', 'elapsed', 'key', 'status')
+RECORD_STATUSES = ('ok', 'error', 'skipped')
+
+
+@dataclass
+class BatchRow:
+    index: int  # position in the input file, starting at 0
+    prompt: str
+    prompt_name: Optional[str] = None
+    history: Optional[List[str]] = None
+    model: Optional[str] = None
+    key: str = field(init=False)  # identifies the row's content, for resuming
+
+    def __post_init__(self):
+        self.key = content_key(json.dumps([self.prompt_name, self.prompt, self.history, self.model])).hex()
+
+
+# ==========================================================================================
+# INPUT
+# ==========================================================================================
+def _parse_history(value: Any) -> Optional[List[str]]:
+    """A history cell: a JSON list of prompt names, or names separated by commas"""
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        names = [str(name).strip() for name in value]
+    else:
+        value = str(value).strip()
+        if value.startswith('['):
+            names = [str(name).strip() for name in json.loads(value)]
+        else:
+            names = [name.strip() for name in value.split(',')]
+    names = [name for name in names if name]
+    return names or None
+
+
+def _cell(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _read_csv(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        yield from csv.DictReader(f)
+
+
+def _read_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}, line {line_number}: invalid JSON ({e})") from e
+
+
+def _read_xlsx(path: str) -> Iterator[Dict[str, Any]]:
+    try:
+        from openpyxl import load_workbook
+    except ImportError as e:
+        logger.error("openpyxl is not installed")
+        raise ImportError("Reading .xlsx files requires the 'openpyxl' package") from e
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(name).strip() if name is not None else '' for name in next(rows, ())]
+        for values in rows:
+            if any(value is not None for value in values):
+                yield dict(zip(header, values))
+    finally:
+        workbook.close()
+
+
+_READERS = {'.csv': _read_csv, '.jsonl': _read_jsonl, '.xlsx': _read_xlsx}
+
+
+def read_rows(path: str) -> List[BatchRow]:
+    """Read a CSV, XLSX or JSONL file with prompt_name, prompt, history and model columns"""
+    extension = os.path.splitext(path)[1].lower()
+    reader = _READERS.get(extension)
+    if reader is None:
+        raise ValueError(f"Unsupported input file type {extension!r}; use one of {sorted(_READERS)}")
+
+    rows = []
+    for index, record in enumerate(reader(path)):
+        prompt = _cell(record.get('prompt'))
+        if prompt is None:
+            raise ValueError(f"{path}: row {index + 1} has no prompt")
+        rows.append(BatchRow(index=index,
+                             prompt=prompt,
+                             prompt_name=_cell(record.get('prompt_name')),
+                             history=_parse_history(record.get('history')),
+                             model=_cell(record.get('model'))))
+    logger.info("Read %d rows from %s", len(rows), path)
+    return rows
+
+
+# ==========================================================================================
+# OUTPUT / CHECKPOINT
+# ==========================================================================================
+class ResultWriter:
+    """
+    Appends one record per finished row to a JSONL or CSV file, synced to disk as it goes.
+
+    The file doubles as the checkpoint: completed() reads it back, keeping the rows whose
+    last record has status 'ok' and whose key still matches the input.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in ('.jsonl', '.csv'):
+            raise ValueError(f"Unsupported output file type {extension!r}; use '.jsonl' or '.csv'")
+        self.is_csv = extension == '.csv'
+        self._file = None
+        self._csv_writer = None
+
+    def _read_records(self) -> List[Dict[str, Any]]:
+        """Records in the file; a truncated last record (from a crash) is dropped"""
+        records = []
+        with open(self.path, newline='', encoding='utf-8') as f:
+            if self.is_csv:
+                for record in csv.DictReader(f):
+                    if record.get('status') in RECORD_STATUSES and record.get('key'):
+                        records.append(record)
+            else:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning("Ignoring an incomplete record in %s", self.path)
+        return records
+
+    def completed(self, rows: List[BatchRow]) -> Dict[int, Dict[str, Any]]:
+        """row index -> the 'ok' record of every row already done with its current content"""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return {}
+
+        records = self._read_records()
+        latest = {}
+        for record in records:
+            try:
+                latest[int(record['row'])] = record
+            except (KeyError, TypeError, ValueError):
+                continue
+
+        done = {}
+        for row in rows:
+            record = latest.get(row.index)
+            if record and record.get('status') == 'ok' and record.get('key') == row.key:
+                done[row.index] = record
+
+        # rewrite the file without a partial record, so new records start on a clean line
+        self._rewrite(records)
+        return done
+
+    def _rewrite(self, records: List[Dict[str, Any]]) -> None:
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', newline='', encoding='utf-8') as f:
+            if self.is_csv:
+                writer = csv.DictWriter(f, fieldnames=OUTPUT_COLUMNS, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(records)
+            else:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        os.replace(temp_path, self.path)
+
+    def open(self) -> None:
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, 'a', newline='', encoding='utf-8')
+        if self.is_csv:
+            self._csv_writer = csv.DictWriter(self._file, fieldnames=OUTPUT_COLUMNS, extrasaction='ignore')
+            if new_file:
+                self._csv_writer.writeheader()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        if self.is_csv:
+            self._csv_writer.writerow(record)
+        else:
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# ==========================================================================================
+# RUNNER
+# ==========================================================================================
+class BatchRunner:
+    """
+    Runs the rows of a prompt file through an FFAI_AzureOpenAI wrapper.
+
+    Rows run concurrently, except that a row waits for the earlier rows its history refers
+    to. A history name that is no earlier row's prompt_name (e.g. an attribute of an
+    earlier JSON response) makes the row wait for all earlier rows. Each row gets a fresh
+    conversation on the client, so rows only see each other through their history.
+
+    Results are appended to the output file as rows finish. Rerunning with the same output
+    file skips the rows already answered and reloads their responses into the wrapper's
+    histories, so their dependents still see them without calling the model again.
+
+        runner = BatchRunner(FFAI_AzureOpenAI(FFAzureOpenAI()), concurrency=8)
+        summary = runner.run(read_rows("prompts.csv"), "results.jsonl")
+    """
+
+    def __init__(self, ffai: Any, concurrency: int = 4):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.ffai = ffai
+        self.concurrency = concurrency
+
+    # ======================================================================================
+    # DEPENDENCIES
+    # ======================================================================================
+    @staticmethod
+    def _dependencies(rows: List[BatchRow]) -> List[tuple]:
+        """
+        (positions of the earlier rows a row's history names, whether it also waits for all
+        earlier rows) for each row, by position in rows
+        """
+        latest_by_name = {}
+        dependencies = []
+        for position, row in enumerate(rows):
+            waits_for = set()
+            waits_for_all = False
+            for name in row.history or ():
+                if name in latest_by_name:
+                    waits_for.add(latest_by_name[name])
+                else:
+                    waits_for_all = True
+            dependencies.append((waits_for, waits_for_all))
+            if row.prompt_name is not None:
+                latest_by_name[row.prompt_name] = position
+        return dependencies
+
+    # ======================================================================================
+    # EXECUTION
+    # ======================================================================================
+    def _call(self, row: BatchRow) -> tuple:
+        """(response, usage) of the row, in a fresh conversation"""
+        with self.ffai.new_conversation():
+            response = self.ffai.generate_response(row.prompt, model=row.model, prompt_name=row.prompt_name,
+                                                   history=row.history)
+            # last_usage is per thread (or of this call's copy of the client)
+            return response, getattr(self.ffai.client, 'last_usage', None)
+
+    def _run_row(self, row: BatchRow) -> Dict[str, Any]:
+        record = {'row': row.index, 'prompt_name': row.prompt_name, 'model': row.model}
+        start = time.perf_counter()
+        try:
+            record['response'], usage = self._call(row)
+            if usage:
+                record['prompt_tokens'] = usage.get('prompt_tokens')
+                record['completion_tokens'] = usage.get('completion_tokens')
+            status = 'ok'
+        except Exception as e:
+            logger.error("Row %d (%s) failed: %s", row.index, Preview(row.prompt_name), e)
+            record['error'] = f"{type(e).__name__}: {e}"
+            status = 'error'
+        record['elapsed'] = round(time.perf_counter() - start, 3)
+        record['key'] = row.key
+        record['status'] = status
+        return record
+
+    def _restore(self, row: BatchRow, record: Dict[str, Any]) -> None:
+        """Put a checkpointed response back into the wrapper's histories"""
+        usage = None
+        if record.get('prompt_tokens') not in (None, ''):
+            usage = {'prompt_tokens': int(record['prompt_tokens']),
+                     'completion_tokens': int(record.get('completion_tokens') or 0)}
+        self.ffai._record_interaction(row.prompt, record.get('response') or '',
+                                      row.model or self.ffai.client.model,
+                                      row.prompt_name, row.history, usage)
+
+    def run(self, rows: List[BatchRow], output_path: str) -> Dict[str, int]:
+        """
+        Run the rows, appending a record per finished row to output_path (.jsonl or .csv).
+
+        Ctrl-C stops starting new rows and waits for the ones in flight, whose responses are
+        already paid for; a second Ctrl-C stops immediately.
+
+        Returns:
+            Counts of rows: 'resumed' (answered by an earlier run), 'ok', 'error', 'skipped'
+            (a row in their history failed) and 'not_run' (interrupted)
+        """
+        writer = ResultWriter(output_path)
+        done = writer.completed(rows)
+        for row in rows:
+            if row.index in done:
+                self._restore(row, done[row.index])
+        if done:
+            logger.info("Resuming: %d of %d rows already answered in %s", len(done), len(rows), output_path)
+
+        summary = {'resumed': len(done), 'ok': 0, 'error': 0, 'skipped': 0, 'not_run': 0}
+
+        # scheduling state, by position in rows
+        dependencies = self._dependencies(rows)
+        resolved = [row.index in done for row in rows]  # answered, failed or skipped
+        remaining = [0] * len(rows)  # unresolved rows named in each row's history
+        dependents = [[] for _ in rows]
+        waiting_for_all = deque()  # rows that also wait for every earlier row, in order
+        ready = []  # heap of positions, so rows start in file order
+        first_unresolved = 0
+
+        for position, (waits_for, waits_for_all) in enumerate(dependencies):
+            if resolved[position]:
+                continue
+            for dependency in waits_for:
+                if not resolved[dependency]:
+                    remaining[position] += 1
+                    dependents[dependency].append(position)
+            if waits_for_all:
+                waiting_for_all.append(position)
+            elif not remaining[position]:
+                ready.append(position)
+
+        def release_in_order() -> None:
+            """Release the rows waiting for all earlier rows, once those are resolved"""
+            nonlocal first_unresolved
+            while first_unresolved < len(rows) and resolved[first_unresolved]:
+                first_unresolved += 1
+            while waiting_for_all and waiting_for_all[0] <= first_unresolved:
+                position = waiting_for_all.popleft()
+                if not resolved[position] and not remaining[position]:
+                    heapq.heappush(ready, position)
+
+        def resolve(position: int, ok: bool) -> None:
+            resolved[position] = True
+            # a failed row skips the rows that name it in their history, transitively
+            failures = [] if ok else [position]
+            while failures:
+                for dependent in dependents[failures.pop()]:
+                    if resolved[dependent]:
+                        continue
+                    resolved[dependent] = True
+                    summary['skipped'] += 1
+                    row = rows[dependent]
+                    writer.write({'row': row.index, 'prompt_name': row.prompt_name, 'model': row.model,
+                                  'error': 'a row in its history failed', 'key': row.key, 'status': 'skipped'})
+                    failures.append(dependent)
+
+            release_in_order()
+            if not ok:
+                return
+            for dependent in dependents[position]:
+                remaining[dependent] -= 1
+                if remaining[dependent] or resolved[dependent]:
+                    continue
+                if not dependencies[dependent][1] or dependent <= first_unresolved:
+                    heapq.heappush(ready, dependent)
+
+        heapq.heapify(ready)
+        release_in_order()
+
+        writer.open()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ffai_batch')
+        in_flight = {}
+        stopping = False
+        try:
+            while True:
+                try:
+                    while ready and not stopping and len(in_flight) < self.concurrency:
+                        position = heapq.heappop(ready)
+                        in_flight[executor.submit(self._run_row, rows[position])] = position
+                    if not in_flight:
+                        break
+
+                    completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        position = in_flight.pop(future)
+                        record = future.result()
+                        writer.write(record)
+                        summary[record['status']] += 1
+                        logger.info("Row %d (%s): %s", record['row'], Preview(record['prompt_name']), record['status'])
+                        resolve(position, record['status'] == 'ok')
+                except KeyboardInterrupt:
+                    if stopping:
+                        raise
+                    stopping = True
+                    logger.warning("Interrupted: waiting for %d rows in flight (Ctrl-C again to abort)", len(in_flight))
+        finally:
+            executor.shutdown(wait=not in_flight, cancel_futures=True)
+            writer.close()
+
+        summary['not_run'] = resolved.count(False)
+        logger.info("Batch finished: %s", summary)
+        return summary
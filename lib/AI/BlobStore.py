@@ -0,0 +1,91 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from typing import Optional, Dict, Any
+import hashlib
+import logging
+import threading
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# texts shorter than this are not worth hashing; they are stored as-is
+BLOB_MIN_CHARS = 256
+
+
+def content_key(text: str) -> bytes:
+    """Content fingerprint of a text (sha1 is hardware accelerated here; it is not used for security)"""
+    return hashlib.sha1(text.encode('utf-8', 'surrogatepass'), usedforsecurity=False).digest()
+
+
+class BlobStore:
+    """
+    Content-addressed text store (hash -> text).
+
+    intern() returns the store's canonical copy of a text, so every history that records
+    the same prompt, RAG context or response holds a reference to one string instead of
+    its own copy.
+    """
+
+    def __init__(self, min_chars: int = BLOB_MIN_CHARS):
+        self.min_chars = min_chars
+        self._blobs: Dict[bytes, str] = {}
+        self._lock = threading.Lock()
+        self._stored_chars = 0
+        self._referenced_chars = 0
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # locks cannot be copied or pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def put(self, text: str) -> bytes:
+        """Store a text and return its key"""
+        key = content_key(text)
+        with self._lock:
+            self._referenced_chars += len(text)
+            if key not in self._blobs:
+                self._blobs[key] = text
+                self._stored_chars += len(text)
+        return key
+
+    def get(self, key: bytes) -> Optional[str]:
+        return self._blobs.get(key)
+
+    def intern(self, text: Any) -> Any:
+        """Return the canonical copy of text; short texts and non-strings are returned unchanged"""
+        if not isinstance(text, str) or len(text) < self.min_chars:
+            return text
+
+        key = content_key(text)
+        with self._lock:
+            self._referenced_chars += len(text)
+            canonical = self._blobs.get(key)
+            if canonical is None:
+                canonical = self._blobs[key] = text
+                self._stored_chars += len(text)
+        return canonical
+
+    def stats(self) -> Dict[str, Any]:
+        """Blob count and how many characters were stored versus referenced"""
+        with self._lock:
+            return {
+                'blobs': len(self._blobs),
+                'stored_chars': self._stored_chars,
+                'referenced_chars': self._referenced_chars,
+                'saved_chars': self._referenced_chars - self._stored_chars
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._blobs.clear()
+            self._stored_chars = 0
+            self._referenced_chars = 0
+
+    def __len__(self) -> int:
+        return len(self._blobs)
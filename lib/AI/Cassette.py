@@ -0,0 +1,437 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from collections import defaultdict
+from typing import Optional, Dict, List, Any, Iterator, AsyncIterator, Tuple
+import asyncio
+import atexit
+import base64
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+try:
+    import httpx
+except ImportError:
+    # newer openai and anthropic releases depend on httpx2, the same API under a new name
+    import httpx2 as httpx
+
+from .BlobStore import content_key
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+CASSETTE_MODES = ('record', 'replay', 'auto')
+
+_KEY_PREFIX = '{"k":"'
+
+# response headers worth keeping: the SDKs read them to parse the body and to pace retries
+KEPT_HEADERS = ('content-type', 'retry-after', 'retry-after-ms', 'x-should-retry')
+
+# the connection pool the SDKs configure by default
+DEFAULT_LIMITS = httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+
+
+def request_key(method: str, path: str, query: str, body: bytes) -> str:
+    """
+    Hash identifying a request: method, path, query and body, with JSON bodies in canonical
+    key order. The host and headers (keys, SDK versions, retry counts) are left out, so a
+    cassette recorded against one endpoint replays against any other.
+    """
+    try:
+        canonical = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    except ValueError:
+        canonical = body.decode('utf-8', 'surrogateescape')
+    return content_key(f"{method} {path}?{query}\n{canonical}").hex()
+
+
+def _key_of(request: 'httpx.Request') -> str:
+    url = request.url
+    query = '&'.join(sorted(url.query.decode('ascii', 'replace').split('&'))) if url.query else ''
+    return request_key(request.method, url.path, query, request.content)
+
+
+class Cassette:
+    """
+    A file of recorded HTTP exchanges, each stored with the hash of its request.
+
+    The file is gzip-compressed JSON lines, one exchange per line: the status, the headers in
+    KEPT_HEADERS, the body, and when the response headers and each body chunk arrived. On
+    open it is read once into a dict (request hash -> exchanges in recorded order), so a
+    lookup costs the same with a hundred entries or a million. Lines are parsed only when
+    they are replayed.
+
+    Identical requests (an Assistants run polled until it completes, a request retried after
+    a 500) replay their recorded responses in order; once those run out the last one is
+    repeated.
+
+    Modes:
+        record: every request goes to the network and the file is rewritten
+        replay: nothing goes to the network; a request that was not recorded gets a 404
+        auto:   recorded requests are replayed, the others go to the network and are appended
+
+    Use Cassette.open() so every client in a process shares one instance, and one writer,
+    per file.
+    """
+
+    _registry: Dict[str, 'Cassette'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, path: str, mode: str = 'auto'):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"cassette mode must be one of {CASSETTE_MODES}, not {mode!r}")
+        self.path = path
+        self.mode = mode
+        self._index: Dict[str, List[str]] = defaultdict(list)
+        self._positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self.replayed = 0
+        self.recorded = 0
+
+        if mode != 'record' and os.path.exists(path):
+            self._load()
+        elif mode == 'replay':
+            raise ValueError(f"Cassette not found: {path}")
+
+    @classmethod
+    def open(cls, path: str, mode: str = 'auto') -> 'Cassette':
+        """Get the shared Cassette for a file, reading it on first use"""
+        key = os.path.abspath(path)
+        with cls._registry_lock:
+            cassette = cls._registry.get(key)
+            if cassette is None:
+                cassette = cls._registry[key] = cls(path, mode)
+            elif cassette.mode != mode:
+                raise ValueError(f"Cassette {path} is already open in {cassette.mode} mode")
+        return cassette
+
+    def __len__(self) -> int:
+        return sum(len(exchanges) for exchanges in self._index.values())
+
+    def _load(self) -> None:
+        start = time.perf_counter()
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    if not line.endswith('\n'):
+                        raise EOFError("last line is incomplete")
+                    # every line starts with {"k":"<request hash>"
+                    key = line[6:46] if line.startswith(_KEY_PREFIX) else json.loads(line)['k']
+                    self._index[key].append(line)
+            except (EOFError, zlib.error, ValueError) as e:
+                # a recording that was cut off: keep the exchanges written before it
+                logger.warning("Cassette %s ends with an incomplete record (%s); using what came before", self.path, e)
+        logger.info("Loaded %d exchanges from cassette %s in %.3f s", len(self), self.path, time.perf_counter() - start)
+
+    # ==================================================================================
+    # REPLAY
+    # ==================================================================================
+    def find(self, key: str) -> Optional[Dict[str, Any]]:
+        """The next recorded exchange for a request hash, or None if it was never recorded"""
+        exchanges = self._index.get(key)
+        if not exchanges:
+            return None
+        with self._lock:
+            position = self._positions.get(key, 0)
+            self._positions[key] = min(position + 1, len(exchanges) - 1)
+            self.replayed += 1
+        return json.loads(exchanges[position])
+
+    @staticmethod
+    def body_of(exchange: Dict[str, Any]) -> bytes:
+        body = exchange['b']
+        return base64.b64decode(body) if exchange.get('e') else body.encode('utf-8')
+
+    # ==================================================================================
+    # RECORDING
+    # ==================================================================================
+    def add(self, key: str, request: 'httpx.Request', status: int, headers: Dict[str, str], body: bytes,
+            headers_at: float, chunks: List[Tuple[float, int]]) -> None:
+        """Append an exchange to the file (it is replayed from the next time the file is opened)"""
+        exchange = {'k': key, 'r': f"{request.method} {request.url.path}", 's': status, 'h': headers}
+        try:
+            exchange['b'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            exchange['b'], exchange['e'] = base64.b64encode(body).decode('ascii'), 1
+        # seconds from the request to the response headers, and to the end of each body chunk
+        exchange['t'] = [round(headers_at, 4), [[round(at, 4), size] for at, size in chunks]]
+        line = json.dumps(exchange, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, 'wt' if self.mode == 'record' else 'at', encoding='utf-8')
+            self._file.write(line)
+            # a sync flush per exchange keeps the file readable if the process dies mid-run
+            self._file.flush()
+            self.recorded += 1
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    @classmethod
+    def close_all(cls) -> None:
+        for cassette in list(cls._registry.values()):
+            cassette.close()
+
+
+# write the gzip trailers of cassettes still recording at exit
+atexit.register(Cassette.close_all)
+
+
+def _replay_response(cassette: Cassette, request: 'httpx.Request', key: str,
+                     exchange: Optional[Dict[str, Any]], stream: Any) -> 'httpx.Response':
+    if exchange is None:
+        message = f"No recorded response for {request.method} {request.url.path} (request {key[:12]}) in cassette {cassette.path}"
+        logger.error(message)
+        # a 404 is not retried by the SDKs, and its message reaches the caller
+        return httpx.Response(404, json={'type': 'error', 'error': {'type': 'cassette_miss', 'message': message}},
+                              request=request)
+    return httpx.Response(exchange['s'], headers=exchange['h'], stream=stream, request=request)
+
+
+class _Recording:
+    """Timing and body of one response as it is read"""
+
+    def __init__(self, cassette: Cassette, key: str, request: 'httpx.Request', response: 'httpx.Response',
+                 start: float):
+        self.cassette = cassette
+        self.key = key
+        self.request = request
+        self.status = response.status_code
+        self.headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+        self.start = start
+        self.headers_at = time.perf_counter() - start
+        self.parts: List[bytes] = []
+        self.chunks: List[Tuple[float, int]] = []
+
+    def chunk(self, part: bytes) -> None:
+        self.parts.append(part)
+        self.chunks.append((time.perf_counter() - self.start, len(part)))
+
+    def finish(self) -> None:
+        self.cassette.add(self.key, self.request, self.status, self.headers, b''.join(self.parts),
+                          self.headers_at, self.chunks)
+
+
+# ==================================================================================
+# SYNC TRANSPORT
+# ==================================================================================
+class _RecordingStream(httpx.SyncByteStream):
+    def __init__(self, stream: Any, recording: _Recording):
+        self._stream = stream
+        self._recording = recording
+        self._done = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part in self._stream:
+            self._recording.chunk(part)
+            yield part
+        self._done = True
+        self._recording.finish()
+
+    def close(self) -> None:
+        try:
+            if not self._done:
+                # the SDKs stop reading a stream at its last event: read the rest, so the
+                # cassette has the whole body
+                for part in self._stream:
+                    self._recording.chunk(part)
+                self._done = True
+                self._recording.finish()
+        finally:
+            self._stream.close()
+
+
+class _ReplayStream(httpx.SyncByteStream):
+    def __init__(self, body: bytes, exchange: Dict[str, Any], start: Optional[float]):
+        self._body = body
+        self._exchange = exchange
+        self._start = start  # None: no latency simulation
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self._start is None:
+            yield self._body
+            return
+        offset = 0
+        for at, size in self._exchange['t'][1]:
+            delay = self._start + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            yield self._body[offset:offset + size]
+            offset += size
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """
+    httpx transport that records to or replays from a Cassette.
+
+    Args:
+        cassette: The Cassette
+        simulate_latency: Replay each response with its recorded timing: headers, then every
+            streamed chunk, when they originally arrived
+        transport: The transport that reaches the network (default: an HTTPTransport)
+    """
+
+    def __init__(self, cassette: Cassette, simulate_latency: bool = False,
+                 transport: Optional['httpx.BaseTransport'] = None):
+        self.cassette = cassette
+        self.simulate_latency = simulate_latency
+        self._transport = transport
+
+    def _network(self) -> 'httpx.BaseTransport':
+        if self._transport is None:
+            self._transport = httpx.HTTPTransport(limits=DEFAULT_LIMITS)
+        return self._transport
+
+    def handle_request(self, request: 'httpx.Request') -> 'httpx.Response':
+        start = time.perf_counter()
+        request.read()
+        key = _key_of(request)
+        cassette = self.cassette
+
+        if cassette.mode != 'record':
+            exchange = cassette.find(key)
+            if exchange is not None or cassette.mode == 'replay':
+                stream = None
+                if exchange is not None:
+                    if self.simulate_latency:
+                        delay = start + exchange['t'][0] - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    stream = _ReplayStream(Cassette.body_of(exchange), exchange, start if self.simulate_latency else None)
+                return _replay_response(cassette, request, key, exchange, stream)
+
+        response = self._network().handle_request(request)
+        recording = _Recording(cassette, key, request, response, start)
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=_RecordingStream(response.stream, recording),
+                              request=request, extensions=response.extensions)
+
+    def close(self) -> None:
+        if self._transport is not None:
+            self._transport.close()
+
+
+# ==================================================================================
+# ASYNC TRANSPORT
+# ==================================================================================
+class _AsyncRecordingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: Any, recording: _Recording):
+        self._stream = stream
+        self._recording = recording
+        self._done = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for part in self._stream:
+            self._recording.chunk(part)
+            yield part
+        self._done = True
+        self._recording.finish()
+
+    async def aclose(self) -> None:
+        try:
+            if not self._done:
+                async for part in self._stream:
+                    self._recording.chunk(part)
+                self._done = True
+                self._recording.finish()
+        finally:
+            await self._stream.aclose()
+
+
+class _AsyncReplayStream(httpx.AsyncByteStream):
+    def __init__(self, body: bytes, exchange: Dict[str, Any], start: Optional[float]):
+        self._body = body
+        self._exchange = exchange
+        self._start = start
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        if self._start is None:
+            yield self._body
+            return
+        offset = 0
+        for at, size in self._exchange['t'][1]:
+            delay = self._start + at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield self._body[offset:offset + size]
+            offset += size
+
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    """CassetteTransport for async clients (AsyncOpenAI, AsyncAnthropic)"""
+
+    def __init__(self, cassette: Cassette, simulate_latency: bool = False,
+                 transport: Optional['httpx.AsyncBaseTransport'] = None):
+        self.cassette = cassette
+        self.simulate_latency = simulate_latency
+        self._transport = transport
+
+    def _network(self) -> 'httpx.AsyncBaseTransport':
+        if self._transport is None:
+            self._transport = httpx.AsyncHTTPTransport(limits=DEFAULT_LIMITS)
+        return self._transport
+
+    async def handle_async_request(self, request: 'httpx.Request') -> 'httpx.Response':
+        start = time.perf_counter()
+        await request.aread()
+        key = _key_of(request)
+        cassette = self.cassette
+
+        if cassette.mode != 'record':
+            exchange = cassette.find(key)
+            if exchange is not None or cassette.mode == 'replay':
+                stream = None
+                if exchange is not None:
+                    if self.simulate_latency:
+                        delay = start + exchange['t'][0] - time.perf_counter()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    stream = _AsyncReplayStream(Cassette.body_of(exchange), exchange,
+                                                start if self.simulate_latency else None)
+                return _replay_response(cassette, request, key, exchange, stream)
+
+        response = await self._network().handle_async_request(request)
+        recording = _Recording(cassette, key, request, response, start)
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=_AsyncRecordingStream(response.stream, recording),
+                              request=request, extensions=response.extensions)
+
+    async def aclose(self) -> None:
+        if self._transport is not None:
+            await self._transport.aclose()
+
+
+def cassette_http_client(client_class: Any, path: Optional[str] = None, mode: Optional[str] = None,
+                         simulate_latency: Optional[bool] = None) -> Any:
+    """
+    The http_client an FF* client passes to its SDK: a client_class (the SDK's
+    DefaultHttpxClient or DefaultAsyncHttpxClient) over a cassette transport, or None to use
+    the SDK's own when no cassette is configured.
+
+    Args:
+        client_class: The SDK's default httpx client class
+        path: Cassette file (default: FFAI_CASSETTE)
+        mode: 'record', 'replay' or 'auto' (default: FFAI_CASSETTE_MODE, or 'auto')
+        simulate_latency: Replay with the recorded timing (default: FFAI_REPLAY_LATENCY)
+    """
+    path = path or os.getenv('FFAI_CASSETTE')
+    if not path:
+        return None
+    mode = mode or os.getenv('FFAI_CASSETTE_MODE', 'auto')
+    if simulate_latency is None:
+        simulate_latency = os.getenv('FFAI_REPLAY_LATENCY', '0').lower() in ('1', 'true', 'yes')
+
+    cassette = Cassette.open(path, mode)
+    logger.info("Using cassette %s in %s mode", path, mode)
+    if issubclass(client_class, httpx.AsyncClient):
+        return client_class(transport=AsyncCassetteTransport(cassette, simulate_latency))
+    return client_class(transport=CassetteTransport(cassette, simulate_latency))
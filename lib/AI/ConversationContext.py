@@ -0,0 +1,202 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from typing import Optional, List, Dict, Any, Iterator
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import copy
+import itertools
+import logging
+import threading
+import weakref
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# 'shared': one conversation for the client (the original behavior)
+# 'thread': one conversation per thread, for clients shared by a worker pool
+# 'task':   one conversation per asyncio task (per thread outside of a task)
+CONVERSATION_SCOPES = ('shared', 'thread', 'task')
+
+_context_ids = itertools.count()
+
+
+def _current_task() -> Optional[asyncio.Task]:
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        # no running event loop in this thread
+        return None
+
+
+class ConversationContexts:
+    """
+    Holds a client's conversation messages, keyed by the configured scope.
+
+    Threads and tasks are held weakly, so a finished thread or task drops its conversation.
+    """
+
+    def __init__(self, scope: str = 'shared'):
+        if scope not in CONVERSATION_SCOPES:
+            logger.error("Invalid conversation scope: %s", scope)
+            raise ValueError(f"conversation_scope must be one of {CONVERSATION_SCOPES}, not {scope!r}")
+
+        self.scope = scope
+        self._shared: List[Dict[str, Any]] = []
+        self._thread_local = threading.local()
+        self._by_task: 'weakref.WeakKeyDictionary[asyncio.Task, List[Dict[str, Any]]]' = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        # a conversation bound with bind() overrides the scope in the current thread/task
+        self._bound = contextvars.ContextVar(f"bound_conversation_{next(_context_ids)}", default=None)
+
+    @contextmanager
+    def bind(self, messages: List[Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+        """Use the given message list as the conversation of the current thread/task inside the block"""
+        token = self._bound.set(messages)
+        try:
+            yield messages
+        finally:
+            self._bound.reset(token)
+
+    @property
+    def messages(self) -> List[Dict[str, Any]]:
+        """The conversation of the current scope (created empty on first use)"""
+        bound = self._bound.get()
+        if bound is not None:
+            return bound
+
+        if self.scope == 'shared':
+            return self._shared
+
+        if self.scope == 'task':
+            task = _current_task()
+            if task is not None:
+                with self._lock:
+                    messages = self._by_task.get(task)
+                    if messages is None:
+                        messages = self._by_task[task] = []
+                return messages
+
+        messages = getattr(self._thread_local, 'messages', None)
+        if messages is None:
+            messages = self._thread_local.messages = []
+        return messages
+
+    @messages.setter
+    def messages(self, value: List[Dict[str, Any]]) -> None:
+        if self._bound.get() is not None:
+            # replace the bound list's contents, so the owner of the list sees the change
+            self._bound.get()[:] = value
+            return
+
+        if self.scope == 'shared':
+            self._shared = value
+            return
+
+        if self.scope == 'task':
+            task = _current_task()
+            if task is not None:
+                with self._lock:
+                    self._by_task[task] = value
+                return
+
+        self._thread_local.messages = value
+
+
+class CallLocal:
+    """
+    A value local to the calling thread or asyncio task, such as the usage of the last call.
+
+    Reads from a thread or task that has not set it return the default. Values are dropped
+    with their thread or task, and all of them with the CallLocal.
+    """
+
+    def __init__(self, default: Any = None):
+        self.default = default
+        self._thread_local = threading.local()
+        self._by_task: 'weakref.WeakKeyDictionary[asyncio.Task, Any]' = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        task = _current_task()
+        if task is not None:
+            with self._lock:
+                return self._by_task.get(task, self.default)
+        return getattr(self._thread_local, 'value', self.default)
+
+    def set(self, value: Any) -> None:
+        task = _current_task()
+        if task is not None:
+            with self._lock:
+                self._by_task[task] = value
+            return
+        self._thread_local.value = value
+
+
+class ScopedValue:
+    """
+    A value kept per conversation scope (see CONVERSATION_SCOPES), so it follows the
+    conversations of a ConversationContexts with the same scope: one value for 'shared', one
+    per thread or per asyncio task otherwise. Reads from a scope that has not set it return
+    the default.
+    """
+
+    def __init__(self, scope: str = 'shared', default: Any = None):
+        if scope not in CONVERSATION_SCOPES:
+            raise ValueError(f"conversation_scope must be one of {CONVERSATION_SCOPES}, not {scope!r}")
+
+        self.scope = scope
+        self.default = default
+        self._shared = default
+        self._thread_local = threading.local()
+        self._by_task: 'weakref.WeakKeyDictionary[asyncio.Task, Any]' = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        if self.scope == 'shared':
+            return self._shared
+        if self.scope == 'task':
+            task = _current_task()
+            if task is not None:
+                with self._lock:
+                    return self._by_task.get(task, self.default)
+        return getattr(self._thread_local, 'value', self.default)
+
+    def set(self, value: Any) -> None:
+        if self.scope == 'shared':
+            self._shared = value
+            return
+        if self.scope == 'task':
+            task = _current_task()
+            if task is not None:
+                with self._lock:
+                    self._by_task[task] = value
+                return
+        self._thread_local.value = value
+
+
+@contextmanager
+def fresh_conversation(client: Any, messages: Optional[Any] = None) -> Iterator[Any]:
+    """
+    Yields the client to call for a new conversation -- empty, or the given messages --
+    leaving the client's own conversation untouched.
+
+    Clients with use_conversation() are yielded themselves, with the conversation bound to the
+    current thread/task. Other clients with a conversation_history are yielded as a shallow
+    per-call copy holding the new conversation, so concurrent calls need no lock.
+    """
+    if hasattr(client, 'use_conversation'):
+        with client.use_conversation([] if messages is None else messages):
+            yield client
+        return
+
+    current = getattr(client, 'conversation_history', None)
+    if current is None:
+        yield client
+        return
+
+    call_client = copy.copy(client)
+    # an empty conversation of the client's own kind (a list, or e.g. a ConversationHistory)
+    call_client.conversation_history = type(current)() if messages is None else messages
+    yield call_client
@@ -0,0 +1,68 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+import os
+import hashlib
+from typing import Any, Optional
+
+# Payloads (prompts, responses, histories) are logged as truncated previews with a content hash.
+# Set FFAI_DIAGNOSTICS_MAX_CHARS=0 (or call configure_diagnostics(max_chars=0)) to log them in full.
+_settings = {
+    'max_chars': int(os.getenv('FFAI_DIAGNOSTICS_MAX_CHARS', 200)),
+}
+
+
+def configure_diagnostics(max_chars: Optional[int] = None) -> None:
+    """
+    Configure how payloads are rendered in log messages.
+
+    Args:
+        max_chars: Longest payload preview to log. 0 logs payloads in full (diagnostics mode).
+    """
+    if max_chars is not None:
+        _settings['max_chars'] = int(max_chars)
+
+
+def preview_text(value: Any) -> str:
+    """Render a payload for logging: truncated with its length and a short hash if it is long"""
+    text = value if isinstance(value, str) else repr(value)
+    max_chars = _settings['max_chars']
+    if not max_chars or len(text) <= max_chars:
+        return text
+
+    digest = hashlib.blake2b(text.encode('utf-8', 'replace'), digest_size=6).hexdigest()
+    return f"{text[:max_chars]}... ({len(text)} chars, #{digest})"
+
+
+class Preview:
+    """
+    Lazy log argument. Formatting (and hashing) happens only if the record is emitted:
+
+        logger.debug("Prompt: %s", Preview(prompt))
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __str__(self) -> str:
+        return preview_text(self.value)
+
+
+class MessagesPreview:
+    """
+    Lazy log argument for a conversation history: the message count and the last message,
+    or the full history when payload truncation is off.
+    """
+    __slots__ = ('messages',)
+
+    def __init__(self, messages: Any):
+        self.messages = messages
+
+    def __str__(self) -> str:
+        messages = list(self.messages or [])
+        if not _settings['max_chars']:
+            return repr(messages)
+        if not messages:
+            return "0 messages"
+        return f"{len(messages)} messages; last: {preview_text(messages[-1])}"
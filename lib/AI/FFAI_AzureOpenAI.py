@@ -1,124 +1,398 @@
 # Copyright (c) 2024 Antonio Quinonez
 # Licensed under the MIT License. See LICENSE in the project root for license information.
 
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple, Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, TimeoutError as FuturesTimeout
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+import contextvars
+import copy
+import json
 import logging
+import os
+import threading
 import time
-import json
+
+from pydantic import BaseModel
 
 from .OrderedPromptHistory import OrderedPromptHistory
 from .PermanentHistory import PermanentHistory
+from .BlobStore import BlobStore, content_key
+from .Tracing import Tracer, TraceHook, Span, NULL_SPAN
+from .Diagnostics import Preview
+from .UsageStats import split_usage
+from .ResponseParser import parse_response
+from .StructuredOutput import StructuredOutput, resolve_structured_output
+from .SemanticCache import SemanticCache, numbers_in
+from .RelevanceIndex import BM25Index, estimate_tokens, CHARS_PER_TOKEN
+from .ConversationContext import fresh_conversation, ScopedValue
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# marks a recorded response whose JSON has not been parsed yet
+_NOT_PARSED = object()
+
+# tokens of retrieved interactions _build_prompt adds when no budget is given
+DEFAULT_RETRIEVAL_TOKEN_BUDGET = int(os.getenv('FFAI_RETRIEVAL_TOKEN_BUDGET', 2000))
+
+# call the client without its own conversation (see the stateless argument)
+DEFAULT_STATELESS = os.getenv('FFAI_STATELESS', '').lower() in ('1', 'true', 'yes')
+
+# most named prompts generate_packed_responses puts in one request
+DEFAULT_PACK_SIZE = int(os.getenv('FFAI_PACK_SIZE', 20))
+
+# reuse a named prompt's stored response while its inputs are unchanged (see the incremental argument)
+DEFAULT_INCREMENTAL = os.getenv('FFAI_INCREMENTAL', '').lower() in ('1', 'true', 'yes')
+
+# client settings that shape a response, and so are part of a fingerprint
+FINGERPRINT_CLIENT_PARAMETERS = ('temperature', 'max_tokens', 'max_completion_tokens', 'is_o1')
+
 class FFAI_AzureOpenAI:
-    def __init__(self, azure_client):
+    def __init__(self, azure_client, price_table: Optional[Dict[str, Dict[str, float]]] = None,
+                 hooks: Optional[List[TraceHook]] = None,
+                 dedupe_text: bool = True,
+                 semantic_cache: Optional[SemanticCache] = None,
+                 stateless: Optional[bool] = None,
+                 incremental: Optional[bool] = None):
+        """
+        Args:
+            azure_client: The wrapped client (e.g. FFAzureOpenAI)
+            price_table: Optional model -> {'prompt': x, 'completion': y, 'cached': z, 'cache_write': w} prices
+                per 1M tokens, used for cost estimates
+            hooks: Optional tracing hooks (see Tracing.py) called around each stage of
+                generate_response. No tracing work is done when there are none.
+            dedupe_text: Keep one copy of each prompt and response text in a content-addressed
+                BlobStore shared by all the histories, instead of a copy per history.
+            semantic_cache: Optional SemanticCache; prompts similar enough to an earlier prompt
+                with the same model, system instructions and history are answered from it.
+            stateless: Call the client with an empty conversation every time, so only the prompt
+                built here (with its history) is sent, instead of the client also re-sending every
+                earlier prompt and response. Each interaction records the estimated tokens this
+                saved as context_tokens_saved. Defaults to FFAI_STATELESS (off).
+            incremental: Fingerprint each named prompt's inputs (prompt, model, client settings,
+                response model, and the history blocks it is given) and, when a call's fingerprint
+                matches the one stored for its prompt_name and model, return the stored response
+                instead of calling the model. Load a previous run's export_state() to rerun only what changed.
+                Defaults to FFAI_INCREMENTAL (off).
+        """
         logger.info("Initializing FFAIAzure wrapper")
+        # the client to call inside a new_conversation() block, local to the thread/task
+        self._call_client = contextvars.ContextVar(f"ffai_call_client_{id(self)}", default=None)
         self.client = azure_client
+        self.tracer: Optional[Tracer] = Tracer(hooks) if hooks else None
+        self.blob_store: Optional[BlobStore] = BlobStore() if dedupe_text else None
+        self.semantic_cache = semantic_cache
+
+        self.stateless = DEFAULT_STATELESS if stateless is None else stateless
+        self.incremental = DEFAULT_INCREMENTAL if incremental is None else incremental
+        # characters a stateful client would be re-sending by now: every prompt and response
+        # since the last clear_conversation, per conversation of the client's conversation_scope
+        self._stateful_conversation_chars = ScopedValue(getattr(azure_client, 'conversation_scope', 'shared'), 0)
         
+        # guards the history lists, the pending queue and the _build_prompt caches, so one wrapper
+        # can be shared by a worker pool; the client call and text cleaning run outside it
+        self._lock = threading.RLock()
+
         self.history = []
-        self.clean_history = []
-        self.prompt_attr_history = []
+        # clean_history and prompt_attr_history are filled lazily from _pending_clean when read
+        self._clean_history = []
+        self._prompt_attr_history = []
+        self._pending_clean = []
+
+        # _build_prompt lookups: prompt_name -> position of its latest prompt_attr_history entry,
+        # and prompt_name -> (position, rendered <interaction> block)
+        self._attr_index: Dict[Any, int] = {}
+        self._attr_indexed_list: Optional[List[Dict[str, Any]]] = None
+        self._attr_indexed_count = 0
+        self._rendered_blocks: Dict[Any, Tuple[int, str]] = {}
+
+        # relevance retrieval: a BM25 index over self.history, built on first use and then
+        # extended with the interactions added since
+        self._relevance_index: Optional[BM25Index] = None
+        self._relevance_indexed_list: Optional[List[Dict[str, Any]]] = None
 
         self.permanent_history = PermanentHistory()
 
-        self.ordered_history = OrderedPromptHistory()
-        self.clean_ordered_history = OrderedPromptHistory()
+        self.ordered_history = OrderedPromptHistory(price_table=price_table, blob_store=self.blob_store)
+        self.clean_ordered_history = OrderedPromptHistory(blob_store=self.blob_store)
+
+        self.named_prompt_ordered_history=OrderedPromptHistory(blob_store=self.blob_store)
 
-        self.named_prompt_ordered_history=OrderedPromptHistory()
+    @property
+    def client(self) -> Any:
+        """The client; inside a new_conversation() block, the one holding that conversation"""
+        call_client = self._call_client.get()
+        return self._client if call_client is None else call_client
 
-    def _clean_response(self, response: str) -> Any:
-        """Process and validate the evaluation response"""
+    @client.setter
+    def client(self, value: Any) -> None:
+        self._client = value
 
-        if response.startswith('```json'):
+    @contextmanager
+    def new_conversation(self, messages: Optional[Any] = None) -> Iterator[None]:
+        """
+        Calls made inside the block from the current thread/task send a new conversation --
+        empty, or the given messages -- and leave the client's own conversation untouched.
+
+        No lock is held: clients with use_conversation() bind the conversation to the
+        thread/task, and other clients are called through a shallow per-call copy (see
+        ConversationContext.fresh_conversation), so blocks in different threads run at once.
+        """
+        with fresh_conversation(self.client, messages) as call_client:
+            token = self._call_client.set(call_client)
             try:
-                json_text = response[response.find('{'):response.rfind('}')+1]
-                cleaned_json_response = json.loads(json_text)
-                
-                return cleaned_json_response
-                
-            except json.JSONDecodeError as e:
-                logger.error(f"Error parsing evaluation response: {str(e)}")
-                raise
-        else:
-            return response
+                yield
+            finally:
+                self._call_client.reset(token)
+
+    @property
+    def clean_history(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._materialize_pending()
+            return self._clean_history
+
+    @clean_history.setter
+    def clean_history(self, value: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._materialize_pending()
+            self._clean_history = value
+
+    @property
+    def prompt_attr_history(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._materialize_pending()
+            return self._prompt_attr_history
+
+    @prompt_attr_history.setter
+    def prompt_attr_history(self, value: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._materialize_pending()
+            self._prompt_attr_history = value
+
+    def _clean_response(self, response: str, structured_output: Optional[StructuredOutput] = None) -> Any:
+        """
+        Process and validate the evaluation response.
+
+        Returns a dict or list for JSON responses (fenced or bare), otherwise the response unchanged.
+        With structured_output, returns the validated object, falling back to plain parsing if
+        validation fails.
+        """
+        if structured_output is not None:
+            try:
+                return structured_output.validate_json(response)
+            except ValueError as e:
+                logger.error("Response does not match %s: %s", structured_output.name, e)
+
+        return parse_response(response)
 
 
     # TODO: Figure out what to do with dependencies, which has data dependencies, if avail, for attribute 
-    def _build_prompt(self, prompt: str, history: Optional[List[str]] = None, dependencies: Optional[Dict] = None) -> str:
-        if not history:
+    def _build_prompt(self, prompt: str, history: Optional[List[str]] = None, dependencies: Optional[Dict] = None,
+                      retrieve: Optional[int] = None, token_budget: Optional[int] = None) -> str:
+        """
+        The prompt with the latest interaction of each prompt_name in history, then (with
+        retrieve) up to that many other past interactions most relevant to the prompt, within
+        token_budget tokens (default FFAI_RETRIEVAL_TOKEN_BUDGET or 2000)
+        """
+        if not history and not retrieve:
             logger.debug("No history provided, returning original prompt")
             return prompt
             
-        logger.info(f"Building prompt with history references: {history}")
-        logger.info(f"Current history size: {len(self.prompt_attr_history)}")
+        logger.info("Building prompt with history references: %s", history)
+        logger.info("Current history size: %d", len(self.prompt_attr_history))
         
-        # Debug current history
-        for idx, entry in enumerate(self.prompt_attr_history):
-            logger.debug("==================================================================")
-            logger.debug(f"History entry {idx}:")
-            logger.debug("==================================================================")
-            logger.debug(f"  Prompt name: {entry.get('prompt_name')}")
-            logger.debug("------------------------------------------------------------------")
-            logger.debug(f"  Prompt: {entry.get('prompt')}")
-            logger.debug("------------------------------------------------------------------")
-            logger.debug(f"  Response: {entry.get('response')}")
-            # logger.debug("==================================================================")
-
-        # Get historical interactions for each prompt name
-        # this is the history that will be passed to the llm based on the information recorded  in self.prompt_attr_history
-        history_entries = []
-        for prompt_name in history:
-            logger.debug("===================================================================================")
-            logger.debug(f"Looking for stored named interactions with prompt_name: {prompt_name}")
-            matching_entries = [
-                entry for entry in self.prompt_attr_history 
-                if entry.get('prompt_name') == prompt_name
-            ]
-
-            if(len(matching_entries)) == 0:
-                logger.warning(f"-- No matching entries for requested prompt_name: {prompt_name}")
-            else:
-                logger.debug(f"-- Found {len(matching_entries)} matching entries")
+        # Debug current history -- walks the whole history, so only when DEBUG is on
+        if logger.isEnabledFor(logging.DEBUG):
+            for idx, entry in enumerate(self.prompt_attr_history):
+                logger.debug("==================================================================")
+                logger.debug("History entry %d:", idx)
+                logger.debug("==================================================================")
+                logger.debug("  Prompt name: %s", entry.get('prompt_name'))
+                logger.debug("------------------------------------------------------------------")
+                logger.debug("  Prompt: %s", Preview(entry.get('prompt')))
+                logger.debug("------------------------------------------------------------------")
+                logger.debug("  Response: %s", Preview(entry.get('response')))
+                # logger.debug("==================================================================")
 
-            
-            if matching_entries:
-                latest = matching_entries[-1]
-                history_entries.append({
-                    'prompt_name': latest.get('prompt_name'),
-                    'prompt': latest['prompt'],
-                    'response': latest['response']
-                })
-                logger.debug(f"Added entry for {prompt_name}: {latest['prompt']} -> {latest['response']}")
-
-        # Format history entries
+        # Get the rendered block of the latest interaction for each prompt name
+        # this is the history that will be passed to the llm based on the information recorded  in self.prompt_attr_history
         formatted_history = []
-        for entry in history_entries:
-            formatted_entry = (
-                f"<interaction prompt_name='{entry['prompt_name']}'>\n"
-                f"USER: {entry['prompt']}\n"
-                f"SYSTEM: {entry['response']}\n"
-                f"</interaction>"
-            )
-            formatted_history.append(formatted_entry)
-        
-        # Combine history with current prompt
+        with self._lock:
+            attr_history = self.prompt_attr_history
+            self._sync_attr_index(attr_history)
+
+            for prompt_name in history or ():
+                logger.debug("===================================================================================")
+                logger.debug("Looking for stored named interactions with prompt_name: %s", prompt_name)
+                position = self._latest_attr_position(attr_history, prompt_name)
+
+                if position is None:
+                    logger.warning("-- No matching entries for requested prompt_name: %s", prompt_name)
+                    continue
+
+                formatted_history.append(self._rendered_block(attr_history, prompt_name, position))
+
+            if retrieve:
+                formatted_history.extend(self._retrieved_blocks(prompt, retrieve, token_budget, history or ()))
+
+        # Combine history with current prompt; blocks keep the order of `history`, so
+        # repeated requests share a stable prefix for provider-side prompt caching
         if formatted_history:
-            final_prompt = (
-                "<conversation_history>\n" + 
-                "\n".join(formatted_history) + 
-                "\n</conversation_history>\n" +
-                "===\n" +
-                "Based on the conversation history above, please answer: " + prompt
-            )
+            final_prompt = ''.join((
+                "<conversation_history>\n",
+                "\n".join(formatted_history),
+                "\n</conversation_history>\n",
+                "===\n",
+                "Based on the conversation history above, please answer: ",
+                prompt
+            ))
         else:
             final_prompt = prompt
             
-        logger.info(f"Final constructed prompt:\n{final_prompt}")
+        logger.info("Final constructed prompt:\n%s", Preview(final_prompt))
         return final_prompt
 
+    def _sync_attr_index(self, attr_history: List[Dict[str, Any]]) -> None:
+        """Index prompt_attr_history entries added since the last call (all of them if the list was replaced)"""
+        if attr_history is not self._attr_indexed_list or len(attr_history) < self._attr_indexed_count:
+            self._attr_index = {}
+            self._attr_indexed_list = attr_history
+            self._attr_indexed_count = 0
+            self._rendered_blocks = {}
+
+        index = self._attr_index
+        for position in range(self._attr_indexed_count, len(attr_history)):
+            try:
+                index[attr_history[position].get('prompt_name')] = position
+            except TypeError:
+                # unhashable prompt names are found by _latest_attr_position's scan
+                pass
+        self._attr_indexed_count = len(attr_history)
+
+    def _latest_attr_position(self, attr_history: List[Dict[str, Any]], prompt_name: Any) -> Optional[int]:
+        """Position of the latest prompt_attr_history entry for prompt_name, or None"""
+        try:
+            return self._attr_index.get(prompt_name)
+        except TypeError:
+            for position in range(len(attr_history) - 1, -1, -1):
+                if attr_history[position].get('prompt_name') == prompt_name:
+                    return position
+            return None
+
+    def _rendered_block(self, attr_history: List[Dict[str, Any]], prompt_name: Any, position: int) -> str:
+        """The <interaction> block for an entry, rendered once per (prompt_name, entry)"""
+        try:
+            cached = self._rendered_blocks.get(prompt_name)
+        except TypeError:
+            cached = None
+        if cached is not None and cached[0] == position:
+            logger.debug("-- Reusing rendered entry for %s", prompt_name)
+            return cached[1]
+
+        latest = attr_history[position]
+        block = (
+            f"<interaction prompt_name='{latest.get('prompt_name')}'>\n"
+            f"USER: {latest['prompt']}\n"
+            f"SYSTEM: {latest['response']}\n"
+            f"</interaction>"
+        )
+        try:
+            self._rendered_blocks[prompt_name] = (position, block)
+        except TypeError:
+            pass
+        logger.debug("Added entry for %s: %s -> %s", prompt_name, Preview(latest['prompt']), Preview(latest['response']))
+        return block
+
+    def _sync_relevance_index(self) -> BM25Index:
+        """Index interactions added since the last call (all of them if the list was replaced; call with the lock held)"""
+        history = self.history
+        index = self._relevance_index
+        if index is None or history is not self._relevance_indexed_list or len(history) < len(index):
+            index = self._relevance_index = BM25Index()
+            self._relevance_indexed_list = history
+        for position in range(len(index), len(history)):
+            entry = history[position]
+            index.add(f"{entry['prompt']}\n{entry['response']}")
+        return index
+
+    def _retrieved_blocks(self, prompt: str, top_k: int, token_budget: Optional[int], named: List[Any]) -> List[str]:
+        """
+        <interaction> blocks of the top_k past interactions most relevant to the prompt that fit
+        the token budget, oldest first; prompt_names already in the history are skipped
+        (call with the lock held)
+        """
+        budget = DEFAULT_RETRIEVAL_TOKEN_BUDGET if token_budget is None else token_budget
+        index = self._sync_relevance_index()
+
+        selected = []
+        used = 0
+        for position, score in index.ranked(prompt):
+            entry = self.history[position]
+            try:
+                if entry.get('prompt_name') in named:
+                    continue
+            except TypeError:
+                pass
+            block = (
+                f"<interaction prompt_name='{entry.get('prompt_name')}'>\n"
+                f"USER: {entry['prompt']}\n"
+                f"SYSTEM: {entry['response']}\n"
+                f"</interaction>"
+            )
+            tokens = estimate_tokens(block)
+            if used + tokens > budget:
+                continue
+            selected.append((position, block))
+            used += tokens
+            logger.debug("Retrieved interaction %d (score %.2f, %d tokens)", position, score, tokens)
+            if len(selected) == top_k:
+                break
+
+        logger.info("Retrieved %d relevant interactions (%d tokens)", len(selected), used)
+        selected.sort()
+        return [block for _, block in selected]
+
+    @staticmethod
+    def _history_context(prompt: str, final_prompt: str) -> str:
+        """The history blocks _build_prompt put in front of the prompt"""
+        return final_prompt[:len(final_prompt) - len(prompt)] if final_prompt.endswith(prompt) else final_prompt
+
+    def _cache_scope(self, prompt: str, final_prompt: str, used_model: str,
+                     structured: Optional[StructuredOutput]) -> tuple:
+        """
+        Semantic cache scope of a call: the prompt is matched by similarity, everything else
+        that shapes the answer must match exactly
+        """
+        context = self._history_context(prompt, final_prompt)
+        return (
+            used_model,
+            getattr(self.client, 'system_instructions', None),
+            content_key(context) if context else None,
+            structured.name if structured else None,
+            numbers_in(prompt),
+        )
+
+    def _fingerprint(self, prompt: str, final_prompt: str, used_model: str,
+                     structured: Optional[StructuredOutput], dependencies: Optional[List[Any]]) -> str:
+        """
+        Fingerprint of everything that shapes a named prompt's response. Its history dependencies
+        count by the content of the blocks they add to the prompt, so a change upstream reaches
+        every prompt that reads it, and an upstream prompt that is rerun but answers the same
+        leaves its dependents as they are.
+        """
+        context = self._history_context(prompt, final_prompt)
+        inputs = {
+            'prompt': prompt,
+            'model': used_model,
+            'system_instructions': getattr(self.client, 'system_instructions', None),
+            'parameters': {name: getattr(self.client, name, None) for name in FINGERPRINT_CLIENT_PARAMETERS},
+            'response_model': structured.schema if structured else None,
+            'dependencies': sorted(map(str, dependencies)) if dependencies else None,
+            'history': content_key(context).hex() if context else None,
+        }
+        return content_key(json.dumps(inputs, sort_keys=True, default=str)).hex()
+
     #todo: refer to data dependencies needed by prompt as prompt_dependencies
     def generate_response(self,
                          prompt: str,
@@ -126,131 +400,532 @@ class FFAI_AzureOpenAI:
                          prompt_name: Optional[str] = None,
                          history: Optional[List[str]] = None,
                          dependencies: Optional[dict] = None,
+                         response_model: Optional[Any] = None,
+                         use_cache: bool = True,
+                         retrieve: Optional[int] = None,
+                         retrieve_token_budget: Optional[int] = None,
                          **kwargs ) -> str:
-        """Generate response using Azure OpenAI"""
-        logger.debug(f"\n===================================================================================")
-        logger.info(f"Generating response for prompt: '{prompt}'")
-        logger.debug(f"Prompt_name: '{prompt_name}'")
-        logger.debug(f"History: {history}") if history else logger.debug("No history provided")
+        """
+        Generate response using Azure OpenAI
+
+        Args:
+            response_model: Optional Pydantic model (or StructuredOutput). The schema is sent as the
+                response_format, and clean_history stores the validated object instead of a dict.
+            use_cache: Set False to skip the semantic cache (if any) for this call
+            retrieve: Also include up to this many past interactions ranked by BM25 relevance to
+                the prompt, in addition to (or instead of) the named history
+            retrieve_token_budget: Most tokens of retrieved interactions (default
+                FFAI_RETRIEVAL_TOKEN_BUDGET or 2000)
+        """
+        logger.debug("\n===================================================================================")
+        logger.info("Generating response for prompt: '%s'", Preview(prompt))
+        logger.debug("Prompt_name: '%s'", prompt_name)
+        logger.debug("History: %s", history) if history else logger.debug("No history provided")
 
         used_model = model if model else self.client.model
-        logger.debug(f"Using model: {used_model}")
+        logger.debug("Using model: %s", used_model)
 
         # dedupe dependencies
         if dependencies:
             dependencies_set = set(dependencies)
             dependencies = list(dependencies_set)
 
+        tracer = self.tracer
         try:
-            # Build prompt with history
-            final_prompt = self._build_prompt(prompt, history, dependencies)
-            logger.debug(f"final_prompt built: {final_prompt}")
+            with (tracer.span('generate_response', model=used_model, prompt_name=prompt_name) if tracer else NULL_SPAN) as request_span:
+                # Build prompt with history
+                with (tracer.span('build_prompt', model=used_model, prompt_name=prompt_name) if tracer else NULL_SPAN) as span:
+                    final_prompt = self._build_prompt(prompt, history, dependencies, retrieve, retrieve_token_budget)
+                    if tracer:
+                        span.set(prompt_bytes=len(prompt.encode('utf-8')), final_prompt_bytes=len(final_prompt.encode('utf-8')))
+                logger.debug("final_prompt built: %s", Preview(final_prompt))
 
-            # ==================================================================================
-            # GENERATE RESPONSE USING THE WRAPPED CLIENT
-            # ==================================================================================
-            # logger.debug(f"is_o1: {is_o1}")
+                # ==================================================================================
+                # GENERATE RESPONSE USING THE WRAPPED CLIENT
+                # ==================================================================================
+                # logger.debug(f"is_o1: {is_o1}")
 
-            response = self.client.generate_response(prompt=final_prompt, model=used_model)
-            logger.debug(f"Generated response: {response}")
+                structured = resolve_structured_output(response_model) if response_model else None
+
+                fingerprint = None
+                if self.incremental and prompt_name is not None:
+                    fingerprint = self._fingerprint(prompt, final_prompt, used_model, structured, dependencies)
+                    stored = self.ordered_history.get_fingerprint(prompt_name, used_model)
+                    if stored is not None and stored[0] == fingerprint:
+                        logger.info("'%s' is up to date; reusing its stored response", prompt_name)
+                        if tracer:
+                            request_span.set(reused=True)
+                        return stored[1]
+
+                cache_scope = None
+                cached = None
+                if self.semantic_cache is not None and use_cache:
+                    with (tracer.span('cache_lookup', model=used_model, prompt_name=prompt_name) if tracer else NULL_SPAN) as span:
+                        cache_scope = self._cache_scope(prompt, final_prompt, used_model, structured)
+                        cached = self.semantic_cache.lookup(prompt, cache_scope)
+                        if tracer:
+                            span.set(hit=cached is not None)
+
+                if cached is not None:
+                    response, similarity = cached
+                    logger.info("Answered from the semantic cache (similarity %.3f)", similarity)
+                    usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0,
+                             'finish_reason': 'semantic_cache', 'latency': None}
+                else:
+                    with (tracer.span('client_call', model=used_model, prompt_name=prompt_name) if tracer else NULL_SPAN) as span, \
+                            (self.new_conversation() if self.stateless else nullcontext()):
+                        if structured:
+                            response = self.client.generate_response(prompt=final_prompt, model=used_model, response_format=structured)
+                        else:
+                            response = self.client.generate_response(prompt=final_prompt, model=used_model)
+
+                        # usage and timing reported by the client for this call, if it supports it
+                        usage = getattr(self.client, 'last_usage', None)
+                        if self.stateless:
+                            usage = self._with_context_savings(usage, final_prompt, response)
+                        if tracer:
+                            span.set(response_bytes=len(response.encode('utf-8')) if response else 0,
+                                     prompt_tokens=usage.get('prompt_tokens') if usage else None,
+                                     completion_tokens=usage.get('completion_tokens') if usage else None)
+
+                    if cache_scope is not None and response:
+                        self.semantic_cache.add(prompt, response, cache_scope)
+                logger.debug("Generated response: %s", Preview(response))
+
+                # JSON responses are parsed later, when clean_history or prompt_attr_history is read
+                with (tracer.span('record_history', model=used_model, prompt_name=prompt_name) if tracer else NULL_SPAN):
+                    self._record_interaction(prompt, response, used_model, prompt_name, history, usage,
+                                             structured_output=structured,
+                                             trace_parent=request_span if tracer else None)
+                    if fingerprint is not None:
+                        stored_response = self.blob_store.intern(response) if self.blob_store is not None else response
+                        self.ordered_history.set_fingerprint(prompt_name, used_model, fingerprint, stored_response)
 
-            # turn response into a dict if a JSON responses.
-            cleaned_response = self._clean_response(response)
-            logger.debug(f"cleaned_response: {cleaned_response}")
+                if tracer:
+                    request_span.set(prompt_tokens=usage.get('prompt_tokens') if usage else None,
+                                     completion_tokens=usage.get('completion_tokens') if usage else None)
+
+            return response
             
-            # ==================================================================================
-            # ADD TO PERMANENT HISTORY
-            # ==================================================================================
-            # 1) Add user prompt to histories
-            self.permanent_history.add_turn_user(prompt)
-        
-            # 2) Add response to histories
-            self.permanent_history.add_turn_assistant(response)
-
-            # ==================================================================================
-            # RECORDING INTERACTIONS
-            # ==================================================================================
-            logger.debug(f"""Adding interaction:
-                                model: {used_model}
-                                prompt: {prompt}
-                                response: {response}
-                                prompt_name: {prompt_name}
-                                history: {history}
-            """)
-        
+        except Exception as e:
+            logger.error("Problem with response generation: %s", e)
+            logger.error("Prompt: %s", Preview(prompt))
+            logger.error("History: %s", history)
+            raise
 
-            # SELF.HISTORY -- Store interaction to self.history ---------------------------------
-            interaction = {
-                'prompt': prompt,
-                'response': response,
-                'prompt_name': prompt_name,
-                'timestamp': time.time(),
-                'model': used_model,
-                'history': history
-            }
+    def _with_context_savings(self, usage: Optional[Dict[str, Any]], final_prompt: str, response: str) -> Dict[str, Any]:
+        """
+        A copy of usage with context_tokens_saved: the tokens of the earlier prompts and
+        responses a stateful client would have re-sent with this call. Characters are
+        converted at this call's own prompt_tokens per character when the client reports it.
+        """
+        with self._lock:
+            resent_chars = self._stateful_conversation_chars.get()
+            self._stateful_conversation_chars.set(resent_chars + len(final_prompt) + len(response or ''))
+
+        sent_chars = len(final_prompt) + len(getattr(self.client, 'system_instructions', None) or '')
+        prompt_tokens = usage.get('prompt_tokens') if usage else None
+        tokens_per_char = prompt_tokens / sent_chars if prompt_tokens and sent_chars else 1 / CHARS_PER_TOKEN
+
+        usage = dict(usage or {})
+        usage['context_tokens_saved'] = round(resent_chars * tokens_per_char)
+        logger.info("Stateless call: about %d conversation tokens not re-sent", usage['context_tokens_saved'])
+        return usage
+
+    def _record_interaction(self, prompt: str, response: str, used_model: str,
+                            prompt_name: Optional[str], history: Optional[List[str]],
+                            usage: Optional[Dict[str, Any]], cleaned_response: Any = _NOT_PARSED,
+                            structured_output: Optional[StructuredOutput] = None,
+                            trace_parent: Optional[Span] = None) -> None:
+        """
+        Store one completed interaction in every history structure.
+
+        clean_history and prompt_attr_history entries are queued and built on first read;
+        pass cleaned_response to skip parsing the response, or structured_output to validate
+        it into a typed object. The clean_response span of that parse belongs to trace_parent.
+        """
+        # every history below references the store's copy of the text
+        if self.blob_store is not None:
+            prompt = self.blob_store.intern(prompt)
+            response = self.blob_store.intern(response)
+
+        # ==================================================================================
+        # RECORDING INTERACTIONS
+        # ==================================================================================
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("""Adding interaction:
+                            model: %s
+                            prompt: %s
+                            response: %s
+                            prompt_name: %s
+                            history: %s
+            """, used_model, Preview(prompt), Preview(response), prompt_name, history)
+    
+
+        # SELF.HISTORY -- Store interaction to self.history ---------------------------------
+        interaction = {
+            'prompt': prompt,
+            'response': response,
+            'prompt_name': prompt_name,
+            'timestamp': time.time(),
+            'model': used_model,
+            'history': history
+        }
+
+        with self._lock:
+            # ADD TO PERMANENT HISTORY -- the user prompt and its response, as one exchange
+            self.permanent_history.add_exchange(prompt, response)
 
             self.history.append(interaction)
-            logger.debug(f"Added new interaction to self.history: {interaction}")
+
+            # SELF.CLEANED_HISTORY / SELF.PROMPT_ATTR_HISTORY -- deferred until read --------------
+            self._pending_clean.append((interaction, cleaned_response, structured_output, trace_parent))
+        if debug:
+            logger.debug("Added new interaction to self.history: %s", Preview(interaction))
+
+        ####################################################################################
+        # ORDERED_HISTORY -- Store interaction to ordered history --------------------------
+        self.ordered_history.add_interaction(
+            model=used_model,
+            prompt=prompt,
+            response=response,
+            prompt_name=prompt_name,
+            history=history,  # Pass the history parameter here
+            usage=usage
+        )
+        # ==================================================================================
+
+    def _materialize_pending(self) -> None:
+        """Parse queued responses and build their clean_history and prompt_attr_history entries (call with the lock held)"""
+        if not self._pending_clean:
+            return
+
+        pending = self._pending_clean
+        self._pending_clean = []
+        tracer = self.tracer
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        for interaction, cleaned_response, structured_output, trace_parent in pending:
+            if cleaned_response is _NOT_PARSED:
+                # turn response into a dict if a JSON responses; a typed object for structured output.
+                # The call's generate_response span has ended, so this span names it as parent (see Tracer)
+                with (tracer.span('clean_response', parent=trace_parent, model=interaction['model'],
+                                  prompt_name=interaction['prompt_name']) if tracer else NULL_SPAN):
+                    cleaned_response = self._clean_response(interaction['response'], structured_output)
+                if debug:
+                    logger.debug("cleaned_response: %s", Preview(cleaned_response))
 
             # SELF.CLEANED_HISTORY -- CLEANED JSON TO PY DICT -------------------------------------
             cleaned_interaction = {
-                'prompt': prompt,
+                'prompt': interaction['prompt'],
                 'response': cleaned_response,
-                'prompt_name': prompt_name,
-                'timestamp': time.time(),
-                'model': used_model,
-                'history': history
+                'prompt_name': interaction['prompt_name'],
+                'timestamp': interaction['timestamp'],
+                'model': interaction['model'],
+                'history': interaction['history']
             }
 
-            self.clean_history.append(cleaned_interaction)
-            logger.debug(f"Added new interaction to self.clean_history: {cleaned_interaction}")
+            self._clean_history.append(cleaned_interaction)
+            if debug:
+                logger.debug("Added new interaction to self.clean_history: %s", Preview(cleaned_interaction))
 
             # SELF.PROMPT_ATTR_HISTORY ------------------------------------------------------------
 
-            if isinstance(cleaned_response, dict):
+            if isinstance(cleaned_response, (dict, BaseModel)):
                 logger.debug("Response was JSON.")
-                for attr, value in cleaned_response.items():
-                    logger.debug(f"Response has attribute(s). attr: {attr} | value: {value}")
+                # a validated model fans out by field, like the keys of a dict
+                attributes = cleaned_response.items() if isinstance(cleaned_response, dict) else iter(cleaned_response)
+                for attr, value in attributes:
+                    if debug:
+                        logger.debug("Response has attribute(s). attr: %s | value: %s", attr, Preview(value))
 
                     attr_interaction = {
                         'prompt': attr,
-                        'response': value,
+                        'response': self.blob_store.intern(value) if self.blob_store is not None else value,
                         'prompt_name': attr,
-                        'timestamp': time.time(),
-                        'model': used_model,
-                        'history': history
+                        'timestamp': interaction['timestamp'],
+                        'model': interaction['model'],
+                        'history': interaction['history']
                     }
 
 
-                    self.prompt_attr_history.append(attr_interaction)
-                    logger.debug(f"Added new attr interaction to self.prompt_attr_history: {attr_interaction}")
+                    self._prompt_attr_history.append(attr_interaction)
+                    if debug:
+                        logger.debug("Added new attr interaction to self.prompt_attr_history: %s", Preview(attr_interaction))
             else:
-                self.prompt_attr_history.append(interaction)
-                logger.debug(f"Interaction was not JSON, saving original 'prompt' and 'response' to prompt_attr_history.")
-                logger.debug(f"Added new interaction to self.prompt_attr_history: {interaction}")
-
-            ####################################################################################
-            # ORDERED_HISTORY -- Store interaction to ordered history --------------------------
-            self.ordered_history.add_interaction(
-                model=used_model,
-                prompt=prompt,
-                response=response,
-                prompt_name=prompt_name,
-                history=history  # Pass the history parameter here
-            )
-            # ==================================================================================
+                self._prompt_attr_history.append(interaction)
+                if debug:
+                    logger.debug("Interaction was not JSON, saving original 'prompt' and 'response' to prompt_attr_history.")
+                    logger.debug("Added new interaction to self.prompt_attr_history: %s", Preview(interaction))
 
-            return response
-            
-        except Exception as e:
-            logger.error(f"Problem with response generation: {str(e)}")
-            logger.error(f"Prompt: {prompt}")
-            logger.error(f"History: {history}")
-            raise
+    # ======================================================================================
+    # FAN-OUT -- the same prompt to several models at once
+    # ======================================================================================
+    def _fan_out_conversation(self) -> Optional[Any]:
+        """What each model's call starts from: the client's current conversation (None, a new one, when stateless)"""
+        if self.stateless:
+            return None
+        return getattr(self.client, 'conversation_history', None)
+
+    @staticmethod
+    def _fan_out_models(models: List[str]) -> List[str]:
+        models = list(dict.fromkeys(models))
+        if not models:
+            raise ValueError("models must name at least one model")
+        return models
+
+    def _fan_out_submit(self, executor: ThreadPoolExecutor, prompt: str, model: str,
+                        conversation: Optional[Any], **kwargs) -> Future:
+        # each call runs in a copy of the caller's context, so its ContextVars (e.g. a bound
+        # 'task' conversation) are seen by the worker thread
+        return executor.submit(contextvars.copy_context().run, self._fan_out_call, prompt, model, conversation, **kwargs)
+
+    def _fan_out_call(self, prompt: str, model: str, conversation: Optional[Any], **kwargs) -> str:
+        # each model answers in its own copy of the conversation, so concurrent calls cannot interleave
+        with self.new_conversation(copy.deepcopy(conversation)):
+            return self.generate_response(prompt, model=model, **kwargs)
+
+    def generate_responses(self, prompt: str, models: List[str], prompt_name: Optional[str] = None,
+                           history: Optional[List[str]] = None, return_exceptions: bool = False,
+                           **kwargs) -> Dict[str, Any]:
+        """
+        Send the prompt to every model concurrently and wait for all of them.
+
+        Each answer is recorded like a generate_response call, under the same prompt_name with
+        its own model, in the order the models finish. The calls start from the same
+        conversation and do not extend the client's conversation.
+
+        Args:
+            return_exceptions: Put a failed model's exception in the result instead of raising
+                it (after all models have finished)
+            kwargs: Passed to generate_response (dependencies, response_model, retrieve, ...)
+
+        Returns:
+            model -> response, in the order of models
+
+        Raises:
+            ValueError: models is empty
+        """
+        models = self._fan_out_models(models)
+        conversation = self._fan_out_conversation()
+        logger.info("Fanning out '%s' to %s", Preview(prompt), models)
+
+        with ThreadPoolExecutor(max_workers=len(models), thread_name_prefix='ffai_fan_out') as executor:
+            futures = {
+                model: self._fan_out_submit(executor, prompt, model, conversation,
+                                            prompt_name=prompt_name, history=history, **kwargs)
+                for model in models
+            }
+            wait(futures.values())
+
+        results = {}
+        for model, future in futures.items():
+            error = future.exception()
+            if error is None:
+                results[model] = future.result()
+            elif return_exceptions:
+                results[model] = error
+            else:
+                raise error
+        return results
+
+    def generate_first_response(self, prompt: str, models: List[str], prompt_name: Optional[str] = None,
+                                history: Optional[List[str]] = None,
+                                accept: Optional[Callable[[str], bool]] = None,
+                                timeout: Optional[float] = None, **kwargs) -> Tuple[str, str]:
+        """
+        Send the prompt to every model concurrently and return the first acceptable answer.
+
+        The remaining calls are cancelled if they have not started. Calls already in flight
+        cannot be interrupted; they finish in the background, and since their tokens are spent,
+        their answers are still recorded.
+
+        Args:
+            accept: Whether a response is acceptable (default: any non-empty response)
+            timeout: Seconds to wait for an acceptable answer
+            kwargs: Passed to generate_response (dependencies, response_model, retrieve, ...)
+
+        Returns:
+            (model, response) of the first acceptable answer
+
+        Raises:
+            ValueError: models is empty
+            RuntimeError: No model gave an acceptable answer (in time)
+        """
+        models = self._fan_out_models(models)
+        accept = accept or (lambda response: bool(response and response.strip()))
+        conversation = self._fan_out_conversation()
+        logger.info("Racing '%s' across %s", Preview(prompt), models)
+
+        executor = ThreadPoolExecutor(max_workers=len(models), thread_name_prefix='ffai_fan_out')
+        futures = {
+            self._fan_out_submit(executor, prompt, model, conversation,
+                                 prompt_name=prompt_name, history=history, **kwargs): model
+            for model in models
+        }
+        rejected = {}
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                model = futures[future]
+                error = future.exception()
+                if error is None and accept(future.result()):
+                    logger.info("First acceptable answer from %s", model)
+                    return model, future.result()
+                rejected[model] = error or "response not accepted"
+        except FuturesTimeout:
+            raise RuntimeError(f"No acceptable answer within {timeout}s from {models}; rejected: {rejected}") from None
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        raise RuntimeError(f"No acceptable answer from {models}: {rejected}")
+
+    # ======================================================================================
+    # PROMPT PACKING -- many small named prompts in one request
+    # ======================================================================================
+    @staticmethod
+    def _packed_prompt(prompts: Dict[str, str]) -> str:
+        """One prompt asking for a JSON object with an answer per prompt name"""
+        keys = ', '.join(json.dumps(name) for name in prompts)
+        return ''.join((
+            "Answer each of the following prompts independently of the others.\n",
+            f"Reply with only a JSON object with exactly these keys: {keys}. ",
+            "The value of each key is the answer to the prompt with that key.\n",
+            "<prompts>\n",
+            json.dumps(prompts, indent=1, ensure_ascii=False),
+            "\n</prompts>"
+        ))
+
+    @staticmethod
+    def _packed_answers(response: str, names: List[str]) -> Dict[str, str]:
+        """The answers in a packed response, by prompt name; missing, null or unparsable answers are left out"""
+        parsed = parse_response(response) if response else None
+        if not isinstance(parsed, dict):
+            logger.warning("Packed response is not a JSON object: %s", Preview(response))
+            return {}
+
+        answers = {}
+        for name in names:
+            value = parsed.get(name)
+            if value is None:
+                continue
+            # structured answers are kept as JSON, so reading the history parses them back
+            answers[name] = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        return answers
+
+    def _generate_pack(self, prompts: Dict[str, str], used_model: str,
+                       history: Optional[List[str]]) -> Dict[str, str]:
+        """Send one packed request and record each answered prompt as its own interaction"""
+        packed_prompt = self._packed_prompt(prompts)
+        final_prompt = self._build_prompt(packed_prompt, history)
+
+        tracer = self.tracer
+        with (tracer.span('client_call', model=used_model, prompt_name=None) if tracer else NULL_SPAN) as span, \
+                (self.new_conversation() if self.stateless else nullcontext()):
+            response = self.client.generate_response(prompt=final_prompt, model=used_model)
+            usage = getattr(self.client, 'last_usage', None)
+            if self.stateless:
+                usage = self._with_context_savings(usage, final_prompt, response)
+            if tracer:
+                span.set(packed_prompts=len(prompts),
+                         prompt_tokens=usage.get('prompt_tokens') if usage else None,
+                         completion_tokens=usage.get('completion_tokens') if usage else None)
+
+        answers = self._packed_answers(response, list(prompts))
+        logger.info("Packed request answered %d of %d prompts", len(answers), len(prompts))
+        if not answers:
+            return answers
+
+        # the request's tokens are divided among the answers, so per-name and per-model totals add up
+        shares = split_usage(usage, [len(prompts[name]) for name in answers],
+                             [len(answer) for answer in answers.values()])
+        for (name, answer), share in zip(answers.items(), shares):
+            self._record_interaction(prompts[name], answer, used_model, name, history, share)
+        return answers
+
+    def generate_packed_responses(self, prompts: Dict[str, str], model: Optional[str] = None,
+                                  history: Optional[List[str]] = None,
+                                  pack_size: Optional[int] = None) -> Dict[str, str]:
+        """
+        Answer many short, independent prompts with a few requests instead of one each.
+
+        Up to pack_size prompts go in one request that asks for a JSON object keyed by their
+        prompt names. Each answer is recorded as its own interaction under its prompt name, with
+        the prompt and its share of the request's tokens, so later prompts can use it as
+        history. Prompts whose key is missing from the reply are sent again on their own.
+
+        Args:
+            prompts: prompt_name -> prompt
+            history: prompt_names whose latest interactions are included, once per request
+            pack_size: Most prompts per request (default FFAI_PACK_SIZE or 20)
+
+        Returns:
+            prompt_name -> response, in the order of prompts
+        """
+        if any(not isinstance(name, str) for name in prompts):
+            raise ValueError("Packed prompts need string prompt names (they become JSON keys)")
+        pack_size = pack_size or DEFAULT_PACK_SIZE
+        used_model = model if model else self.client.model
+        names = list(prompts)
+        logger.info("Packing %d prompts into requests of up to %d", len(names), pack_size)
+
+        responses = {}
+        for start in range(0, len(names), pack_size):
+            pack = {name: prompts[name] for name in names[start:start + pack_size]}
+            if len(pack) > 1:
+                responses.update(self._generate_pack(pack, used_model, history))
+
+        missing = [name for name in names if name not in responses]
+        if missing:
+            logger.info("Sending %d unanswered prompts individually: %s", len(missing), missing)
+        for name in missing:
+            responses[name] = self.generate_response(prompts[name], model=used_model,
+                                                     prompt_name=name, history=history)
+
+        return {name: responses[name] for name in names}
+
+    def add_trace_hook(self, hook: TraceHook) -> None:
+        """Attach a tracing hook, enabling tracing if it was off"""
+        if self.tracer is None:
+            self.tracer = Tracer()
+        self.tracer.add_hook(hook)
 
     def clear_conversation(self):
         """Clear conversation in client but retain history"""
         self.client.clear_conversation()
+        with self._lock:
+            self._stateful_conversation_chars.set(0)
+
+    # ======================================================================================
+    # STATE -- save and restore the histories (e.g. for SessionManager)
+    # ======================================================================================
+    _STATE_FIELDS = ('history', '_clean_history', '_prompt_attr_history', 'permanent_history',
+                     'ordered_history', 'clean_ordered_history', 'named_prompt_ordered_history', 'blob_store')
+
+    def export_state(self) -> Dict[str, Any]:
+        """
+        The histories as a picklable dict. The client, tracing hooks and caches are not included.
+        Pending responses are parsed first, so the state holds no unparsed entries.
+        """
+        with self._lock:
+            self._materialize_pending()
+            return {field: getattr(self, field) for field in self._STATE_FIELDS}
+
+    def load_state(self, state: Dict[str, Any]) -> None:
+        """Replace the histories with a state from export_state(); the current price table is kept"""
+        with self._lock:
+            price_table = self.ordered_history.price_table
+            for field in self._STATE_FIELDS:
+                setattr(self, field, state[field])
+            self.ordered_history.price_table = price_table
+            self._pending_clean = []
+
+            # the _build_prompt index and blocks describe the replaced lists
+            self._attr_index = {}
+            self._attr_indexed_list = None
+            self._attr_indexed_count = 0
+            self._rendered_blocks = {}
+            self._relevance_index = None
+            self._relevance_indexed_list = None
 
     def get_interaction_history(self) -> List[Dict[str, Any]]:
         """Get complete history"""
@@ -311,10 +986,25 @@ class FFAI_AzureOpenAI:
     
     def get_model_usage_stats(self) -> Dict[str, int]:
         """Get statistics on model usage"""
-        usage_stats = {}
-        for interaction in self.ordered_history.get_all_interactions():
-            usage_stats[interaction.model] = usage_stats.get(interaction.model, 0) + 1
-        return usage_stats
+        return self.ordered_history.get_model_usage_stats()
+
+    def get_token_usage_by_model(self) -> Dict[str, Dict[str, Any]]:
+        """Get token totals, latency percentiles and estimated cost per model"""
+        return self.ordered_history.get_token_usage_by_model()
+
+    def get_token_usage_by_prompt_name(self) -> Dict[str, Dict[str, Any]]:
+        """Get token totals, latency percentiles and estimated cost per prompt name"""
+        return self.ordered_history.get_token_usage_by_prompt_name()
+
+    def get_latency_percentiles(self, percentiles: List[float] = (50, 90, 99),
+                                model: Optional[str] = None,
+                                prompt_name: Optional[str] = None) -> Dict[float, Optional[float]]:
+        """Get latency percentiles (seconds), optionally for one model or prompt name"""
+        return self.ordered_history.get_latency_percentiles(percentiles, model=model, prompt_name=prompt_name)
+
+    def get_estimated_cost(self) -> float:
+        """Get the estimated total cost of all interactions from the price table"""
+        return self.ordered_history.get_estimated_cost()
 
     def get_prompt_name_usage_stats(self) -> Dict[str, int]:
         """Get statistics on prompt name usage"""
@@ -2,65 +2,131 @@
 # Licensed under the MIT License. See LICENSE in the project root for license information.
 
 import os
+import re
+import json
 import time
+import hashlib
+import inspect
 import logging
-from typing import Optional, List
-from anthropic import Anthropic
+from typing import Optional, List, Dict, Any, Iterator, Set, Callable
+from anthropic import Anthropic, DefaultHttpxClient
+from anthropic.resources.messages import Messages
 from dotenv import load_dotenv
 
+from .UsageStats import usage_from_anthropic
+from .Diagnostics import Preview, MessagesPreview
+from .StructuredOutput import resolve_structured_output, anthropic_tool_response
+from .Cassette import cassette_http_client
+
 load_dotenv()
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Message Batches API limits (per batch)
+BATCH_MAX_REQUESTS = 100_000
+BATCH_MAX_BYTES = 256 * 1024 * 1024
+BATCH_CUSTOM_ID_PATTERN = re.compile(r'^[a-zA-Z0-9_-]{1,64}$')
+
+# errors that will not succeed on a retry
+BATCH_NON_RETRYABLE_ERRORS = {'invalid_request_error', 'authentication_error', 'permission_error', 'not_found_error'}
+
+
+def batch_prompts_digest(prompts: Dict[str, str]) -> str:
+    """Identifies the prompts of a generate_batch run, so a state file is only resumed by the same run"""
+    return hashlib.sha1(json.dumps(prompts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# DEFAULT VALUES, shared by FFAnthropic, FFAnthropicCached and their async versions
+DEFAULT_MAX_MODEL = 'max-tokens-3-5-sonnet-2024-07-15'
+DEFAULTS = {
+    'model': "claude-3-5-sonnet-20240620",
+    'max_tokens': 2000,
+    'max_model_max_tokens': 8192,
+    'temperature': 0.5,
+    'instructions': "Respond accurately to user queries. Never start with a preamble, such as 'The provided JSON data structure has been reordered and formatted as valid'. Immediately address the ask or request. Do not add meta information about your response. If there's nothing to do, answer with ''"
+}
+
+
+def apply_anthropic_config(client: Any, config: Optional[dict], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Set the settings every Anthropic client takes (api_key, model, temperature, max_tokens,
+    max_model, system_instructions and the cassette options) on client, so the sync and
+    async clients read a config the same way. Returns the combined config, for the keys only
+    some clients take.
+    """
+    # Combine config and kwargs, with kwargs taking precedence
+    all_config = {**(config or {}), **kwargs}
+
+    for key, value in all_config.items():
+        match key:
+            case 'api_key':
+                client.api_key = value or os.getenv('ANTHROPIC_TOKEN')
+            case 'model':
+                client.model = value
+            case 'temperature':
+                client.temperature = float(value)
+            case 'max_model' | 'use_max_model':
+                if value:
+                    # max_model names the beta; max_model=True or use_max_model uses ANTHROPIC_MAX_MODEL
+                    max_model = all_config.get('max_model')
+                    client.max_model = max_model if isinstance(max_model, str) else os.getenv('ANTHROPIC_MAX_MODEL', DEFAULT_MAX_MODEL)
+                    client.max_tokens = int(all_config.get('max_model_max_tokens') or DEFAULTS['max_model_max_tokens'])
+            case 'max_tokens':
+                if not hasattr(client, 'max_tokens'):
+                    client.max_tokens = int(value)
+            case 'system_instructions':
+                client.system_instructions = value
+            case 'cassette':
+                client.cassette = value
+            case 'cassette_mode':
+                client.cassette_mode = value
+            case 'replay_latency':
+                client.replay_latency = bool(value)
+
+    # Set default values if not set
+    client.api_key = getattr(client, 'api_key', os.getenv('ANTHROPIC_TOKEN'))
+    client.model = getattr(client, 'model', os.getenv('ANTHROPIC_MODEL', DEFAULTS['model']))
+    client.temperature = getattr(client, 'temperature', float(os.getenv('ANTHROPIC_TEMPERATURE', DEFAULTS['temperature'])))
+    client.max_tokens = getattr(client, 'max_tokens', int(os.getenv('ANTHROPIC_MAX_TOKENS', DEFAULTS['max_tokens'])))
+    client.system_instructions = getattr(client, 'system_instructions', os.getenv('ANTHROPIC_ASSISTANT_INSTRUCTIONS', DEFAULTS['instructions']))
+    client.max_model = getattr(client, 'max_model', None)
+    # record/replay (see Cassette); unset, the FFAI_CASSETTE* environment variables apply
+    client.cassette = getattr(client, 'cassette', None)
+    client.cassette_mode = getattr(client, 'cassette_mode', None)
+    client.replay_latency = getattr(client, 'replay_latency', None)
+    return all_config
+
+
+# some anthropic SDK releases have no temperature argument on messages.create; the API still
+# takes temperature in the request body
+_CREATE_TAKES_TEMPERATURE = 'temperature' in inspect.signature(Messages.create).parameters
+
+
+def temperature_args(temperature: float) -> Dict[str, Any]:
+    """The messages.create arguments that send temperature, whichever anthropic SDK is installed"""
+    if _CREATE_TAKES_TEMPERATURE:
+        return {'temperature': temperature}
+    return {'extra_body': {'temperature': temperature}}
+
+
+def message_text(message: Any) -> Optional[str]:
+    """The text of a Messages API answer (its first text block), or None if it has none"""
+    return next((block.text for block in message.content if getattr(block, 'type', None) == 'text'), None)
+
+
 class FFAnthropic:
     def __init__(self, config: Optional[dict] = None, **kwargs):
         logger.info("Initializing FFAnthropic")
-
-        # DEFAULT VALUES
-        default_max_model = 'max-tokens-3-5-sonnet-2024-07-15'
-        defaults = {
-            'model': "claude-3-5-sonnet-20240620",
-            'max_tokens': 2000,
-            'max_model_max_tokens': 8192,
-            'temperature': 0.5,
-            'instructions': "Respond accurately to user queries. Never start with a preamble, such as 'The provided JSON data structure has been reordered and formatted as valid'. Immediately address the ask or request. Do not add meta information about your response. If there's nothing to do, answer with ''"
-        }
-
-        # Combine config and kwargs, with kwargs taking precedence
-        all_config = {**(config or {}), **kwargs}
-
-        for key, value in all_config.items():
-            match key:
-                case 'api_key':
-                    self.api_key = value or os.getenv('ANTHROPIC_TOKEN')
-                case 'model':
-                    self.model = value
-                case 'temperature':
-                    self.temperature = float(value)
-                case 'max_model' | 'use_max_model':
-                    if value:
-                        self.max_model = all_config.get('max_model', default_max_model) or os.getenv('ANTHROPIC_MAX_MODEL', default_max_model)
-                        self.max_tokens = int(all_config.get('max_model_max_tokens'))
-                case 'max_tokens':
-                    if not hasattr(self, 'max_tokens'):
-                        self.max_tokens = int(value)
-                case 'system_instructions':
-                    self.system_instructions = value
-
-        # Set default values if not set
-        self.api_key = getattr(self, 'api_key', os.getenv('ANTHROPIC_TOKEN'))
-        self.model = getattr(self, 'model', os.getenv('ANTHROPIC_MODEL', defaults['model']))
-        self.temperature = getattr(self, 'temperature', float(os.getenv('ANTHROPIC_TEMPERATURE', defaults['temperature'])))
-        self.max_tokens = getattr(self, 'max_tokens', int(os.getenv('ANTHROPIC_MAX_TOKENS', defaults['max_tokens'])))
-        self.system_instructions = getattr(self, 'system_instructions', os.getenv('ANTHROPIC_ASSISTANT_INSTRUCTIONS', defaults['instructions']))
-        self.max_model = getattr(self, 'max_model', None)
+        apply_anthropic_config(self, config, kwargs)
 
         logger.debug(f"Model: {self.model}, Temperature: {self.temperature}, Max Tokens: {self.max_tokens}")
         logger.debug(f"System instructions: {self.system_instructions}")
         logger.debug(f"Max model: {self.max_model}")
 
         self.conversation_history = []
+        # usage and timing of the most recent call (see UsageStats)
+        self.last_usage = None
         self.client: Anthropic = self._initialize_client()
              
     def _initialize_client(self) -> Anthropic:
@@ -70,50 +136,295 @@ class FFAnthropic:
             logger.error("API key not found")
             raise ValueError("API key not found")
         
-        return Anthropic(api_key=api_key)
+        return Anthropic(api_key=api_key,
+                         http_client=cassette_http_client(DefaultHttpxClient, self.cassette, self.cassette_mode, self.replay_latency))
+
+    def generate_response(self, prompt: str, response_format: Optional[Any] = None) -> str:
+        """
+        Args:
+            prompt: The user prompt
+            response_format: Optional StructuredOutput or Pydantic model. Claude is forced to answer
+                through a tool with that schema, and the tool input is returned as JSON text.
+        """
+        logger.debug("Generating response for prompt: %s", Preview(prompt))
 
-    def generate_response(self, prompt: str) -> str:
-        logger.debug(f"Generating response for prompt: {prompt}")
+        extra_args = {}
+        if response_format:
+            structured = resolve_structured_output(response_format)
+            if structured is None:
+                raise ValueError("response_format must be a StructuredOutput or a Pydantic model")
+            extra_args = {'tools': [structured.anthropic_tool()], 'tool_choice': structured.anthropic_tool_choice()}
 
         try:
             self.conversation_history.append({"role": "user", "content": prompt})
             
+            start_time = time.perf_counter()
             if self.max_model:
-                logger.info(f"Using max model: {self.max_model}")
+                logger.info("Using max model: %s", self.max_model)
                 response = self.client.messages.create(
                     model=self.model,
                     max_tokens=self.max_tokens,
-                    temperature=self.temperature,
                     system=self.system_instructions,
                     messages=self.conversation_history,
-                    extra_headers={"anthropic-beta": self.max_model}
+                    extra_headers={"anthropic-beta": self.max_model},
+                    **temperature_args(self.temperature),
+                    **extra_args
                 )
             else:
                 response = self.client.messages.create(
                     model=self.model,
                     max_tokens=self.max_tokens,
-                    temperature=self.temperature,
                     system=self.system_instructions,
-                    messages=self.conversation_history
+                    messages=self.conversation_history,
+                    **temperature_args(self.temperature),
+                    **extra_args
                 )                
+            self.last_usage = usage_from_anthropic(response, time.perf_counter() - start_time)
             
-            assistant_response = response.content[0].text
+            if extra_args:
+                assistant_response = anthropic_tool_response(response)
+            else:
+                assistant_response = response.content[0].text
             self.conversation_history.append({"role": "assistant", "content": assistant_response})
             
             logger.info("Response generated successfully")
             return assistant_response
         except Exception as e:
             logger.error("Problem with response generation")
-            logger.error(f"  -- exception: {str(e)}")
-            logger.error(f"  -- model: {self.model}")
-            logger.error(f"  -- system: {self.system_instructions}")
-            logger.error(f"  -- conversation history: {self.conversation_history}")
-            logger.error(f"  -- max_model: {self.max_model}")
-            logger.error(f"  -- max_tokens: {self.max_tokens}")
-            logger.error(f"  -- temperature: {self.temperature}")
+            logger.error("  -- exception: %s", e)
+            logger.error("  -- model: %s", self.model)
+            logger.error("  -- system: %s", Preview(self.system_instructions))
+            logger.error("  -- conversation history: %s", MessagesPreview(self.conversation_history))
+            logger.error("  -- max_model: %s", self.max_model)
+            logger.error("  -- max_tokens: %s", self.max_tokens)
+            logger.error("  -- temperature: %s", self.temperature)
             
             raise RuntimeError(f"Error generating response from Claude: {str(e)}")
 
     def clear_conversation(self):
         logger.info("Clearing conversation history")
-        self.conversation_history = []
\ No newline at end of file
+        self.conversation_history = []
+
+    # ==================================================================================
+    # MESSAGE BATCHES
+    # ==================================================================================
+    def _batch_params(self, prompt: str) -> Dict[str, Any]:
+        """Build the Messages API params for one independent (history-free) batch request"""
+        return {
+            'model': self.model,
+            'max_tokens': self.max_tokens,
+            'temperature': self.temperature,
+            'system': self.system_instructions,
+            'messages': [{"role": "user", "content": prompt}]
+        }
+
+    def _chunk_batch_requests(self, prompts: Dict[str, str]) -> List[List[Dict[str, Any]]]:
+        """Split prompts into batches that respect the request count and payload size limits"""
+        chunks = []
+        current = []
+        current_bytes = 0
+
+        for custom_id, prompt in prompts.items():
+            if not BATCH_CUSTOM_ID_PATTERN.match(custom_id):
+                raise ValueError(f"Invalid batch custom_id '{custom_id}': use 1-64 characters of [a-zA-Z0-9_-]")
+
+            request = {'custom_id': custom_id, 'params': self._batch_params(prompt)}
+            request_bytes = len(json.dumps(request).encode('utf-8'))
+
+            if current and (len(current) >= BATCH_MAX_REQUESTS or current_bytes + request_bytes > BATCH_MAX_BYTES):
+                chunks.append(current)
+                current = []
+                current_bytes = 0
+
+            current.append(request)
+            current_bytes += request_bytes
+
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def submit_batch(self, prompts: Dict[str, str],
+                     on_submitted: Optional[Callable[[str, List[str]], None]] = None) -> List[str]:
+        """
+        Submit independent prompts to the Message Batches API.
+
+        Args:
+            prompts: Mapping of custom_id -> prompt text. Each prompt is sent without conversation history.
+            on_submitted: Called with (batch_id, custom_ids) as soon as each chunk is accepted, so
+                the batches created before a later chunk fails can still be persisted
+
+        Returns:
+            List of batch IDs, one per chunk. Persist these to resume with iter_batch_results().
+        """
+        batch_ids = []
+        extra_headers = {"anthropic-beta": self.max_model} if self.max_model else None
+
+        for chunk in self._chunk_batch_requests(prompts):
+            try:
+                batch = self.client.messages.batches.create(requests=chunk, extra_headers=extra_headers)
+            except Exception as e:
+                logger.error("Problem submitting message batch")
+                logger.error(f"  -- exception: {str(e)}")
+                logger.error(f"  -- submitted so far: {batch_ids}")
+                raise RuntimeError(f"Error submitting message batch to Claude: {str(e)}")
+
+            logger.info(f"Submitted message batch {batch.id} with {len(chunk)} requests")
+            batch_ids.append(batch.id)
+            if on_submitted:
+                on_submitted(batch.id, [request['custom_id'] for request in chunk])
+
+        return batch_ids
+
+    def iter_batch_results(self, batch_ids: List[str], poll_interval: float = 10.0,
+                           max_poll_interval: float = 300.0) -> Iterator[Dict[str, Any]]:
+        """
+        Poll batches until they end and stream their results as each one finishes.
+
+        Polling backs off exponentially from poll_interval up to max_poll_interval,
+        and only batches that are still processing are polled.
+
+        Yields:
+            Dicts with 'custom_id', 'status' ('succeeded', 'errored', 'canceled' or 'expired'),
+            'response' (text or None) and 'error' (error type or None)
+        """
+        pending = list(batch_ids)
+        interval = poll_interval
+
+        while pending:
+            still_pending = []
+            for batch_id in pending:
+                batch = self.client.messages.batches.retrieve(batch_id)
+                if batch.processing_status != 'ended':
+                    still_pending.append(batch_id)
+                    continue
+
+                logger.info(f"Message batch {batch_id} ended: {batch.request_counts}")
+                for entry in self.client.messages.batches.results(batch_id):
+                    yield self._batch_entry_to_result(entry)
+
+            if still_pending and len(still_pending) == len(pending):
+                logger.debug(f"Waiting {interval}s for {len(still_pending)} message batch(es)")
+                time.sleep(interval)
+                interval = min(interval * 2, max_poll_interval)
+            elif still_pending:
+                # something finished; check the rest again soon
+                interval = poll_interval
+            pending = still_pending
+
+    def _batch_entry_to_result(self, entry: Any) -> Dict[str, Any]:
+        result = entry.result
+        response = None
+        error = None
+
+        status = result.type
+        if status == 'succeeded':
+            response = message_text(result.message)
+            if response is None:
+                # e.g. stopped at max_tokens before any text
+                status = 'errored'
+                error = 'empty_response'
+        elif status == 'errored':
+            error_body = getattr(result.error, 'error', None)
+            error = getattr(error_body, 'type', None) or 'api_error'
+
+        return {
+            'custom_id': entry.custom_id,
+            'status': status,
+            'response': response,
+            'error': error
+        }
+
+    def _save_batch_state(self, state_path: str, prompts_digest: str, batch_ids: List[str], submitted: Set[str]) -> None:
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'prompts_digest': prompts_digest, 'batch_ids': batch_ids, 'submitted': sorted(submitted)}, f)
+        os.replace(tmp_path, state_path)
+
+    def generate_batch(self, prompts: Dict[str, str], state_path: Optional[str] = None,
+                       max_retries: int = 1, poll_interval: float = 10.0,
+                       max_poll_interval: float = 300.0) -> Iterator[Dict[str, Any]]:
+        """
+        Run independent prompts through the Message Batches API and stream back the results.
+
+        Batches are billed at a discount and are meant for throughput, not latency.
+        Errored (retryable) and expired requests are resubmitted up to max_retries times;
+        each custom_id is yielded exactly once with its final outcome.
+
+        Args:
+            prompts: Mapping of custom_id -> prompt text
+            state_path: Optional JSON file used to persist submitted batch IDs. If it already
+                exists, the run resumes from those batches instead of submitting again. It is
+                deleted once every result has been yielded; a file left by a run with other
+                prompts raises ValueError.
+            max_retries: Number of resubmission rounds for failed requests
+            poll_interval: Initial seconds between status polls
+            max_poll_interval: Upper bound for the poll backoff
+
+        Yields:
+            Result dicts as described in iter_batch_results()
+        """
+        prompts_digest = batch_prompts_digest(prompts)
+        batch_ids = []
+        submitted = set()
+        if state_path and os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            if state.get('prompts_digest') != prompts_digest:
+                raise ValueError(f"{state_path} belongs to a batch run with other prompts; delete it or use another state_path")
+            batch_ids = state.get('batch_ids', [])
+            submitted = set(state.get('submitted', []))
+            logger.info(f"Resuming message batches from {state_path}: {batch_ids}")
+
+        def saved(batch_id: str, custom_ids: List[str]) -> None:
+            # saved per chunk, so a resume never pays for a chunk that already went out
+            batch_ids.append(batch_id)
+            submitted.update(custom_ids)
+            if state_path:
+                self._save_batch_state(state_path, prompts_digest, batch_ids, submitted)
+
+        def submit(requests: Dict[str, str]) -> List[str]:
+            return self.submit_batch(requests, on_submitted=saved)
+
+        remaining = dict(prompts)
+        current_ids = list(batch_ids)
+        # prompts never submitted (a new run, or one interrupted while submitting) are not retries
+        unsubmitted = {cid: p for cid, p in remaining.items() if cid not in submitted}
+        if unsubmitted:
+            current_ids += submit(unsubmitted)
+
+        attempt = 0
+        while current_ids:
+            failed = {}
+            for result in self.iter_batch_results(current_ids, poll_interval, max_poll_interval):
+                custom_id = result['custom_id']
+                if custom_id not in remaining:
+                    # already delivered by an earlier batch
+                    continue
+
+                retryable = (result['status'] == 'expired' or
+                             (result['status'] == 'errored' and result['error'] not in BATCH_NON_RETRYABLE_ERRORS))
+                if retryable and attempt < max_retries:
+                    failed[custom_id] = remaining[custom_id]
+                    continue
+
+                # a later batch in a resumed run may have retried it already
+                failed.pop(custom_id, None)
+                del remaining[custom_id]
+                yield result
+
+            # submitted requests that no result came back for
+            missing = {cid: p for cid, p in remaining.items() if cid not in failed}
+            retry = {**failed, **missing} if attempt < max_retries else {}
+            if not retry:
+                break
+
+            attempt += 1
+            logger.warning(f"Resubmitting {len(retry)} failed batch request(s), attempt {attempt}/{max_retries}")
+            current_ids = submit(retry)
+
+        for custom_id in remaining:
+            yield {'custom_id': custom_id, 'status': 'errored', 'response': None, 'error': 'not_processed'}
+
+        # every result is delivered; a later run with this state_path starts afresh
+        if state_path and os.path.exists(state_path):
+            os.remove(state_path)
@@ -1,51 +1,46 @@
 # Copyright (c) 2024 Antonio Quinonez
 # Licensed under the MIT License. See LICENSE in the project root for license information.
 
-import os
 import time
 import logging
-from typing import Optional, List
-from anthropic import Anthropic
+from typing import Optional, List, Any
+from anthropic import Anthropic, DefaultHttpxClient
 from dotenv import load_dotenv
 
+from .UsageStats import usage_from_anthropic
+from .Diagnostics import Preview, MessagesPreview
+from .StructuredOutput import resolve_structured_output, anthropic_tool_response
+from .Cassette import cassette_http_client
+from .FFAnthropic import apply_anthropic_config, temperature_args
+
 load_dotenv()
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-class FFAnthropicCached:
-    def __init__(self, config: Optional[dict] = None, **kwargs):
-        logger.info("Initializing FFAnthropicCached")
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
 
-        # DEFAULT VALUES
-        default_model = "claude-3-5-sonnet-20240620"
-        default_max_tokens = 2000       
-        default_temperature = 0.5
-        
-        default_instructions = "Respond accurately to user queries. Never start with a preamble, such as 'The provided JSON data structure has been reordered and formatted as valid'. Immediately address the ask or request. Do not add meta information about your response. If there's nothing to do, answer with ''"
 
-        # Combine config and kwargs, with kwargs taking precedence
-        all_config = {**(config or {}), **kwargs}
+def cached_betas(max_model: Optional[str]) -> str:
+    """The anthropic-beta header of a cached request: prompt caching, plus the max_model beta when set"""
+    return PROMPT_CACHING_BETA + (f",{max_model}" if max_model else "")
 
-        # GET API KEY
-        self.api_key = all_config.get('api_key', os.getenv('ANTHROPIC_TOKEN')) if all_config else os.getenv('ANTHROPIC_TOKEN')
 
-        # SET MODEL
-        self.model = all_config.get('model', default_model) if all_config else os.getenv('ANTHROPIC_MODEL', default_model)
-        
-        #SET MAX TOKENS
-        self.max_tokens = int(all_config.get('max_tokens', default_max_tokens)) if all_config else int(os.getenv('ANTHROPIC_MAX_TOKENS', default_max_tokens))
+class FFAnthropicCached:
+    def __init__(self, config: Optional[dict] = None, **kwargs):
+        logger.info("Initializing FFAnthropicCached")
 
-        # SET TEMPERATURE
-        self.temperature = float(all_config.get('temperature', default_temperature)) if all_config else float(os.getenv('ANTHROPIC_TEMPERATURE', default_temperature))
+        apply_anthropic_config(self, config, kwargs)
 
-        self.system_instructions = config.get('system_instructions', default_instructions) if config else os.getenv('ANTHROPIC_ASSISTANT_INSTRUCTIONS', default_instructions)
         self.conversation_history = ConversationHistory()
+        # usage and timing of the most recent call (see UsageStats)
+        self.last_usage = None
              
         self.client: Anthropic = self._initialize_client()
 
         logger.debug(f"Model: {self.model}, Temperature: {self.temperature}, Max Tokens: {self.max_tokens}")
         logger.debug(f"System instructions: {self.system_instructions}")
+        logger.debug(f"Max model: {self.max_model}")
     
     def _initialize_client(self) -> Anthropic:
         logger.info("Initializing Anthropic client")
@@ -53,10 +48,26 @@ class FFAnthropicCached:
         if not api_key:
             logger.error("API key not found")
             raise ValueError("API key not found")
-        return Anthropic(api_key=api_key)
+        return Anthropic(api_key=api_key,
+                         http_client=cassette_http_client(DefaultHttpxClient, self.cassette, self.cassette_mode, self.replay_latency))
+
+    def generate_response(self, prompt: str, response_format: Optional[Any] = None) -> str:
+        """
+        Args:
+            prompt: The user prompt
+            response_format: Optional StructuredOutput or Pydantic model. Claude is forced to answer
+                through a tool with that schema, and the tool input is returned as JSON text.
+                The tool definition sits ahead of the system prompt, so it is cached with it.
+        """
+        logger.debug("Generating response for prompt: %s", Preview(prompt))
+
+        extra_args = {}
+        if response_format:
+            structured = resolve_structured_output(response_format)
+            if structured is None:
+                raise ValueError("response_format must be a StructuredOutput or a Pydantic model")
+            extra_args = {'tools': [structured.anthropic_tool()], 'tool_choice': structured.anthropic_tool_choice()}
 
-    def generate_response(self, prompt: str) -> str:
-        logger.debug(f"Generating response for prompt: {prompt}")
         try: 
             self.conversation_history.add_turn_user(prompt)
 
@@ -65,32 +76,38 @@ class FFAnthropicCached:
                 logger.error("Conversation history is empty")
                 raise ValueError("Conversation history is empty")
 
+            start_time = time.perf_counter()
             response = self.client.messages.create(
                 model=self.model,
                 max_tokens=self.max_tokens,
-                temperature=self.temperature,
                 system=[{
                     "type": "text",
                     "text": self.system_instructions,
                     "cache_control": {"type": "ephemeral"}
                 }],
                 messages=turns,
-                extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
+                extra_headers={"anthropic-beta": cached_betas(self.max_model)},
+                **temperature_args(self.temperature),
+                **extra_args
             )
+            self.last_usage = usage_from_anthropic(response, time.perf_counter() - start_time)
 
-            assistant_response = response.content[0].text
+            if extra_args:
+                assistant_response = anthropic_tool_response(response)
+            else:
+                assistant_response = response.content[0].text
             self.conversation_history.add_turn_assistant(assistant_response)
             
             logger.info("Response generated successfully")
             return assistant_response
         except Exception as e:
             logger.error("Problem with response generation")
-            logger.error(f"  -- exception: {str(e)}")
-            logger.error(f"  -- model: {self.model}")
-            logger.error(f"  -- system: {self.system_instructions}")
-            logger.error(f"  -- conversation history: {self.conversation_history.get_turns()}")
-            logger.error(f"  -- max_tokens: {self.max_tokens}")
-            logger.error(f"  -- temperature: {self.temperature}")
+            logger.error("  -- exception: %s", e)
+            logger.error("  -- model: %s", self.model)
+            logger.error("  -- system: %s", Preview(self.system_instructions))
+            logger.error("  -- conversation history: %s", MessagesPreview(self.conversation_history.turns))
+            logger.error("  -- max_tokens: %s", self.max_tokens)
+            logger.error("  -- temperature: %s", self.temperature)
             
             raise RuntimeError(f"Error generating response from Claude: {str(e)}")
 
@@ -0,0 +1,150 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+import time
+import logging
+from typing import Optional, Dict, Any, AsyncIterator
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+from dotenv import load_dotenv
+
+from .UsageStats import usage_from_anthropic
+from .Diagnostics import Preview, MessagesPreview
+from .StructuredOutput import resolve_structured_output, anthropic_tool_response
+from .Cassette import cassette_http_client
+from .FFAnthropic import apply_anthropic_config, message_text, temperature_args
+from .FFAnthropicCached import ConversationHistory, cached_betas
+from .FFAnthropicAsync import DEFAULT_MAX_CONCURRENCY
+from .AsyncBatch import batch_request, run_bounded
+
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class FFAnthropicCachedAsync:
+    """
+    FFAnthropicCached on AsyncAnthropic: the system instructions are cached, calls are
+    awaitable, and generate_batch sends independent prompts concurrently. The batch
+    requests share the cached system prompt, so after the first one they read it from
+    the cache.
+
+    generate_response() keeps one conversation, so await its calls one after another.
+    """
+
+    def __init__(self, config: Optional[dict] = None, **kwargs):
+        logger.info("Initializing FFAnthropicCachedAsync")
+
+        all_config = apply_anthropic_config(self, config, kwargs)
+        self.max_concurrency = int(all_config.get('max_concurrency', DEFAULT_MAX_CONCURRENCY))
+
+        self.conversation_history = ConversationHistory()
+        # usage and timing of the most recent call (see UsageStats)
+        self.last_usage = None
+
+        self.client: AsyncAnthropic = self._initialize_client()
+
+        logger.debug(f"Model: {self.model}, Temperature: {self.temperature}, Max Tokens: {self.max_tokens}")
+        logger.debug(f"System instructions: {self.system_instructions}")
+        logger.debug(f"Max model: {self.max_model}")
+
+    def _initialize_client(self) -> AsyncAnthropic:
+        logger.info("Initializing AsyncAnthropic client")
+        api_key = self.api_key
+        if not api_key:
+            logger.error("API key not found")
+            raise ValueError("API key not found")
+        return AsyncAnthropic(api_key=api_key,
+                              http_client=cassette_http_client(DefaultAsyncHttpxClient, self.cassette, self.cassette_mode, self.replay_latency))
+
+    def _message_params(self, messages: Any, extra_args: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'model': self.model,
+            'max_tokens': self.max_tokens,
+            'system': [{
+                "type": "text",
+                "text": self.system_instructions,
+                "cache_control": {"type": "ephemeral"}
+            }],
+            'messages': messages,
+            'extra_headers': {"anthropic-beta": cached_betas(self.max_model)},
+            **temperature_args(self.temperature),
+            **extra_args
+        }
+
+    async def generate_response(self, prompt: str, response_format: Optional[Any] = None) -> str:
+        """
+        Args:
+            prompt: The user prompt
+            response_format: Optional StructuredOutput or Pydantic model. Claude is forced to answer
+                through a tool with that schema, and the tool input is returned as JSON text.
+                The tool definition sits ahead of the system prompt, so it is cached with it.
+        """
+        logger.debug("Generating response for prompt: %s", Preview(prompt))
+
+        extra_args = {}
+        if response_format:
+            structured = resolve_structured_output(response_format)
+            if structured is None:
+                raise ValueError("response_format must be a StructuredOutput or a Pydantic model")
+            extra_args = {'tools': [structured.anthropic_tool()], 'tool_choice': structured.anthropic_tool_choice()}
+
+        try:
+            self.conversation_history.add_turn_user(prompt)
+
+            turns = self.conversation_history.get_turns()
+            if not turns:
+                logger.error("Conversation history is empty")
+                raise ValueError("Conversation history is empty")
+
+            start_time = time.perf_counter()
+            response = await self.client.messages.create(**self._message_params(turns, extra_args))
+            self.last_usage = usage_from_anthropic(response, time.perf_counter() - start_time)
+
+            if extra_args:
+                assistant_response = anthropic_tool_response(response)
+            else:
+                assistant_response = response.content[0].text
+            self.conversation_history.add_turn_assistant(assistant_response)
+
+            logger.info("Response generated successfully")
+            return assistant_response
+        except Exception as e:
+            logger.error("Problem with response generation")
+            logger.error("  -- exception: %s", e)
+            logger.error("  -- model: %s", self.model)
+            logger.error("  -- system: %s", Preview(self.system_instructions))
+            logger.error("  -- conversation history: %s", MessagesPreview(self.conversation_history.turns))
+            logger.error("  -- max_model: %s", self.max_model)
+            logger.error("  -- max_tokens: %s", self.max_tokens)
+            logger.error("  -- temperature: %s", self.temperature)
+
+            raise RuntimeError(f"Error generating response from Claude: {str(e)}")
+
+    def clear_conversation(self):
+        logger.info("Clearing conversation history")
+        self.conversation_history = ConversationHistory()
+
+    async def aclose(self) -> None:
+        """Close the client's connection pool"""
+        await self.client.close()
+
+    # ==================================================================================
+    # CONCURRENT BATCH
+    # ==================================================================================
+    async def _batch_request(self, custom_id: str, prompt: str) -> Dict[str, Any]:
+        """One independent (history-free) request of generate_batch"""
+        messages = [{"role": "user", "content": [{"type": "text", "text": prompt}]}]
+        params = self._message_params(messages, {})
+        return await batch_request(custom_id, lambda: self.client.messages.create(**params),
+                                   message_text, usage_from_anthropic)
+
+    async def generate_batch(self, prompts: Dict[str, str],
+                             max_concurrency: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Send independent prompts, at most max_concurrency at a time, and yield the results as
+        they finish. See FFAnthropicAsync.generate_batch.
+        """
+        logger.info("Sending %d batch requests, at most %d at a time", len(prompts), max_concurrency or self.max_concurrency)
+        async for result in run_bounded(prompts, self._batch_request, max_concurrency or self.max_concurrency):
+            yield result
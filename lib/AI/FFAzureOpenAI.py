@@ -4,11 +4,17 @@
 import os
 import time
 import logging
-from typing import Optional
+from typing import Optional, Any, List, Dict
 # from openai import OpenAI
-from openai import AzureOpenAI
+from openai import AzureOpenAI, DefaultHttpxClient
 from dotenv import load_dotenv
 
+from .UsageStats import usage_from_openai
+from .Diagnostics import Preview, MessagesPreview
+from .StructuredOutput import openai_response_format
+from .ConversationContext import ConversationContexts, CallLocal
+from .Cassette import cassette_http_client
+
 load_dotenv()
 
 # Configure logging
@@ -26,6 +32,7 @@ class FFAzureOpenAI:
             'max_tokens': 4000,
             'max_completion_tokens': 8000,
             'temperature': 0.5,
+            'conversation_scope': 'shared',
             'instructions': "Respond accurately to user queries. Never start with a preamble. Immediately address the ask or request. Do not add meta information about your response. If there's nothing to do, answer with ''"
         }
 
@@ -50,6 +57,14 @@ class FFAzureOpenAI:
                     self.max_completion_tokens = int(value)
                 case 'system_instructions':
                     self.system_instructions = value
+                case 'conversation_scope':
+                    self.conversation_scope = value
+                case 'cassette':
+                    self.cassette = value
+                case 'cassette_mode':
+                    self.cassette_mode = value
+                case 'replay_latency':
+                    self.replay_latency = bool(value)
 
         # Set default values if not set
         self.api_key = getattr(self, 'api_key', os.getenv('AZUREOPENAI_TOKEN'))
@@ -83,9 +98,46 @@ class FFAzureOpenAI:
 
         logger.debug(f"System instructions: {self.system_instructions}")
 
-        self.conversation_history = []
+        # record/replay (see Cassette); unset, the FFAI_CASSETTE* environment variables apply
+        self.cassette = getattr(self, 'cassette', None)
+        self.cassette_mode = getattr(self, 'cassette_mode', None)
+        self.replay_latency = getattr(self, 'replay_latency', None)
+
+        # 'thread' or 'task' gives each worker thread / asyncio task its own conversation
+        self.conversation_scope = getattr(self, 'conversation_scope', os.getenv('AZUREOPENAI_CONVERSATION_SCOPE', self._defaults['conversation_scope']))
+        self._conversations = ConversationContexts(self.conversation_scope)
+
+        # usage and timing of the most recent call made from the current thread or task (see UsageStats)
+        self._last_usage = CallLocal()
         self.client: AzureOpenAI = self._initialize_client()
 
+    @property
+    def conversation_history(self) -> List[Dict[str, Any]]:
+        """The conversation of the current scope (see conversation_scope)"""
+        return self._conversations.messages
+
+    @conversation_history.setter
+    def conversation_history(self, value: List[Dict[str, Any]]) -> None:
+        self._conversations.messages = value
+
+    def use_conversation(self, messages: List[Dict[str, Any]]):
+        """
+        Context manager: calls made from the current thread/task inside the block read and
+        append to the given message list instead of the client's own conversation.
+
+            with client.use_conversation(session_messages):
+                client.generate_response(prompt)
+        """
+        return self._conversations.bind(messages)
+
+    @property
+    def last_usage(self) -> Optional[Dict[str, Any]]:
+        return self._last_usage.get()
+
+    @last_usage.setter
+    def last_usage(self, value: Optional[Dict[str, Any]]) -> None:
+        self._last_usage.set(value)
+
     def _initialize_client(self) -> AzureOpenAI:
         """Initialize and return the OpenAI client."""
         logger.info("Initializing Azure OpenAI client")
@@ -98,88 +150,100 @@ class FFAzureOpenAI:
         api_version = os.getenv('AZURE_API_VERSION') or '2024-08-01-preview'
         return AzureOpenAI( api_key=api_key, 
                             azure_endpoint=azure_endpoint,
-                            api_version = api_version
+                            api_version = api_version,
+                            http_client=cassette_http_client(DefaultHttpxClient, self.cassette, self.cassette_mode, self.replay_latency)
         )
 
 
     from inspect import signature
 
-    def generate_response(self, prompt: str, model: Optional[str] = None, is_o1: Optional[bool] = None, infer_o1:Optional[bool] = None, prompt_name: Optional[str] = None) -> str:
-        logger.debug(f"Generating response for prompt: {prompt}")
-        logger.debug("Method args")
-        logger.debug(locals())
+    def generate_response(self, prompt: str, model: Optional[str] = None, is_o1: Optional[bool] = None, infer_o1:Optional[bool] = None, prompt_name: Optional[str] = None, response_format: Optional[Any] = None) -> str:
+        logger.debug("Generating response for prompt: %s", Preview(prompt))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Method args")
+            logger.debug("model: %s | is_o1: %s | infer_o1: %s | prompt_name: %s", model, is_o1, infer_o1, prompt_name)
 
         method_is_o1 = is_o1
 
         # are we using the model and is_o1 from init or the one passed with the generate_response method?
         used_model = model if model else self.model
-        logger.debug(f"Using model: {used_model}")
+        logger.debug("Using model: %s", used_model)
 
         # if init is infer_o1, we use that else what the method call says -- init may set infer_o1 if set at that time
         infer_o1 = self.infer_o1 or infer_o1
-        logger.debug(f"Using infer_o1: {infer_o1}")
+        logger.debug("Using infer_o1: %s", infer_o1)
 
         # infer if o1 for method call with model arg
         if infer_o1 == True:
             if 'o1' in used_model:
                 is_o1 = True
-                logger.debug(f"Inference says model is an o1 model")
+                logger.debug("Inference says model is an o1 model")
             else:
                 is_o1 = False
-                logger.debug(f"Inference says model is not an o1 model")
+                logger.debug("Inference says model is not an o1 model")
         elif is_o1 == True:
-            logger.debug(f"Using is_o1 == True from method call") 
+            logger.debug("Using is_o1 == True from method call") 
         elif model and is_o1 == False:
-            logger.debug(f"Method says model is not an o1 model")
+            logger.debug("Method says model is not an o1 model")
         elif model == self.model:
             is_o1 = self.is_o1
-            logger.debug(f"Using is_o1 from self.is_o1 since models are the same from init and method call:")
-            logger.debug(f"Method call arg is_o1: {method_is_o1}| Init is_o1: {self.is_o1}")
-            logger.debug(f"Method model: {model}")
+            logger.debug("Using is_o1 from self.is_o1 since models are the same from init and method call:")
+            logger.debug("Method call arg is_o1: %s| Init is_o1: %s", method_is_o1, self.is_o1)
+            logger.debug("Method model: %s", model)
         else:
             is_o1 = False
-            logger.debug(f"DEFAULT for is_o1 = False")
+            logger.debug("DEFAULT for is_o1 = False")
 
+        # the conversation of this thread/task (or the shared one); bound once for the whole call
+        conversation_history = self.conversation_history
         try:
-            self.conversation_history.append({"role": "user", "content": prompt})
+            conversation_history.append({"role": "user", "content": prompt})
             
             messages = [
                 {
                     "role": "assistant" if is_o1 == True else "system",
                     "content": self.system_instructions,
                 },
-                *self.conversation_history
+                *conversation_history
             ]
 
+            # structured output: a StructuredOutput / Pydantic model, or a raw response_format dict
+            extra_args = {}
+            if response_format:
+                extra_args['response_format'] = openai_response_format(response_format)
+
             # DIFFERENT PROMPT COMPLETIONS DEPENDING ON IF o1 OR NOT
+            start_time = time.perf_counter()
             if is_o1 == True:
                 response = self.client.chat.completions.create(
                     model=used_model,
                     messages=messages,
-                    max_completion_tokens = getattr(self, 'max_completion_tokens', self._defaults['max_completion_tokens'])
+                    max_completion_tokens = getattr(self, 'max_completion_tokens', self._defaults['max_completion_tokens']),
+                    **extra_args
                 )
             else:
                 response = self.client.chat.completions.create(
                     model=used_model,
                     messages=messages,
                     max_tokens= getattr(self, 'max_tokens', self._defaults['max_tokens']),
-                    temperature=self.temperature
+                    temperature=self.temperature,
+                    **extra_args
                 )
             # ================================================================
-
+            self.last_usage = usage_from_openai(response, time.perf_counter() - start_time)
             
             assistant_response = response.choices[0].message.content
-            self.conversation_history.append({"role": "assistant", "content": assistant_response})
+            conversation_history.append({"role": "assistant", "content": assistant_response})
             
             logger.info("Response generated successfully")
             return assistant_response
         
         except Exception as e:
             logger.error("Problem with response generation")
-            logger.error(f"  -- exception: {str(e)}")
-            logger.error(f"  -- model: {used_model}")
-            logger.error(f"  -- system: {self.system_instructions}")
-            logger.error(f"  -- conversation history: {self.conversation_history}")
+            logger.error("  -- exception: %s", e)
+            logger.error("  -- model: %s", used_model)
+            logger.error("  -- system: %s", Preview(self.system_instructions))
+            logger.error("  -- conversation history: %s", MessagesPreview(conversation_history))
             
             raise RuntimeError(f"Error generating response from Azure OpenAI: {str(e)}")
 
@@ -5,12 +5,18 @@ import os
 import logging
 import subprocess
 import asyncio
-from typing import Optional, List
+import time
+from typing import Optional, List, Any
 from google.auth.transport import requests
 from google.oauth2 import credentials
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 import google.auth
 
+from .UsageStats import usage_from_openai
+from .Diagnostics import Preview, MessagesPreview
+from .StructuredOutput import openai_response_format
+from .Cassette import cassette_http_client
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
@@ -39,12 +45,22 @@ class FFGemini:
                     self.max_tokens = int(value)
                 case 'system_instructions':
                     self.system_instructions = value
+                case 'cassette':
+                    self.cassette = value
+                case 'cassette_mode':
+                    self.cassette_mode = value
+                case 'replay_latency':
+                    self.replay_latency = bool(value)
 
         # Set default values if not set
         self.model = getattr(self, 'model', os.getenv('GEMINI_MODEL_NAME', defaults['model']))
         self.temperature = getattr(self, 'temperature', float(os.getenv('GEMINI_TEMPERATURE', defaults['temperature'])))
         self.max_tokens = getattr(self, 'max_tokens', int(os.getenv('GEMINI_MAX_TOKENS', defaults['max_tokens'])))
         self.system_instructions = getattr(self, 'system_instructions', os.getenv('GEMINI_SYSTEM_INSTRUCTIONS', defaults['system_instructions']))
+        # record/replay (see Cassette); unset, the FFAI_CASSETTE* environment variables apply
+        self.cassette = getattr(self, 'cassette', None)
+        self.cassette_mode = getattr(self, 'cassette_mode', None)
+        self.replay_latency = getattr(self, 'replay_latency', None)
 
         logger.debug(f"Model: {self.model}, Temperature: {self.temperature}, Max Tokens: {self.max_tokens}")
         logger.debug(f"System instructions: {self.system_instructions}")
@@ -54,6 +70,8 @@ class FFGemini:
         self.refresh_token_if_needed()
 
         self.chat_history: List[dict] = []
+        # usage and timing of the most recent call (see UsageStats)
+        self.last_usage = None
         self.client: AsyncOpenAI = self._initialize_client()
         self._response_generated = False
 
@@ -73,7 +91,8 @@ class FFGemini:
         self.refresh_token_if_needed()  # Ensure token is valid before creating client
         return AsyncOpenAI(
             base_url=f'https://us-central1-aiplatform.googleapis.com/v1beta1/projects/{self.project}/locations/{self._get_region()}/endpoints/openapi',
-            api_key=self.creds.token
+            api_key=self.creds.token,
+            http_client=cassette_http_client(DefaultAsyncHttpxClient, self.cassette, self.cassette_mode, self.replay_latency)
         )
 
     def _get_region(self) -> str:
@@ -96,8 +115,8 @@ class FFGemini:
             logger.error(f"Error determining Google Cloud region using gcloud: {str(e)}")
             raise ValueError(f"Error determining Google Cloud region using gcloud: {str(e)}")
 
-    async def generate_response(self, prompt: str) -> str:
-        logger.debug(f"Generating response for prompt: {prompt}")
+    async def generate_response(self, prompt: str, response_format: Optional[Any] = None) -> str:
+        logger.debug("Generating response for prompt: %s", Preview(prompt))
 
         if not prompt.strip():
             logger.error("Received empty prompt")
@@ -117,17 +136,25 @@ class FFGemini:
             *self.chat_history
         ]
 
-        logger.debug(f"Messages for API call: {messages}")
+        logger.debug("Messages for API call: %s", MessagesPreview(messages))
+
+        # structured output: a StructuredOutput / Pydantic model, or a raw response_format dict
+        extra_args = {}
+        if response_format:
+            extra_args['response_format'] = openai_response_format(response_format)
 
         try:
+            start_time = time.perf_counter()
             response = await self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 max_tokens=self.max_tokens,
-                temperature=self.temperature
+                temperature=self.temperature,
+                **extra_args
             )
             
-            logger.debug(f"Full API response: {response}")
+            self.last_usage = usage_from_openai(response, time.perf_counter() - start_time)
+            logger.debug("Full API response: %s", Preview(response))
             
             # Add a small delay to ensure response is fully processed
             await asyncio.sleep(0.1)
@@ -142,11 +169,12 @@ class FFGemini:
                 logger.error("Unexpected response structure from API")
                 raise ValueError("Unexpected response structure from API")
         except Exception as e:
-            logger.error(f"Error generating response: {str(e)}")
+            logger.error("Error generating response: %s", e)
+            logger.error("  -- chat history: %s", MessagesPreview(self.chat_history))
             raise
 
-    def generate_response_sync(self, prompt: str) -> str:
-        return asyncio.run(self.generate_response(prompt))
+    def generate_response_sync(self, prompt: str, response_format: Optional[Any] = None) -> str:
+        return asyncio.run(self.generate_response(prompt, response_format=response_format))
 
     def clear_conversation(self):
         self.chat_history = []
\ No newline at end of file
@@ -4,10 +4,15 @@
 import os
 import time
 import logging
-from typing import Optional
-from openai import OpenAI
+from typing import Optional, Any
+from openai import OpenAI, DefaultHttpxClient
 from dotenv import load_dotenv
 
+from .UsageStats import usage_from_openai
+from .Diagnostics import Preview
+from .StructuredOutput import openai_response_format
+from .Cassette import cassette_http_client
+
 load_dotenv()
 
 # Configure logging
@@ -53,6 +58,9 @@ class FFOpenAIAssistant:
             class Messages(BaseModel):
                 messages: list[Message]
 
+            The Pydantic model itself (or StructuredOutput.for_model(Messages)) may be passed
+            instead; its schema is generated once and shared with the other clients.
+
     """
 
     def __init__(self, config: Optional[dict] = None, **kwargs):
@@ -104,7 +112,13 @@ class FFOpenAIAssistant:
                 case 'thread_id':
                     self.thread_id = value
                 case 'response_format':
-                    self.response_format = value
+                    self.response_format = openai_response_format(value)
+                case 'cassette':
+                    self.cassette = value
+                case 'cassette_mode':
+                    self.cassette_mode = value
+                case 'replay_latency':
+                    self.replay_latency = bool(value)
 
         # Set default values if not set
         self.api_key = getattr(self, 'api_key', os.getenv('OPENAI_TOKEN'))
@@ -116,11 +130,18 @@ class FFOpenAIAssistant:
         self.assistant_id = getattr(self, 'assistant_id', None)
         self.thread_id = getattr(self, 'thread_id', None)
         self.response_format = getattr(self, 'response_format', os.getenv('OPENAI_RESPONSE_FORMAT', defaults['response_format']))
+        # record/replay (see Cassette); unset, the FFAI_CASSETTE* environment variables apply
+        self.cassette = getattr(self, 'cassette', None)
+        self.cassette_mode = getattr(self, 'cassette_mode', None)
+        self.replay_latency = getattr(self, 'replay_latency', None)
 
         logger.debug(f"Model: {self.model}, Temperature: {self.temperature}, Max Tokens: {self.max_tokens}")
         logger.debug(f"System instructions: {self.system_instructions}")
         logger.debug(f"Assistant name: {self.assistant_name}")
 
+        # usage and timing of the most recent run (see UsageStats)
+        self.last_usage = None
+
         # Initialize the OpenAI client and get the assistant
         self.client: OpenAI = self._initialize_client()
         self.assistant_id = self._get_assistant(self.assistant_id)
@@ -137,7 +158,8 @@ class FFOpenAIAssistant:
             logger.error("API key not found")
             raise ValueError("API key not found")
         
-        return OpenAI(api_key=self.api_key)
+        return OpenAI(api_key=self.api_key,
+                      http_client=cassette_http_client(DefaultHttpxClient, self.cassette, self.cassette_mode, self.replay_latency))
 
     def _get_assistant(self, assistant_id: Optional[str]) -> str:
         """
@@ -204,17 +226,18 @@ class FFOpenAIAssistant:
         else:
             logger.debug(f"Using existing thread with ID: {self.thread_id}")
 
-    def _run_conversation(self, prompt: str) -> str:
+    def _run_conversation(self, prompt: str, response_format: Optional[Any] = None) -> str:
         """
         Run a conversation in the current thread and return the response.
 
         Args:
             prompt (str): The user's input prompt.
+            response_format (Optional[Any]): Overrides the assistant's response_format for this run.
 
         Returns:
             str: The assistant's response.
         """
-        logger.debug(f"Running conversation with prompt: {prompt}")
+        logger.debug("Running conversation with prompt: %s", Preview(prompt))
         self._ensure_thread()
         
         try:
@@ -227,22 +250,32 @@ class FFOpenAIAssistant:
             logger.debug("Added user message to thread")
 
             # Create and monitor the run
+            start_time = time.perf_counter()
+            extra_args = {}
+            if response_format:
+                extra_args['response_format'] = openai_response_format(response_format)
+
             run = self.client.beta.threads.runs.create(
                 thread_id=self.thread_id,
-                assistant_id=self.assistant_id
+                assistant_id=self.assistant_id,
+                **extra_args
             )
-            logger.debug(f"Created run with ID: {run.id}")
+            logger.debug("Created run with ID: %s", run.id)
 
             # Wait for the run to complete
             while run.status in ['queued', 'in_progress']:
                 time.sleep(1)
                 run = self.client.beta.threads.runs.retrieve(thread_id=self.thread_id, run_id=run.id)
-                logger.debug(f"Run status: {run.status}")
+                logger.debug("Run status: %s", run.status)
 
             if run.status != 'completed':
                 logger.error(f"Run failed with status: {run.status}")
                 raise RuntimeError(f"Run failed with status: {run.status}")
 
+            # runs report usage like chat completions; the run status stands in for finish_reason
+            self.last_usage = usage_from_openai(run, time.perf_counter() - start_time)
+            self.last_usage['finish_reason'] = run.status
+
             # Retrieve the assistant's response
             messages = self.client.beta.threads.messages.list(thread_id=self.thread_id)
             response = messages.data[0].content[0].text.value
@@ -253,15 +286,17 @@ class FFOpenAIAssistant:
             logger.error(f"Error in OpenAI conversation: {str(e)}")
             raise RuntimeError(f"Error in OpenAI conversation: {str(e)}")
 
-    def generate_response(self, prompt: str) -> str:
+    def generate_response(self, prompt: str, response_format: Optional[Any] = None) -> str:
         """
         Generate a response to the given prompt.
 
         Args:
             prompt (str): The user's input prompt.
+            response_format (Optional[Any]): Optional per-run response_format; a StructuredOutput,
+                Pydantic model or raw response_format dict.
 
         Returns:
             str: The generated response from the OpenAI model.
         """
         logger.info("Generating response")
-        return self._run_conversation(prompt)
\ No newline at end of file
+        return self._run_conversation(prompt, response_format=response_format)
\ No newline at end of file
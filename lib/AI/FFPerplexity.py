@@ -4,15 +4,30 @@
 import os
 import time
 import logging
-from typing import Optional
-from openai import OpenAI
+from typing import Optional, List, Dict, Any
+from openai import OpenAI, DefaultHttpxClient
 from dotenv import load_dotenv
 
+from .UsageStats import usage_from_openai
+from .Diagnostics import Preview, MessagesPreview
+from .Cassette import cassette_http_client
+
 load_dotenv()
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+
+def response_citations(response: Any) -> List[str]:
+    """The search citations (URLs) of a Perplexity response or stream chunk; [] if it has none"""
+    return list(getattr(response, 'citations', None) or [])
+
+
+def api_messages(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """The conversation as the API takes it: citations stay in the history and are not sent back"""
+    return [{"role": message["role"], "content": message["content"]} for message in history]
+
+
 class FFPerplexity:
     def __init__(self, config: Optional[dict] = None, **kwargs):
         logger.info("Initializing FFPerplexity")
@@ -40,6 +55,12 @@ class FFPerplexity:
                     self.max_tokens = int(value)
                 case 'system_instructions':
                     self.system_instructions = value
+                case 'cassette':
+                    self.cassette = value
+                case 'cassette_mode':
+                    self.cassette_mode = value
+                case 'replay_latency':
+                    self.replay_latency = bool(value)
 
         # Set default values if not set
         self.api_key = getattr(self, 'api_key', os.getenv('PERPLEXITY_TOKEN'))
@@ -47,11 +68,19 @@ class FFPerplexity:
         self.temperature = getattr(self, 'temperature', float(os.getenv('PERPLEXITY_TEMPERATURE', defaults['temperature'])))
         self.max_tokens = getattr(self, 'max_tokens', int(os.getenv('PERPLEXITY_MAX_TOKENS', defaults['max_tokens'])))
         self.system_instructions = getattr(self, 'system_instructions', os.getenv('PERPLEXITY_ASSISTANT_INSTRUCTIONS', defaults['instructions']))
+        # record/replay (see Cassette); unset, the FFAI_CASSETTE* environment variables apply
+        self.cassette = getattr(self, 'cassette', None)
+        self.cassette_mode = getattr(self, 'cassette_mode', None)
+        self.replay_latency = getattr(self, 'replay_latency', None)
 
         logger.debug(f"Model: {self.model}, Temperature: {self.temperature}, Max Tokens: {self.max_tokens}")
         logger.debug(f"System instructions: {self.system_instructions}")
 
+        # assistant turns keep their search citations under 'citations'
         self.conversation_history = []
+        # usage and timing of the most recent call (see UsageStats)
+        self.last_usage = None
+        self.last_citations: List[str] = []
         self.client: OpenAI = self._initialize_client()
 
     def _initialize_client(self) -> OpenAI:
@@ -62,10 +91,11 @@ class FFPerplexity:
             logger.error("API key not found")
             raise ValueError("API key not found")
         
-        return OpenAI(api_key=api_key, base_url="https://api.perplexity.ai")
+        return OpenAI(api_key=api_key, base_url="https://api.perplexity.ai",
+                      http_client=cassette_http_client(DefaultHttpxClient, self.cassette, self.cassette_mode, self.replay_latency))
 
     def generate_response(self, prompt: str) -> str:
-        logger.debug(f"Generating response for prompt: {prompt}")
+        logger.debug("Generating response for prompt: %s", Preview(prompt))
 
         try:
             self.conversation_history.append({"role": "user", "content": prompt})
@@ -75,29 +105,33 @@ class FFPerplexity:
                     "role": "system",
                     "content": self.system_instructions,
                 },
-                *self.conversation_history
+                *api_messages(self.conversation_history)
             ]
 
+            start_time = time.perf_counter()
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 max_tokens=self.max_tokens,
                 temperature=self.temperature
             )
+            self.last_usage = usage_from_openai(response, time.perf_counter() - start_time)
             
             assistant_response = response.choices[0].message.content
-            self.conversation_history.append({"role": "assistant", "content": assistant_response})
+            self.last_citations = response_citations(response)
+            self.conversation_history.append({"role": "assistant", "content": assistant_response,
+                                              "citations": self.last_citations})
             
             logger.info("Response generated successfully")
             return assistant_response
         except Exception as e:
             logger.error("Problem with response generation")
-            logger.error(f"  -- exception: {str(e)}")
-            logger.error(f"  -- model: {self.model}")
-            logger.error(f"  -- system: {self.system_instructions}")
-            logger.error(f"  -- conversation history: {self.conversation_history}")
-            logger.error(f"  -- max_tokens: {self.max_tokens}")
-            logger.error(f"  -- temperature: {self.temperature}")
+            logger.error("  -- exception: %s", e)
+            logger.error("  -- model: %s", self.model)
+            logger.error("  -- system: %s", Preview(self.system_instructions))
+            logger.error("  -- conversation history: %s", MessagesPreview(self.conversation_history))
+            logger.error("  -- max_tokens: %s", self.max_tokens)
+            logger.error("  -- temperature: %s", self.temperature)
             
             raise RuntimeError(f"Error generating response from Perplexity: {str(e)}")
 
@@ -0,0 +1,267 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+import os
+import time
+import logging
+from types import SimpleNamespace
+from typing import Optional, List, Dict, Any, AsyncIterator
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from dotenv import load_dotenv
+
+from .UsageStats import usage_from_openai
+from .Diagnostics import Preview, MessagesPreview
+from .Cassette import cassette_http_client
+from .AsyncBatch import batch_request, run_bounded
+from .FFPerplexity import response_citations, api_messages
+
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# requests generate_batch keeps in flight at once
+DEFAULT_MAX_CONCURRENCY = int(os.getenv('PERPLEXITY_MAX_CONCURRENCY', 16))
+
+
+def merge_citations(citations: List[str], new: Optional[List[str]]) -> None:
+    """Add the citations of a stream chunk that are not in citations yet, in order"""
+    # each chunk usually repeats the list so far, which needs no work
+    if not new or new == citations:
+        return
+    seen = set(citations)
+    for url in new:
+        if url not in seen:
+            seen.add(url)
+            citations.append(url)
+
+
+class FFPerplexityAsync:
+    """
+    FFPerplexity on AsyncOpenAI: awaitable calls, token streaming, and generate_batch for
+    research fan-out, with the search citations of every answer kept.
+
+    generate_response() and stream_response() keep one conversation, so await their calls
+    one after another. For independent queries, use generate_batch().
+    """
+
+    def __init__(self, config: Optional[dict] = None, **kwargs):
+        logger.info("Initializing FFPerplexityAsync")
+
+        # DEFAULT VALUES
+        defaults = {
+            'model': "llama-3.1-sonar-huge-128k-online",
+            'max_tokens': 4000,
+            'temperature': 0.5,
+            'instructions': "Respond accurately to user queries. Never start with a preamble. Immediately address the ask or request. Do not add meta information about your response. If there's nothing to do, answer with ''"
+        }
+
+        # Combine config and kwargs, with kwargs taking precedence
+        all_config = {**(config or {}), **kwargs}
+
+        for key, value in all_config.items():
+            match key:
+                case 'api_key':
+                    self.api_key = value or os.getenv('PERPLEXITY_TOKEN')
+                case 'model':
+                    self.model = value
+                case 'temperature':
+                    self.temperature = float(value)
+                case 'max_tokens':
+                    self.max_tokens = int(value)
+                case 'system_instructions':
+                    self.system_instructions = value
+                case 'max_concurrency':
+                    self.max_concurrency = int(value)
+                case 'cassette':
+                    self.cassette = value
+                case 'cassette_mode':
+                    self.cassette_mode = value
+                case 'replay_latency':
+                    self.replay_latency = bool(value)
+
+        # Set default values if not set
+        self.api_key = getattr(self, 'api_key', os.getenv('PERPLEXITY_TOKEN'))
+        self.model = getattr(self, 'model', os.getenv('PERPLEXITY_MODEL', defaults['model']))
+        self.temperature = getattr(self, 'temperature', float(os.getenv('PERPLEXITY_TEMPERATURE', defaults['temperature'])))
+        self.max_tokens = getattr(self, 'max_tokens', int(os.getenv('PERPLEXITY_MAX_TOKENS', defaults['max_tokens'])))
+        self.system_instructions = getattr(self, 'system_instructions', os.getenv('PERPLEXITY_ASSISTANT_INSTRUCTIONS', defaults['instructions']))
+        self.max_concurrency = getattr(self, 'max_concurrency', DEFAULT_MAX_CONCURRENCY)
+        # record/replay (see Cassette); unset, the FFAI_CASSETTE* environment variables apply
+        self.cassette = getattr(self, 'cassette', None)
+        self.cassette_mode = getattr(self, 'cassette_mode', None)
+        self.replay_latency = getattr(self, 'replay_latency', None)
+
+        logger.debug(f"Model: {self.model}, Temperature: {self.temperature}, Max Tokens: {self.max_tokens}")
+        logger.debug(f"System instructions: {self.system_instructions}")
+
+        # assistant turns keep their search citations under 'citations'
+        self.conversation_history = []
+        # usage and timing of the most recent call (see UsageStats)
+        self.last_usage = None
+        # citations of the most recent answer; while a response streams, they are added as they arrive
+        self.last_citations: List[str] = []
+        self.client: AsyncOpenAI = self._initialize_client()
+
+    def _initialize_client(self) -> AsyncOpenAI:
+        """Initialize and return the AsyncOpenAI client."""
+        logger.info("Initializing async Perplexity client")
+        api_key = self.api_key
+        if not api_key:
+            logger.error("API key not found")
+            raise ValueError("API key not found")
+
+        return AsyncOpenAI(api_key=api_key, base_url="https://api.perplexity.ai",
+                           http_client=cassette_http_client(DefaultAsyncHttpxClient, self.cassette, self.cassette_mode, self.replay_latency))
+
+    def _messages(self, history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [
+            {
+                "role": "system",
+                "content": self.system_instructions,
+            },
+            *api_messages(history)
+        ]
+
+    def _log_error(self, e: Exception) -> None:
+        logger.error("Problem with response generation")
+        logger.error("  -- exception: %s", e)
+        logger.error("  -- model: %s", self.model)
+        logger.error("  -- system: %s", Preview(self.system_instructions))
+        logger.error("  -- conversation history: %s", MessagesPreview(self.conversation_history))
+        logger.error("  -- max_tokens: %s", self.max_tokens)
+        logger.error("  -- temperature: %s", self.temperature)
+
+    async def generate_response(self, prompt: str) -> str:
+        logger.debug("Generating response for prompt: %s", Preview(prompt))
+
+        try:
+            self.conversation_history.append({"role": "user", "content": prompt})
+
+            start_time = time.perf_counter()
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=self._messages(self.conversation_history),
+                max_tokens=self.max_tokens,
+                temperature=self.temperature
+            )
+            self.last_usage = usage_from_openai(response, time.perf_counter() - start_time)
+
+            assistant_response = response.choices[0].message.content
+            self.last_citations = response_citations(response)
+            self.conversation_history.append({"role": "assistant", "content": assistant_response,
+                                              "citations": self.last_citations})
+
+            logger.info("Response generated successfully")
+            return assistant_response
+        except Exception as e:
+            self._log_error(e)
+            raise RuntimeError(f"Error generating response from Perplexity: {str(e)}")
+
+    async def stream_response(self, prompt: str) -> AsyncIterator[str]:
+        """
+        Stream the answer to a prompt as text deltas:
+
+            async for text in client.stream_response(prompt):
+                ...
+
+        last_citations fills in as the chunks bring citations. When the stream ends, the
+        answer and its citations are added to the conversation and last_usage is set. To stop
+        early, iterate inside contextlib.aclosing(), so the request is closed at once; the
+        conversation then keeps the text received so far. If the request fails, RuntimeError
+        is raised and, as with generate_response(), no answer is added.
+        """
+        logger.debug("Streaming response for prompt: %s", Preview(prompt))
+        self.conversation_history.append({"role": "user", "content": prompt})
+
+        citations: List[str] = []
+        self.last_citations = citations
+        parts: List[str] = []
+        usage = None
+        finish_reason = None
+        stream = None
+        failed = False
+        start_time = time.perf_counter()
+        try:
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=self._messages(self.conversation_history),
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                stream=True
+            )
+            async for chunk in stream:
+                merge_citations(citations, getattr(chunk, 'citations', None))
+                if chunk.usage:
+                    usage = chunk.usage
+                if chunk.choices:
+                    choice = chunk.choices[0]
+                    finish_reason = choice.finish_reason or finish_reason
+                    if choice.delta and choice.delta.content:
+                        parts.append(choice.delta.content)
+                        yield choice.delta.content
+            logger.info("Response streamed successfully")
+        except Exception as e:
+            failed = True
+            self._log_error(e)
+            raise RuntimeError(f"Error streaming response from Perplexity: {str(e)}")
+        finally:
+            if stream is not None:
+                await stream.close()
+                # finished, or closed early by the caller: the user and assistant turns must
+                # alternate, so even a partial answer is kept
+                if not failed:
+                    self.last_usage = usage_from_openai(
+                        SimpleNamespace(usage=usage, choices=[SimpleNamespace(finish_reason=finish_reason)]),
+                        time.perf_counter() - start_time)
+                    self.conversation_history.append({"role": "assistant", "content": ''.join(parts),
+                                                      "citations": citations})
+
+    def clear_conversation(self):
+        logger.info("Clearing conversation history")
+        self.conversation_history = []
+
+    async def aclose(self) -> None:
+        """Close the client's connection pool"""
+        await self.client.close()
+
+    # ==================================================================================
+    # CONCURRENT BATCH
+    # ==================================================================================
+    async def _batch_request(self, custom_id: str, prompt: str) -> Dict[str, Any]:
+        """One independent (history-free) query of generate_batch"""
+        return await batch_request(
+            custom_id,
+            lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=self._messages([{"role": "user", "content": prompt}]),
+                max_tokens=self.max_tokens,
+                temperature=self.temperature
+            ),
+            lambda response: response.choices[0].message.content,
+            usage_from_openai,
+            lambda response: {'citations': response_citations(response) if response is not None else []})
+
+    async def generate_batch(self, prompts: Dict[str, str],
+                             max_concurrency: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Send independent queries, at most max_concurrency at a time, and yield the results as
+        they finish. Each query is sent without conversation history; the SDK retries
+        rate-limited requests.
+
+            async for result in client.generate_batch({'q1': query1, 'q2': query2}):
+                ...
+
+        Args:
+            prompts: Mapping of custom_id -> prompt text
+            max_concurrency: Requests in flight at once (default: max_concurrency from the
+                config, or PERPLEXITY_MAX_CONCURRENCY, 16)
+
+        Yields:
+            Dicts with 'custom_id', 'status' ('succeeded' or 'errored'), 'response' (text or
+            None), 'citations' (URLs), 'error' (error type, 'empty_response' when the answer
+            had no text, or None) and 'usage' (see UsageStats, or None)
+        """
+        logger.info("Sending %d batch queries, at most %d at a time", len(prompts), max_concurrency or self.max_concurrency)
+        async for result in run_bounded(prompts, self._batch_request, max_concurrency or self.max_concurrency):
+            yield result
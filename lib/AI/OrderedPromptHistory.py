@@ -1,16 +1,98 @@
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from collections import OrderedDict
 from copy import deepcopy
 from dataclasses import dataclass
+from operator import attrgetter
+from itertools import chain
+import heapq
 import time
 from datetime import datetime
 import re
+import threading
 
 import logging
 
+from .UsageStats import UsageTotals, USAGE_FIELDS
+from .Diagnostics import Preview
+from .BlobStore import BlobStore, content_key
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# ======================================================================================
+# TEXT CLEANING
+# ======================================================================================
+RAG_OPEN = '<RAG>'
+RAG_CLOSE = '</RAG>'
+PROMPT_SECTION_PATTERN = re.compile(r'========\s*PROMPT\s*========')
+
+# cleaned text is memoized by content hash; short texts are cheaper to clean than to hash
+CLEAN_CACHE_MAX_ENTRIES = 512
+CLEAN_CACHE_MIN_CHARS = 1024
+_clean_cache: OrderedDict = OrderedDict()
+_clean_cache_lock = threading.Lock()
+_join_words = ' '.join
+
+
+def _remove_rag_sections(text: str) -> str:
+    """Remove every <RAG>...</RAG> section (same result as the non-greedy regex, via str.find)"""
+    parts = []
+    pos = 0
+    while True:
+        start = text.find(RAG_OPEN, pos)
+        if start == -1:
+            break
+        end = text.find(RAG_CLOSE, start + len(RAG_OPEN))
+        if end == -1:
+            break
+        parts.append(text[pos:start])
+        pos = end + len(RAG_CLOSE)
+
+    if not parts:
+        return text
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
+def clean_text_uncached(text: str) -> str:
+    """Remove RAG tags, the PROMPT section and extra whitespace, keeping one line per non-blank line"""
+    if RAG_OPEN in text:
+        text = _remove_rag_sections(text)
+
+    # Remove PROMPT sections (the marker and everything after it)
+    if '========' in text:
+        match = PROMPT_SECTION_PATTERN.search(text)
+        if match:
+            text = text[:match.start()]
+
+    # Collapse whitespace within each line and drop blank lines
+    return '\n'.join(filter(None, map(_join_words, map(str.split, text.splitlines()))))
+
+
+def clean_text(text: str) -> str:
+    """clean_text_uncached(), memoized by content hash so repeated prompts and RAG blocks are cleaned once"""
+    if len(text) < CLEAN_CACHE_MIN_CHARS:
+        return clean_text_uncached(text)
+
+    key = content_key(text)
+    with _clean_cache_lock:
+        cleaned = _clean_cache.get(key)
+        if cleaned is not None:
+            _clean_cache.move_to_end(key)
+            return cleaned
+
+    cleaned = clean_text_uncached(text)
+    with _clean_cache_lock:
+        _clean_cache[key] = cleaned
+        if len(_clean_cache) > CLEAN_CACHE_MAX_ENTRIES:
+            _clean_cache.popitem(last=False)
+    return cleaned
+
+
+def clear_clean_cache() -> None:
+    with _clean_cache_lock:
+        _clean_cache.clear()
+
 @dataclass
 class Interaction:
     """Represents a single prompt-response interaction"""
@@ -21,7 +103,18 @@ class Interaction:
     prompt: str
     response: str
     history: Optional[List[str]] = None  # Added history field
+    # provider usage and timing, when the client reports it
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    finish_reason: Optional[str] = None
+    latency: Optional[float] = None
+    context_tokens_saved: Optional[int] = None
+    cache_write_tokens: Optional[int] = None
     
+    def usage(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in USAGE_FIELDS}
+
     def to_dict(self) -> Dict[str, Any]:
         return {
             "sequence_number": self.sequence_number,
@@ -31,39 +124,70 @@ class Interaction:
             "prompt": self.prompt,
             "response": self.response,
             "history": self.history,  # Include history in dict representation
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "finish_reason": self.finish_reason,
+            "latency": self.latency,
+            "context_tokens_saved": self.context_tokens_saved,
+            "cache_write_tokens": self.cache_write_tokens,
             "datetime": datetime.fromtimestamp(self.timestamp).isoformat()
         }
 
 class OrderedPromptHistory:
-    def __init__(self):
+    def __init__(self, price_table: Optional[Dict[str, Dict[str, float]]] = None,
+                 blob_store: Optional[BlobStore] = None):
         self.prompt_dict: OrderedDict[str, List[Interaction]] = OrderedDict()
         self._current_sequence = 0
+
+        # optional shared store; cleaned prompts and responses are kept once across histories
+        self.blob_store = blob_store
+
+        # model -> {'prompt': x, 'completion': y, 'cached': z, 'cache_write': w} per 1M tokens
+        self.price_table = price_table or {}
+        # usage aggregates, updated on every add so stats never rescan the history
+        self._usage_by_model: Dict[str, UsageTotals] = {}
+        self._usage_by_prompt_name: Dict[Any, UsageTotals] = {}
+        # across all interactions
+        self._usage_total = UsageTotals()
+
+        # prompt_name -> formatted block of its latest interaction, for get_formatted_responses
+        self._formatted_blocks: Dict[Any, str] = {}
+
+        # (prompt_name, model) -> (fingerprint, response) of the latest interaction of that prompt_name
+        # with that model, when it was fingerprinted (see FFAI_AzureOpenAI incremental); a new
+        # interaction of the pair drops it. Keyed by model too, so fanned-out models keep theirs.
+        self.fingerprints: Dict[Tuple[Any, str], Tuple[str, str]] = {}
+
+        # guards prompt_dict, the sequence counter and the aggregates; cleaning happens outside it
+        self._lock = threading.RLock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # locks cannot be copied or pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
     
     def _clean_text(self, text: str) -> str:
         """Clean text by removing RAG tags, PROMPT sections, and extra whitespace"""
-        # Remove RAG sections
-        cleaned = re.sub(r'<RAG>[\s\S]*?</RAG>', '', text)
-        # Remove PROMPT sections
-        cleaned = re.sub(r'========\s*PROMPT\s*========[\s\S]*', '', cleaned)
-        
-        # Clean whitespace line by line
-        cleaned_lines = []
-        for line in cleaned.splitlines():
-            cleaned_line = ' '.join(line.split())
-            if cleaned_line:  # Only add non-empty lines
-                cleaned_lines.append(cleaned_line)
-        
-        return '\n'.join(cleaned_lines).strip()
+        return clean_text(text)
 
     def get_effective_prompt_name(self, prompt_name:Any)->str:
-        logger.debug(f"Running: get_effective_prompt_name()")
-        logger.debug(f"prompt_name: {prompt_name} | type: {type(prompt_name)}")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Running: get_effective_prompt_name()")
+            logger.debug("prompt_name: %s | type: %s", Preview(prompt_name), type(prompt_name))
 
         if type(prompt_name) == str:
             # Clean prompt_name
             cleaned_prompt = self._clean_text(prompt_name)
 
-            logger.debug(f"returning effective_prompt: {cleaned_prompt} | type: str")
+            if debug:
+                logger.debug("returning effective_prompt: %s | type: str", Preview(cleaned_prompt))
             return cleaned_prompt
         elif type(prompt_name) == tuple:
             values = []
@@ -80,17 +204,20 @@ class OrderedPromptHistory:
             if len(tuple(values)) == 1:
                 simple_value = tuple(values)[0]
 
-                logger.debug(f"returning effective_prompt: {simple_value} | type: {type(simple_value)}")
+                if debug:
+                    logger.debug("returning effective_prompt: %s | type: %s", simple_value, type(simple_value))
                 return tuple(values)[0]
             # return multiple item tuple
             else:
-                logger.debug(f"returning effective_prompt: {tuple(values)} | type: tuple")
+                if debug:
+                    logger.debug("returning effective_prompt: %s | type: tuple", tuple(values))
                 return tuple(values)
 
 
     def add_interaction(self, model: str, prompt: str, response: str, 
                        prompt_name: Optional[str] = None, 
-                       history: Optional[List[str]] = None) -> Interaction:
+                       history: Optional[List[str]] = None,
+                       usage: Optional[Dict[str, Any]] = None) -> Interaction:
         """
         Add a new interaction to the history, storing cleaned versions of prompt and response
         
@@ -100,71 +227,113 @@ class OrderedPromptHistory:
             response: The response text
             prompt_name: Optional name/key for the prompt. If None, uses prompt text as key
             history: Optional list of prompt names that form the history chain for this interaction
+            usage: Optional usage dict from the client (prompt_tokens, completion_tokens,
+                cached_tokens, finish_reason, latency)
         
         Returns:
             The created Interaction object
         """
-        logger.debug("***************************************************************")
-        logger.debug(f"Running: add_interaction()")
-        logger.debug("***************************************************************")
-        logger.debug(f"prompt: {prompt} | type: {type(prompt)}")
-        logger.debug(f"prompt_name: {prompt_name} | type: {type(prompt_name)}")
-        logger.debug(f"history: {history} | type: {type(history)}")
-        logger.debug(f"model: {model} | type: {type(model)}")
-        logger.debug("***************************************************************")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("***************************************************************")
+            logger.debug("Running: add_interaction()")
+            logger.debug("***************************************************************")
+            logger.debug("prompt: %s | type: %s", Preview(prompt), type(prompt))
+            logger.debug("prompt_name: %s | type: %s", Preview(prompt_name), type(prompt_name))
+            logger.debug("history: %s | type: %s", history, type(history))
+            logger.debug("model: %s | type: %s", model, type(model))
+            logger.debug("***************************************************************")
 
-        logger.debug(f"response: {response} | type: {type(response)}")
+            logger.debug("response: %s | type: %s", Preview(response), type(response))
 
-        self._current_sequence += 1
-
-        
         # Clean prompt and response before storing
         cleaned_prompt = self._clean_text(prompt)
         cleaned_response = self._clean_text(response)
-        logger.debug(f"cleaned_response: {cleaned_response}")
+        if self.blob_store is not None:
+            cleaned_prompt = self.blob_store.intern(cleaned_prompt)
+            cleaned_response = self.blob_store.intern(cleaned_response)
+        if debug:
+            logger.debug("cleaned_response: %s", Preview(cleaned_response))
 
         # GET PROMPT NAME
         effective_prompt_name = self.get_effective_prompt_name(prompt_name) or cleaned_prompt
-        logger.debug(f"effective_prompt_name: {effective_prompt_name}")
+        if debug:
+            logger.debug("effective_prompt_name: %s", Preview(effective_prompt_name))
 
 
 
-        interaction = Interaction(
-            sequence_number=self._current_sequence,
-            model=model,
-            timestamp=time.time(),
-            prompt_name=effective_prompt_name,
-            prompt=cleaned_prompt,
-            response=cleaned_response,
-            history=history  # Store the history chain
-        )
-        
+        usage_fields = {field: usage.get(field) for field in USAGE_FIELDS} if usage else {}
+
+        # sequence allocation and the append are one step, so every prompt_name list stays in sequence order
+        with self._lock:
+            self._current_sequence += 1
+            interaction = Interaction(
+                sequence_number=self._current_sequence,
+                model=model,
+                timestamp=time.time(),
+                prompt_name=effective_prompt_name,
+                prompt=cleaned_prompt,
+                response=cleaned_response,
+                history=history,  # Store the history chain
+                **usage_fields
+            )
 
-        if effective_prompt_name not in self.prompt_dict:
-            self.prompt_dict[effective_prompt_name] = []
+            if effective_prompt_name not in self.prompt_dict:
+                self.prompt_dict[effective_prompt_name] = []
 
-        self.prompt_dict[effective_prompt_name].append(interaction)
+            self.prompt_dict[effective_prompt_name].append(interaction)
+            self._formatted_blocks.pop(effective_prompt_name, None)
+            self.fingerprints.pop((effective_prompt_name, model), None)
+            self._record_usage(interaction)
         return interaction
 
+    def _record_usage(self, interaction: Interaction) -> None:
+        usage = interaction.usage()
+        if interaction.model not in self._usage_by_model:
+            self._usage_by_model[interaction.model] = UsageTotals()
+        self._usage_by_model[interaction.model].add(interaction.model, usage)
+
+        if interaction.prompt_name not in self._usage_by_prompt_name:
+            self._usage_by_prompt_name[interaction.prompt_name] = UsageTotals()
+        self._usage_by_prompt_name[interaction.prompt_name].add(interaction.model, usage)
+        self._usage_total.add(interaction.model, usage)
+
+    def set_fingerprint(self, prompt_name: Any, model: str, fingerprint: str, response: str) -> None:
+        """Record the fingerprint of the inputs that produced the latest response for prompt_name from model"""
+        effective_prompt_name = self.get_effective_prompt_name(prompt_name)
+        with self._lock:
+            self.fingerprints[(effective_prompt_name, model)] = (fingerprint, response)
+
+    def get_fingerprint(self, prompt_name: Any, model: str) -> Optional[Tuple[str, str]]:
+        """(fingerprint, response) of the latest interaction for prompt_name from model, if it was fingerprinted"""
+        effective_prompt_name = self.get_effective_prompt_name(prompt_name)
+        with self._lock:
+            return self.fingerprints.get((effective_prompt_name, model))
+
     def get_interactions_by_prompt_name(self, prompt_name: str) -> List[Interaction]:
         """Get all interactions for a specific prompt name"""
-        logger.debug(f"Getting interactions for prompt_name: {prompt_name}")
+        logger.debug("Getting interactions for prompt_name: %s", Preview(prompt_name))
 
-        return deepcopy(self.prompt_dict.get(prompt_name, []))
+        with self._lock:
+            interactions = list(self.prompt_dict.get(prompt_name, []))
+        return deepcopy(interactions)
     
     def get_latest_interaction_by_prompt_name(self, prompt_name: str) -> Optional[Interaction]:
         """Get the most recent interaction for a specific prompt name"""
-        logger.debug(f"Getting latest interaction for prompt_name: {prompt_name}")
+        logger.debug("Getting latest interaction for prompt_name: %s", Preview(prompt_name))
         
-        interactions = self.prompt_dict.get(prompt_name, [])
-        return deepcopy(interactions[-1]) if interactions else None
+        with self._lock:
+            interactions = self.prompt_dict.get(prompt_name)
+            latest = interactions[-1] if interactions else None
+        return deepcopy(latest) if latest else None
     
     def get_all_prompt_names(self) -> List[str]:
         """Get a list of all prompt names in order of first appearance"""
         if hasattr(self, 'prompt_dict'):
-            all_prompt_names = self.prompt_dict.keys()
-            logger.debug(f"Returning all prompt names: {all_prompt_names}")
-            return list(all_prompt_names)
+            with self._lock:
+                all_prompt_names = list(self.prompt_dict.keys())
+            logger.debug("Returning all prompt names: %s", Preview(all_prompt_names))
+            return all_prompt_names
         else:
             logger.warning("prompt_dict is not initialized")
             return []  # or handle the error case differently
@@ -173,55 +342,161 @@ class OrderedPromptHistory:
     def get_all_interactions(self) -> List[Interaction]:
         """Get all interactions in sequence order"""
         logger.debug("Getting all interactions")
-        logger.debug(f"Object Prompt dict: {self.prompt_dict}")
-
-        all_interactions = []
+        logger.debug("Object Prompt dict: %d prompt names", len(self.prompt_dict))
 
-        for interactions in self.prompt_dict.values():
-            all_interactions.extend(interactions)
-        return sorted(deepcopy(all_interactions), key=lambda x: x.sequence_number)
+        with self._lock:
+            all_interactions = self._interactions_in_sequence()
+        return deepcopy(all_interactions)
     
     def get_prompt_name_usage_stats(self) -> Dict[str, int]:
         """Get statistics on prompt name usage"""
-        return {name: len(interactions) for name, interactions in self.prompt_dict.items()}
+        with self._lock:
+            return {name: len(interactions) for name, interactions in self.prompt_dict.items()}
+
+    def get_model_usage_stats(self) -> Dict[str, int]:
+        """Get the number of calls per model"""
+        with self._lock:
+            return {model: totals.calls for model, totals in self._usage_by_model.items()}
+
+    def get_token_usage_by_model(self) -> Dict[str, Dict[str, Any]]:
+        """Get token totals, latency percentiles and estimated cost per model"""
+        with self._lock:
+            return {model: totals.to_dict(self.price_table) for model, totals in self._usage_by_model.items()}
+
+    def get_token_usage_by_prompt_name(self) -> Dict[Any, Dict[str, Any]]:
+        """Get token totals, latency percentiles and estimated cost per prompt name"""
+        with self._lock:
+            return {name: totals.to_dict(self.price_table) for name, totals in self._usage_by_prompt_name.items()}
+
+    def get_latency_percentiles(self, percentiles: List[float] = (50, 90, 99),
+                                model: Optional[str] = None,
+                                prompt_name: Optional[str] = None) -> Dict[float, Optional[float]]:
+        """
+        Get latency percentiles (seconds) across all interactions, or for one model or prompt name
+        """
+        with self._lock:
+            if model is not None:
+                totals = self._usage_by_model.get(model, UsageTotals())
+            elif prompt_name is not None:
+                totals = self._usage_by_prompt_name.get(prompt_name, UsageTotals())
+            else:
+                totals = self._usage_total
+            return {p: totals.percentile(p) for p in percentiles}
+
+    def get_estimated_cost(self) -> float:
+        """Get the estimated total cost of all interactions from the price table"""
+        with self._lock:
+            return self._usage_total.cost(self.price_table) or 0.0
     
     def get_interactions_by_model_and_prompt_name(self, model: str, prompt_name: str) -> List[Interaction]:
         """Get all interactions for a specific model and prompt name combination"""
-        interactions = self.prompt_dict.get(prompt_name, [])
-        return deepcopy([i for i in interactions if i.model == model])
+        with self._lock:
+            interactions = [i for i in self.prompt_dict.get(prompt_name, []) if i.model == model]
+        return deepcopy(interactions)
     
-    def merge_histories(self, other: 'OrderedPromptHistory') -> None:
+    def _interactions_in_sequence(self) -> List[Interaction]:
+        """This history's interactions in sequence order, without copying them (call with the lock held)"""
+        # each prompt_name list is already a sorted run, which sorted() merges in near-linear time
+        return sorted(chain.from_iterable(self.prompt_dict.values()), key=attrgetter('sequence_number'))
+
+    def merge_histories(self, *others: 'OrderedPromptHistory', order_by: str = 'timestamp') -> None:
         """
-        Merge another OrderedPromptHistory into this one
-        
+        Merge one or more OrderedPromptHistory instances into this one in a single pass
+
+        Interactions keep their cleaned text, prompt names, timestamps and usage; they are
+        interleaved with a k-way merge and renumbered. The other histories are left unchanged.
+
         Args:
-            other: Another OrderedPromptHistory instance to merge
+            others: The OrderedPromptHistory instances to merge
+            order_by: 'timestamp' to order all interactions by when they happened (ties keep
+                each history's sequence order), or 'sequence' to interleave by each history's own
+                sequence numbers
         """
-        for prompt_name, interactions in other.prompt_dict.items():
-            if prompt_name not in self.prompt_dict:
-                self.prompt_dict[prompt_name] = []
-            self.prompt_dict[prompt_name].extend(deepcopy(interactions))
-            
-        # Resequence all interactions to maintain order
-        all_interactions = self.get_all_interactions()
-        self._current_sequence = 0
-        self.prompt_dict.clear()
-        
-        for interaction in all_interactions:
-            self.add_interaction(
-                model=interaction.model,
-                prompt=interaction.prompt,
-                response=interaction.response,
-                prompt_name=interaction.prompt_name,
-                history=interaction.history  # Preserve history when resequencing
-            )
-    
+        match order_by:
+            case 'timestamp':
+                merge_key = attrgetter('timestamp')
+            case 'sequence':
+                merge_key = attrgetter('sequence_number')
+            case _:
+                raise ValueError(f"order_by must be 'timestamp' or 'sequence', not {order_by!r}")
+
+        others = [other for other in others if other is not self]
+        if not others:
+            return
+
+        # each other history is locked only while it is copied, so merges never hold two locks
+        snapshots = [self._adopted(other) for other in others]
+
+        with self._lock:
+            streams = [self._interactions_in_sequence()]
+            streams.extend(adopted for adopted, _, _ in snapshots)
+            if order_by == 'timestamp':
+                # heapq.merge needs every stream in timestamp order. Timestamps usually follow the
+                # sequence numbers, but not after a merge by sequence; the sort is stable, and a
+                # single pass over a stream already in order.
+                for stream in streams:
+                    stream.sort(key=merge_key)
+
+            merged: OrderedDict[str, List[Interaction]] = OrderedDict()
+            sequence = 0
+            # ties keep the stream order: this history first, then others as passed
+            for sequence, interaction in enumerate(heapq.merge(*streams, key=merge_key), start=1):
+                interaction.sequence_number = sequence
+                if interaction.prompt_name not in merged:
+                    merged[interaction.prompt_name] = []
+                merged[interaction.prompt_name].append(interaction)
+
+            self.prompt_dict = merged
+            self._current_sequence = sequence
+            self._formatted_blocks.clear()
+            # a merged-in interaction may now be the latest for its prompt_name
+            for adopted, _, _ in snapshots:
+                for interaction in adopted:
+                    self.fingerprints.pop((interaction.prompt_name, interaction.model), None)
+
+            # the snapshot totals are private copies, so new groups can take them as they are
+            for _, usage_by_model, usage_by_prompt_name in snapshots:
+                for model, totals in usage_by_model.items():
+                    self._usage_total.merge(totals)
+                    if model in self._usage_by_model:
+                        self._usage_by_model[model].merge(totals)
+                    else:
+                        self._usage_by_model[model] = totals
+                for prompt_name, totals in usage_by_prompt_name.items():
+                    if prompt_name in self._usage_by_prompt_name:
+                        self._usage_by_prompt_name[prompt_name].merge(totals)
+                    else:
+                        self._usage_by_prompt_name[prompt_name] = totals
+
+    def _adopted(self, other: 'OrderedPromptHistory') -> Tuple[List[Interaction], Dict[str, UsageTotals], Dict[Any, UsageTotals]]:
+        """
+        Shallow copies of another history's interactions, ready to be renumbered into this one,
+        and copies of its usage aggregates
+        """
+        with other._lock:
+            interactions = other._interactions_in_sequence()
+            usage_by_model = {model: UsageTotals.copy_of(totals) for model, totals in other._usage_by_model.items()}
+            usage_by_prompt_name = {name: UsageTotals.copy_of(totals) for name, totals in other._usage_by_prompt_name.items()}
+
+        intern = self.blob_store.intern if self.blob_store is not None and other.blob_store is not self.blob_store else None
+        adopted_interactions = []
+        for interaction in interactions:
+            # a field-for-field copy; dataclasses.replace() would re-run __init__ per interaction
+            adopted = object.__new__(Interaction)
+            adopted.__dict__.update(interaction.__dict__)
+            if intern is not None:
+                adopted.prompt = intern(adopted.prompt)
+                adopted.response = intern(adopted.response)
+            adopted_interactions.append(adopted)
+        return adopted_interactions, usage_by_model, usage_by_prompt_name
+
     def to_dict(self) -> Dict[str, List[Dict[str, Any]]]:
         """Convert the entire history to a dictionary organized by prompt names"""
-        return {
-            prompt_name: [i.to_dict() for i in interactions]
-            for prompt_name, interactions in self.prompt_dict.items()
-        }
+        with self._lock:
+            return {
+                prompt_name: [i.to_dict() for i in interactions]
+                for prompt_name, interactions in self.prompt_dict.items()
+            }
     
     def get_interaction_by_prompt(self, prompt: str) -> Optional[Interaction]:
         """
@@ -251,10 +526,32 @@ class OrderedPromptHistory:
                 }
         return result
     
+    def _formatted_block(self, prompt_name: Any) -> str:
+        """The formatted block for the latest interaction under prompt_name ('' if there is none)"""
+        block = self._formatted_blocks.get(prompt_name)
+        if block is None:
+            interactions = self.prompt_dict.get(prompt_name)
+            latest = interactions[-1] if interactions else None
+            block = ''
+            if latest and latest.prompt and latest.response:
+                # Use the cleaned prompt text for the tag, not the prompt_name
+                block = f"<prompt:{latest.prompt}>{latest.response}</prompt:{latest.prompt}>"
+            self._formatted_blocks[prompt_name] = block
+        return block
+
+    def _history_of(self, prompt_name: Any) -> List[Any]:
+        """The history chain recorded with the latest interaction under prompt_name"""
+        interactions = self.prompt_dict.get(prompt_name)
+        return (interactions[-1].history or []) if interactions else []
+
     def get_formatted_responses(self, prompt_names: List[str]) -> str:
         """
         Format the latest prompts and responses in the specified format,
         including recursive history chains.
+
+        Each prompt's history chain comes before the prompt itself. Chains are walked
+        iteratively (no recursion limit) and formatted blocks are cached until a new
+        interaction is added under their prompt name.
         
         Args:
             prompt_names: List of prompt names to include in the formatted output
@@ -262,30 +559,29 @@ class OrderedPromptHistory:
         Returns:
             Formatted string containing all prompts and responses
         """
-        formatted_outputs = []
-        processed_prompts = set()  # To prevent infinite loops
-        
-        def process_prompt_chain(prompt_name: str):
-            if prompt_name in processed_prompts:
-                return
-            
-            processed_prompts.add(prompt_name)
-            latest = self.get_latest_interaction_by_prompt_name(prompt_name)
-            
-            if latest:
-                # First process this prompt's history if it exists
-                if latest.history:
-                    for history_prompt in latest.history:
-                        process_prompt_chain(history_prompt)
-                
-                # Then add this prompt's formatted output
-                if latest.prompt and latest.response:
-                    # Use the cleaned prompt text for the tag, not the prompt_name
-                    formatted_output = f"<prompt:{latest.prompt}>{latest.response}</prompt:{latest.prompt}>"
-                    formatted_outputs.append(formatted_output)
-        
-        # Process all prompt chains
-        for prompt_name in prompt_names:
-            process_prompt_chain(prompt_name)
-        
+        with self._lock:
+            formatted_outputs = []
+            processed_prompts = set()  # To prevent infinite loops
+
+            for root in prompt_names:
+                if root in processed_prompts:
+                    continue
+                processed_prompts.add(root)
+
+                # depth-first walk: (prompt name, iterator over its history chain)
+                stack = [(root, iter(self._history_of(root)))]
+                while stack:
+                    prompt_name, chain_names = stack[-1]
+                    for history_prompt in chain_names:
+                        if history_prompt not in processed_prompts:
+                            processed_prompts.add(history_prompt)
+                            stack.append((history_prompt, iter(self._history_of(history_prompt))))
+                            break
+                    else:
+                        # history chain done; then add this prompt's formatted output
+                        stack.pop()
+                        block = self._formatted_block(prompt_name)
+                        if block:
+                            formatted_outputs.append(block)
+
         return '\n'.join(formatted_outputs)
\ No newline at end of file
@@ -1,47 +1,219 @@
 # Copyright (c) 2024 Antonio Quinonez
 # Licensed under the MIT License. See LICENSE in the project root for license information.
+import os
+import json
 import time
-from typing import Optional, List
-from copy import deepcopy
+import tempfile
+import threading
+import weakref
+from bisect import bisect_left, bisect_right
+from typing import Optional
+
+# turns kept in memory before the oldest are spilled to disk; 0 keeps everything in memory
+DEFAULT_MAX_MEMORY_TURNS = int(os.getenv('FFAI_PERMANENT_HISTORY_MAX_TURNS', 10_000))
+
+
+def _remove_spill_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
 
 class PermanentHistory:
-    def __init__(self):
-        self.turns = []
+    """
+    Append-only, timestamp-ordered log of conversation turns.
+
+    Timestamps never decrease, so range queries are binary searches. The newest
+    max_memory_turns turns are kept in memory; older turns are spilled in chunks to a
+    JSON-lines segment file and read back only when a query reaches them.
+
+    A temporary segment file is deleted by close(), or when the history is garbage collected
+    or the interpreter exits. Pickled copies carry their spilled turns with them and spill
+    to a file of their own.
+    """
+
+    def __init__(self, max_memory_turns: Optional[int] = None, spill_path: Optional[str] = None):
+        """
+        Args:
+            max_memory_turns: Turns kept in memory (default FFAI_PERMANENT_HISTORY_MAX_TURNS
+                or 10000; 0 keeps everything in memory)
+            spill_path: Segment file for spilled turns; a temporary file is created on first
+                spill if not given. Copies made by pickling do not share it.
+        """
+        self.turns = []  # in-memory turns, oldest first
+        self._timestamps = []  # timestamps of self.turns, for bisect
         self.timestamp = time.time()
+        self.max_memory_turns = DEFAULT_MAX_MEMORY_TURNS if max_memory_turns is None else max_memory_turns
+        self.spill_path = spill_path
 
-    def add_turn_assistant(self, content):
+        # spilled turns: timestamps and byte offsets into the segment file
+        self._spilled_timestamps = []
+        self._spilled_offsets = []
+        # removes a temporary segment file this history created
+        self._spill_file_finalizer = None
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # locks and finalizers cannot be copied or pickled
+        with self._lock:
+            state = self.__dict__.copy()
+            del state['_lock']
+            state.pop('_spill_file_finalizer', None)
+            # spilled turns travel inline, so the copy never reads a file this history may delete
+            state['_spilled_turns'] = self._read_spilled(0, len(self._spilled_timestamps))
+            state['spill_path'] = None
+            state['_spilled_timestamps'] = []
+            state['_spilled_offsets'] = []
+            return state
+
+    def __setstate__(self, state):
+        spilled_turns = state.pop('_spilled_turns', None)
+        self.__dict__.update(state)
+        self._spill_file_finalizer = None
+        self._lock = threading.RLock()
+        if spilled_turns:
+            self._write_spilled(spilled_turns)
+
+    def __len__(self):
+        return len(self._spilled_timestamps) + len(self.turns)
+
+    def _next_timestamp(self):
+        # never earlier than the last turn, even if the wall clock steps back
+        now = time.time()
+        if self._timestamps and now < self._timestamps[-1]:
+            return self._timestamps[-1]
+        return now
+
+    def _append(self, role, content):
+        timestamp = self._next_timestamp()
         self.turns.append({
-            "role": "assistant",
+            "role": role,
             "content": [
                 {
                     "type": "text",
                     "text": content
                 }
             ],
-            "timestamp": time.time()
+            "timestamp": timestamp
         })
+        self._timestamps.append(timestamp)
+
+        if self.max_memory_turns and len(self.turns) > self.max_memory_turns:
+            self._spill()
+
+    def add_turn_assistant(self, content):
+        with self._lock:
+            self._append("assistant", content)
 
     def add_turn_user(self, content):
-        if self.turns and self.turns[-1]["role"] == "user":
-            # If the last turn was a user, update its content instead of adding a new turn
-            self.turns[-1]["content"][0]["text"] += "\n" + content
-            self.turns[-1]["timestamp"] = time.time()
-        else:
-            self.turns.append({
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": content
-                    }
-                ],
-                "timestamp": time.time()
-            })
+        with self._lock:
+            if self.turns and self.turns[-1]["role"] == "user":
+                # If the last turn was a user, update its content instead of adding a new turn.
+                # It is always the newest turn, so moving its timestamp forward keeps the order.
+                self.turns[-1]["content"][0]["text"] += "\n" + content
+                timestamp = self._next_timestamp()
+                self.turns[-1]["timestamp"] = timestamp
+                self._timestamps[-1] = timestamp
+            else:
+                self._append("user", content)
+
+    def add_exchange(self, user_content, assistant_content):
+        """Adds a user turn and its assistant reply together, so concurrent callers cannot interleave them."""
+        with self._lock:
+            self.add_turn_user(user_content)
+            self.add_turn_assistant(assistant_content)
+
+    # ======================================================================================
+    # SPILL TO DISK
+    # ======================================================================================
+    def _spill(self):
+        """Move the oldest quarter of the in-memory turns to the segment file (the newest turn always stays)"""
+        count = max(1, self.max_memory_turns // 4)
+        count = min(count, len(self.turns) - 1)
+        if count <= 0:
+            return
+
+        self._write_spilled(self.turns[:count])
+        del self.turns[:count]
+        del self._timestamps[:count]
+
+    def _write_spilled(self, turns):
+        """Append turns, older than any in memory, to the segment file"""
+        if self.spill_path is None:
+            fd, self.spill_path = tempfile.mkstemp(prefix='ffai_history_', suffix='.jsonl')
+            os.close(fd)
+            # the file goes with this history even if close() is never called
+            self._spill_file_finalizer = weakref.finalize(self, _remove_spill_file, self.spill_path)
+
+        with open(self.spill_path, 'ab') as f:
+            offset = f.tell()
+            for turn in turns:
+                line = json.dumps(turn).encode('utf-8') + b'\n'
+                self._spilled_offsets.append(offset)
+                self._spilled_timestamps.append(turn["timestamp"])
+                offset += len(line)
+                f.write(line)
 
+    def _read_spilled(self, start, stop):
+        """Spilled turns start..stop-1, read from the segment file"""
+        if start >= stop:
+            return []
+        with open(self.spill_path, 'rb') as f:
+            f.seek(self._spilled_offsets[start])
+            return [json.loads(f.readline()) for _ in range(stop - start)]
+
+    def _slice(self, start, stop):
+        """Turns start..stop-1 of the whole log; spilled turns are fresh copies, in-memory turns are not"""
+        spilled = len(self._spilled_timestamps)
+        turns = self._read_spilled(min(start, spilled), min(stop, spilled))
+        turns.extend(self.turns[max(start - spilled, 0):max(stop - spilled, 0)])
+        return turns
+
+    def _position(self, timestamp, side):
+        """Index in the whole log of the first turn after (side='right') or at (side='left') timestamp"""
+        search = bisect_right if side == 'right' else bisect_left
+        spilled = len(self._spilled_timestamps)
+        position = search(self._spilled_timestamps, timestamp)
+        if position < spilled:
+            return position
+        return spilled + search(self._timestamps, timestamp)
+
+    # ======================================================================================
+    # QUERIES
+    # ======================================================================================
     def get_all_turns(self):
         """Returns all turns with their timestamps."""
-        return deepcopy(self.turns)  # Return a deep copy to prevent modification
+        with self._lock:
+            spilled = self._read_spilled(0, len(self._spilled_timestamps))
+            # copy the two levels a caller could modify, instead of a generic deepcopy
+            return spilled + [
+                {**turn, "content": [dict(block) for block in turn["content"]]}
+                for turn in self.turns
+            ]
 
     def get_turns_since(self, timestamp: float):
         """Returns all turns that occurred after the specified timestamp."""
-        return [turn for turn in self.turns if turn["timestamp"] > timestamp]
\ No newline at end of file
+        with self._lock:
+            return self._slice(self._position(timestamp, 'right'), len(self))
+
+    def get_turns_between(self, start: float, end: float):
+        """Returns the turns with start <= timestamp < end."""
+        with self._lock:
+            return self._slice(self._position(start, 'left'), self._position(end, 'left'))
+
+    def get_recent_turns(self, n: int):
+        """Returns the last n turns."""
+        with self._lock:
+            return self._slice(max(len(self) - n, 0), len(self))
+
+    def close(self):
+        """Deletes the segment file, if any; spilled turns are no longer available afterwards."""
+        with self._lock:
+            if self._spill_file_finalizer is not None:
+                self._spill_file_finalizer.detach()
+                self._spill_file_finalizer = None
+            if self.spill_path:
+                _remove_spill_file(self.spill_path)
+            self._spilled_timestamps = []
+            self._spilled_offsets = []
@@ -0,0 +1,114 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from typing import List, Dict, Tuple, Iterator
+from array import array
+from collections import Counter
+import logging
+import math
+import re
+
+# numpy is optional; only relevance retrieval needs it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+_TERMS = re.compile(r'\w+')
+
+# rough size of a text in tokens, for retrieval budgets (about 4 characters per token in English)
+CHARS_PER_TOKEN = 4
+
+
+def terms_of(text: str) -> List[str]:
+    return _TERMS.findall(text.lower())
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class BM25Index:
+    """
+    Incremental Okapi BM25 index over short documents (here, past interactions).
+
+    Each term's postings are two growable arrays (document ids and term frequencies), so
+    adding a document costs O(its terms) and never rebuilds anything. A query reads the
+    postings of its terms as NumPy views and scores them in a few vector operations.
+
+    Not synchronized: FFAI_AzureOpenAI calls it with its lock held.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        if np is None:
+            logger.error("numpy is not installed")
+            raise ImportError("BM25Index requires the 'numpy' package")
+
+        self.k1 = k1
+        self.b = b
+        self._term_ids: Dict[str, int] = {}
+        self._postings_docs: List[array] = []  # term id -> document ids, ascending
+        self._postings_tfs: List[array] = []  # term id -> frequencies in those documents
+        self._doc_lengths = array('f')
+        self._total_length = 0.0
+
+    def __len__(self) -> int:
+        return len(self._doc_lengths)
+
+    def add(self, text: str) -> int:
+        """Index a document; returns its id (ids are assigned 0, 1, 2, ...)"""
+        doc_id = len(self._doc_lengths)
+        terms = terms_of(text)
+        for term, frequency in Counter(terms).items():
+            term_id = self._term_ids.get(term)
+            if term_id is None:
+                term_id = self._term_ids[term] = len(self._postings_docs)
+                self._postings_docs.append(array('i'))
+                self._postings_tfs.append(array('f'))
+            self._postings_docs[term_id].append(doc_id)
+            self._postings_tfs[term_id].append(frequency)
+
+        self._doc_lengths.append(len(terms))
+        self._total_length += len(terms)
+        return doc_id
+
+    def scores(self, query: str) -> 'np.ndarray':
+        """BM25 score of every document for the query (0 for documents sharing no term)"""
+        count = len(self._doc_lengths)
+        scores = np.zeros(count, dtype=np.float64)
+        if not count:
+            return scores
+
+        average_length = self._total_length / count or 1.0
+        doc_lengths = np.frombuffer(self._doc_lengths, dtype=np.float32)
+        for term in set(terms_of(query)):
+            term_id = self._term_ids.get(term)
+            if term_id is None:
+                continue
+            docs = np.frombuffer(self._postings_docs[term_id], dtype=np.int32)
+            frequencies = np.frombuffer(self._postings_tfs[term_id], dtype=np.float32)
+            idf = math.log(1.0 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            length_norm = self.k1 * (1.0 - self.b + self.b * doc_lengths[docs] / average_length)
+            # each document appears once in a term's postings, so fancy-index += is safe
+            scores[docs] += idf * frequencies * (self.k1 + 1.0) / (frequencies + length_norm)
+        return scores
+
+    def ranked(self, query: str, batch: int = 32) -> Iterator[Tuple[int, float]]:
+        """
+        (document id, score) of the documents sharing a term with the query, best first (ties:
+        older first). Candidates are sorted a batch at a time, so taking the first few is cheap.
+        """
+        scores = self.scores(query)
+        candidates = np.flatnonzero(scores > 0)
+        while len(candidates):
+            if len(candidates) > batch:
+                split = np.argpartition(-scores[candidates], batch)
+                best, candidates = candidates[split[:batch]], candidates[split[batch:]]
+            else:
+                best, candidates = candidates, candidates[:0]
+            for doc_id in best[np.lexsort((best, -scores[best]))].tolist():
+                yield doc_id, float(scores[doc_id])
+            batch *= 2
@@ -0,0 +1,102 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from typing import Optional, Any, Tuple
+import json
+import logging
+import re
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# orjson is optional; it parses large responses several times faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FENCE = '```'
+JSON_OPENERS = ('{', '[')
+JSON_CLOSERS = {'{': '}', '[': ']'}
+_LEADING_SPACE = re.compile(r'\s*')
+
+
+def loads(text: str) -> Any:
+    """Parse JSON with orjson when installed, else the standard library"""
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # orjson rejects a few inputs json accepts (e.g. NaN, big ints); let json decide
+            pass
+    return json.loads(text)
+
+
+def _fenced_body(response: str, fence_start: int, fence_end: int) -> Optional[str]:
+    """Return the body of the fence opened at fence_start and closed at fence_end, if it is JSON-shaped"""
+    line_end = response.find('\n', fence_start, fence_end)
+    if line_end == -1:
+        return None
+
+    language = response[fence_start + len(FENCE):line_end].strip().lower()
+    if language not in ('', 'json'):
+        return None
+
+    body = response[line_end + 1:fence_end].strip()
+    return body if body[:1] in JSON_OPENERS else None
+
+
+def _strip_bounds(text: str) -> Tuple[int, int]:
+    """Indexes of the first and one-past-last non-whitespace characters, without copying text"""
+    start = _LEADING_SPACE.match(text).end()
+    end = len(text)
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def extract_json_text(response: str) -> Optional[str]:
+    """
+    Locate the JSON object or array in a model response without parsing it.
+
+    Handles a bare object/array, a response that is a ```json (or bare ```) fenced block,
+    and a ```json block embedded in surrounding prose. Returns None if nothing JSON-shaped is found.
+    """
+    if not isinstance(response, str):
+        return None
+
+    start, end = _strip_bounds(response)
+    first = response[start:start + 1]
+
+    if first in JSON_OPENERS:
+        return response[start:end] if response[end - 1:end] == JSON_CLOSERS[first] else None
+
+    if response.startswith(FENCE, start):
+        # the whole response is a fenced block; its closing fence is at the end
+        fence_end = response.rfind(FENCE, start + len(FENCE), end)
+        return _fenced_body(response, start, fence_end if fence_end != -1 else end)
+
+    embedded = response.find(FENCE + 'json')
+    if embedded != -1:
+        fence_end = response.find(FENCE, embedded + len(FENCE))
+        return _fenced_body(response, embedded, fence_end if fence_end != -1 else end)
+
+    return None
+
+
+def parse_response(response: str) -> Any:
+    """
+    Turn a JSON response into a dict or list; anything else is returned unchanged.
+
+    A response that looks like JSON but does not parse (e.g. prose in brackets) is returned
+    unchanged.
+    """
+    json_text = extract_json_text(response)
+    if json_text is None:
+        return response
+
+    try:
+        return loads(json_text)
+    except ValueError as e:
+        logger.debug("Response is not JSON, keeping the text: %s", e)
+        return response
@@ -0,0 +1,272 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from typing import Optional, List, Dict, Hashable, Tuple
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+
+# numpy is optional; only the semantic cache needs it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIMILARITY_THRESHOLD = float(os.getenv('FFAI_SEMANTIC_CACHE_THRESHOLD', 0.95))
+DEFAULT_MAX_ENTRIES = int(os.getenv('FFAI_SEMANTIC_CACHE_MAX_ENTRIES', 5_000))
+
+_NUMBERS = re.compile(r'\d+(?:[.,]\d+)*')
+_WORDS = re.compile(r'\w+')
+
+# multiplicative hashing constants for the n-gram buckets
+_GRAM_MULTIPLIER = 1_000_003
+_BUCKET_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def numbers_in(text: str) -> Tuple[str, ...]:
+    """The numbers in a text, in order; prompts that differ only in a number must not share an answer"""
+    return tuple(_NUMBERS.findall(text))
+
+
+class HashedNgramVectorizer:
+    """
+    Embeds a text as signed, hashed counts of its character n-grams and word n-grams,
+    L2-normalized.
+
+    Case, punctuation and whitespace are dropped first, so reformatted prompts embed
+    identically and small edits keep most of their n-grams. Word n-grams make a changed
+    word (e.g. 'I' and 'II') count for more than its few characters. No vocabulary is kept:
+    a text is embedded without reference to any other.
+    """
+
+    def __init__(self, dim: int = 1024, char_ngrams: Tuple[int, ...] = (3, 5), word_ngrams: Tuple[int, ...] = (1, 2)):
+        if dim < 2 or dim & (dim - 1):
+            raise ValueError("dim must be a power of two")
+        self.dim = dim
+        self.char_ngrams = char_ngrams
+        self.word_ngrams = word_ngrams
+        self._shift = np.uint64(64 - (dim.bit_length() - 1))
+
+    def _add_ngrams(self, vector: 'np.ndarray', tokens: 'np.ndarray', sizes: Tuple[int, ...], salt: int) -> None:
+        for n in sizes:
+            count = len(tokens) - n + 1
+            if count <= 0:
+                continue
+            # polynomial hash of every n-gram at once (uint64 arithmetic wraps)
+            hashes = np.full(count, salt + n, dtype=np.uint64)
+            for k in range(n):
+                hashes = hashes * np.uint64(_GRAM_MULTIPLIER) + tokens[k:k + count]
+            hashes *= np.uint64(_BUCKET_MULTIPLIER)
+            buckets = (hashes >> self._shift).astype(np.intp)
+            signs = np.where(hashes & np.uint64(1 << 31), 1.0, -1.0)
+            vector += np.bincount(buckets, weights=signs, minlength=self.dim)
+
+    def embed(self, text: str) -> 'np.ndarray':
+        words = _WORDS.findall(text.lower())
+        characters = np.frombuffer((' ' + ' '.join(words) + ' ').encode('utf-32-le'), dtype=np.uint32)
+        word_hashes = np.fromiter((zlib.crc32(word.encode('utf-8')) for word in words), dtype=np.uint64, count=len(words))
+
+        vector = np.zeros(self.dim, dtype=np.float64)
+        self._add_ngrams(vector, characters.astype(np.uint64), self.char_ngrams, 0)
+        self._add_ngrams(vector, word_hashes, self.word_ngrams, 100)
+
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.astype(np.float32)
+
+
+def _grown(array: 'np.ndarray', capacity: int) -> 'np.ndarray':
+    grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class SemanticCache:
+    """
+    Returns a stored response for prompts similar to one answered before.
+
+    Prompts are embedded with a HashedNgramVectorizer into the rows of one matrix, and a
+    lookup is a single matrix-vector product (cosine similarity) over it. A stored response
+    is returned only within the same scope -- the wrapper uses the model, the system
+    instructions, the exact history context and the numbers in the prompt -- and only when
+    the similarity is at least the threshold.
+
+    Rows are added one at a time; when max_entries is reached the least recently used
+    entry's row is reused. Entries older than ttl seconds are never returned.
+
+        ffai = FFAI_AzureOpenAI(client, semantic_cache=SemanticCache(threshold=0.95))
+    """
+
+    def __init__(self, threshold: Optional[float] = None, max_entries: Optional[int] = None,
+                 ttl: Optional[float] = None, vectorizer: Optional[HashedNgramVectorizer] = None):
+        """
+        Args:
+            threshold: Minimum cosine similarity for a hit (default FFAI_SEMANTIC_CACHE_THRESHOLD or 0.95)
+            max_entries: Most entries kept (default FFAI_SEMANTIC_CACHE_MAX_ENTRIES or 5000)
+            ttl: Seconds an entry stays valid (None: until evicted)
+            vectorizer: Defaults to HashedNgramVectorizer()
+        """
+        if np is None:
+            logger.error("numpy is not installed")
+            raise ImportError("SemanticCache requires the 'numpy' package")
+
+        self.threshold = DEFAULT_SIMILARITY_THRESHOLD if threshold is None else threshold
+        self.max_entries = DEFAULT_MAX_ENTRIES if max_entries is None else max_entries
+        if self.max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.ttl = ttl
+        self.vectorizer = vectorizer or HashedNgramVectorizer()
+
+        # row i holds entry i; rows of removed entries have scope -1 until reused
+        self._vectors = np.zeros((0, self.vectorizer.dim), dtype=np.float32)
+        self._scopes = np.zeros(0, dtype=np.int32)
+        self._created = np.zeros(0, dtype=np.float64)
+        self._last_used = np.zeros(0, dtype=np.float64)
+        self._responses: List[Optional[str]] = []
+        self._size = 0  # rows in use, including removed ones
+        self._free: List[int] = []  # removed rows, reused first
+        # scope -> id, and id -> [scope, rows]; a scope is forgotten with its last row
+        self._scope_ids: Dict[Hashable, int] = {}
+        self._scope_rows: Dict[int, list] = {}
+        self._next_scope_id = 0
+
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'adds': 0, 'evictions': 0}
+
+    def __getstate__(self):
+        # locks cannot be copied or pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size - len(self._free)
+
+    def _claim_scope(self, scope: Hashable) -> int:
+        """The id of a scope, counting one more row in it (call with the lock held)"""
+        scope_id = self._scope_ids.get(scope)
+        if scope_id is None:
+            scope_id = self._scope_ids[scope] = self._next_scope_id
+            self._scope_rows[scope_id] = [scope, 0]
+            self._next_scope_id += 1
+        self._scope_rows[scope_id][1] += 1
+        return scope_id
+
+    def _release_row(self, row: int) -> None:
+        """Forget the entry in a row (call with the lock held)"""
+        scope_id = int(self._scopes[row])
+        if scope_id < 0:
+            return
+        scope_rows = self._scope_rows[scope_id]
+        scope_rows[1] -= 1
+        if not scope_rows[1]:
+            del self._scope_ids[scope_rows[0]]
+            del self._scope_rows[scope_id]
+        self._scopes[row] = -1
+        self._responses[row] = None
+
+    # ======================================================================================
+    # LOOKUP
+    # ======================================================================================
+    def lookup(self, prompt: str, scope: Hashable = None) -> Optional[Tuple[str, float]]:
+        """(response, similarity) of the most similar entry in the scope, or None below the threshold"""
+        vector = self.vectorizer.embed(prompt)
+        with self._lock:
+            scope_id = self._scope_ids.get(scope)
+            if scope_id is None or not len(self):
+                self.stats['misses'] += 1
+                return None
+
+            similarities = self._vectors[:self._size] @ vector
+            excluded = self._scopes[:self._size] != scope_id
+            if self.ttl is not None:
+                excluded |= self._created[:self._size] < time.time() - self.ttl
+            similarities[excluded] = -np.inf
+
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.stats['misses'] += 1
+                return None
+
+            self._last_used[best] = time.monotonic()
+            self.stats['hits'] += 1
+            return self._responses[best], similarity
+
+    # ======================================================================================
+    # UPDATES
+    # ======================================================================================
+    def _allocate_row(self) -> int:
+        """A row for a new entry: a free one, a new one, or the least recently used (call with the lock held)"""
+        if self._free:
+            return self._free.pop()
+
+        if self._size >= self.max_entries:
+            row = int(np.argmin(self._last_used[:self._size]))
+            self._release_row(row)
+            self.stats['evictions'] += 1
+            return row
+
+        if self._size == len(self._vectors):
+            capacity = min(max(2 * len(self._vectors), 64), self.max_entries)
+            self._vectors = _grown(self._vectors, capacity)
+            self._scopes = _grown(self._scopes, capacity)
+            self._created = _grown(self._created, capacity)
+            self._last_used = _grown(self._last_used, capacity)
+            self._responses.extend([None] * (capacity - len(self._responses)))
+        self._size += 1
+        return self._size - 1
+
+    def add(self, prompt: str, response: str, scope: Hashable = None) -> None:
+        """Store the response to a prompt"""
+        vector = self.vectorizer.embed(prompt)
+        with self._lock:
+            row = self._allocate_row()
+            self._vectors[row] = vector
+            self._scopes[row] = self._claim_scope(scope)
+            self._created[row] = time.time()
+            self._last_used[row] = time.monotonic()
+            self._responses[row] = response
+            self.stats['adds'] += 1
+
+    def _remove_rows(self, rows: 'np.ndarray') -> int:
+        """Mark rows removed (call with the lock held)"""
+        for row in rows.tolist():
+            self._release_row(row)
+            self._free.append(row)
+        return len(rows)
+
+    def invalidate(self, scope: Hashable = None) -> int:
+        """Remove every entry of a scope; returns how many were removed"""
+        with self._lock:
+            scope_id = self._scope_ids.get(scope)
+            if scope_id is None:
+                return 0
+            return self._remove_rows(np.flatnonzero(self._scopes[:self._size] == scope_id))
+
+    def evict_expired(self) -> int:
+        """Remove entries older than ttl; returns how many were removed"""
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            expired = (self._created[:self._size] < time.time() - self.ttl) & (self._scopes[:self._size] >= 0)
+            return self._remove_rows(np.flatnonzero(expired))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._size = 0
+            self._free = []
+            self._scope_ids = {}
+            self._scope_rows = {}
+            self._responses = [None] * len(self._responses)
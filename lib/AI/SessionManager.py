@@ -0,0 +1,394 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from abc import ABC, abstractmethod
+from typing import Optional, List, Dict, Any, Iterator
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+import zlib
+
+from .FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from .Diagnostics import Preview
+from .ConversationContext import fresh_conversation
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SESSION_ID_PATTERN = re.compile(r'^[a-zA-Z0-9_.-]{1,128}$')
+
+
+class SessionStore(ABC):
+    """Where evicted sessions are kept. Implement save/load/delete for another backend."""
+
+    @abstractmethod
+    def save(self, session_id: str, data: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def load(self, session_id: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        pass
+
+
+class DirectorySessionStore(SessionStore):
+    """
+    One file per session in a directory.
+
+    Sessions are pickled; keep the directory private to the service, since loading a
+    session file runs pickle on its contents.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv('FFAI_SESSION_DIR') or tempfile.mkdtemp(prefix='ffai_sessions_')
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, session_id: str) -> str:
+        return os.path.join(self.path, f"{session_id}.session")
+
+    def save(self, session_id: str, data: bytes) -> None:
+        # write then rename, so a crash never leaves a partial session file
+        temp_path = self._file(session_id) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self._file(session_id))
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        try:
+            with open(self._file(session_id), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, session_id: str) -> None:
+        try:
+            os.remove(self._file(session_id))
+        except FileNotFoundError:
+            pass
+
+
+class SessionClient:
+    """
+    A per-session view of a shared client: the session's own conversation on top of the
+    shared client's configuration and connection pool.
+    """
+    # one conversation per session, whatever the shared client's scope
+    conversation_scope = 'shared'
+
+    def __init__(self, client: Any, messages: Optional[List[Dict[str, Any]]] = None):
+        self._client = client
+        self.messages: List[Dict[str, Any]] = messages if messages is not None else []
+        # usage of the last fallback call per thread (freed with the SessionClient, unlike a ContextVar)
+        self._fallback_usage = threading.local()
+
+    @property
+    def model(self) -> str:
+        return self._client.model
+
+    @property
+    def conversation_history(self) -> List[Dict[str, Any]]:
+        return self.messages
+
+    @conversation_history.setter
+    def conversation_history(self, value: List[Dict[str, Any]]) -> None:
+        self.messages = value
+
+    @property
+    def last_usage(self) -> Optional[Dict[str, Any]]:
+        if hasattr(self._client, 'use_conversation'):
+            # already local to the calling thread/task
+            return getattr(self._client, 'last_usage', None)
+        return getattr(self._fallback_usage, 'value', None)
+
+    def generate_response(self, prompt: str, **kwargs) -> str:
+        # clients without use_conversation() are called through a per-call copy holding the messages
+        with fresh_conversation(self._client, self.messages) as client:
+            response = client.generate_response(prompt, **kwargs)
+            if client is not self._client:
+                self._fallback_usage.value = getattr(client, 'last_usage', None)
+                # the client may have replaced the list (e.g. clear_conversation)
+                self.messages = client.conversation_history
+        return response
+
+    def clear_conversation(self) -> None:
+        self.messages = []
+
+    def __getattr__(self, name: str) -> Any:
+        """
+        The shared client's settings (system_instructions, temperature, max_tokens, ...), so the
+        wrapper's fingerprints, cache scopes and savings estimates see them. Its methods are not
+        exposed; a session is not a stand-in for use_conversation() and the like.
+        """
+        # private names (and lookups before __init__ has run, e.g. while unpickling) are not delegated
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = getattr(self._client, name)
+        if callable(value):
+            raise AttributeError(f"{type(self).__name__} does not expose {name}()")
+        return value
+
+
+class _Session:
+    """
+    A session in memory. ffai is None while the session is being loaded from the store (or
+    closed); lock is held meanwhile, and around each save, so saves, loads and close_session
+    of one session never overlap.
+    """
+    __slots__ = ('ffai', 'last_used', 'in_use', 'lock')
+
+    def __init__(self, ffai: Optional[FFAI_AzureOpenAI] = None):
+        self.ffai = ffai
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+
+class SessionManager:
+    """
+    Many end-user conversations over one shared client.
+
+    Each session_id gets its own FFAI_AzureOpenAI histories and conversation, while the
+    underlying client (and its HTTP connection pool) is shared. At most max_sessions are
+    kept in memory; the least recently used sessions, and sessions idle for longer than
+    idle_ttl seconds, are saved to the store and dropped. They are loaded again on their
+    next request.
+
+        manager = SessionManager(FFAzureOpenAI(), max_sessions=500, idle_ttl=900)
+        manager.generate_response(user_id, prompt, prompt_name="answer")
+    """
+
+    def __init__(self, client: Any, max_sessions: int = 1000, idle_ttl: Optional[float] = None,
+                 store: Optional[SessionStore] = None, **wrapper_kwargs):
+        """
+        Args:
+            client: The shared client (e.g. FFAzureOpenAI)
+            max_sessions: Most sessions kept in memory
+            idle_ttl: Seconds of inactivity after which a session is evicted (None: LRU only)
+            store: Where evicted sessions go; defaults to a DirectorySessionStore
+                (FFAI_SESSION_DIR, or a new temporary directory)
+            wrapper_kwargs: Passed to each session's FFAI_AzureOpenAI (price_table, hooks, dedupe_text)
+        """
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1")
+
+        self.client = client
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.store = store or DirectorySessionStore()
+        self.wrapper_kwargs = wrapper_kwargs
+
+        self._sessions: OrderedDict[str, _Session] = OrderedDict()  # least recently used first
+        self._evicting: Dict[str, _Session] = {}  # removed, still being saved
+        self._lock = threading.RLock()
+
+        self.stats = {'created': 0, 'rehydrated': 0, 'evicted': 0}
+
+    # ======================================================================================
+    # SESSIONS
+    # ======================================================================================
+    def _new_wrapper(self, messages: Optional[List[Dict[str, Any]]] = None) -> FFAI_AzureOpenAI:
+        return FFAI_AzureOpenAI(SessionClient(self.client, messages), **self.wrapper_kwargs)
+
+    def _activate(self, session_id: str) -> tuple:
+        """
+        Find the session, or add an empty one for the caller to load, and mark it most recently
+        used (call with the lock held). Returns (session, whether the caller must load it); a new
+        session is returned with its lock held.
+        """
+        session = self._sessions.get(session_id)
+        new = False
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+        else:
+            session = self._evicting.pop(session_id, None)
+            if session is None:
+                session = _Session()
+                session.lock.acquire()
+                new = True
+            self._sessions[session_id] = session
+
+        session.last_used = time.monotonic()
+        return session, new
+
+    def _rehydrate(self, session_id: str, session: _Session) -> None:
+        """Load the session from the store, or start it empty (without the manager lock)"""
+        data = self.store.load(session_id)
+        if data is None:
+            logger.debug("Creating session %s", session_id)
+            session.ffai = self._new_wrapper()
+            stat = 'created'
+        else:
+            logger.debug("Rehydrating session %s", session_id)
+            state = pickle.loads(zlib.decompress(data))
+            ffai = self._new_wrapper(state['conversation'])
+            ffai.load_state(state['histories'])
+            session.ffai = ffai
+            stat = 'rehydrated'
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _release(self, session_id: str, session: _Session) -> None:
+        """Drop a use of a session that could not be loaded (call with the lock held)"""
+        session.in_use -= 1
+        if self._sessions.get(session_id) is session:
+            del self._sessions[session_id]
+
+    def _checkout(self, session_id: str) -> _Session:
+        """The loaded session, marked in use"""
+        while True:
+            with self._lock:
+                session, new = self._activate(session_id)
+                session.in_use += 1
+                victims = self._select_victims()
+
+            try:
+                if new:
+                    try:
+                        self._rehydrate(session_id, session)
+                    except BaseException:
+                        with self._lock:
+                            self._release(session_id, session)
+                        raise
+                    finally:
+                        session.lock.release()
+                    return session
+            finally:
+                self._save_victims(victims)
+
+            if session.ffai is None:
+                # another request is loading it, or close_session is deleting it
+                with session.lock:
+                    pass
+                if session.ffai is None:
+                    with self._lock:
+                        self._release(session_id, session)
+                    continue
+            return session
+
+    @contextmanager
+    def session(self, session_id: str) -> Iterator[FFAI_AzureOpenAI]:
+        """
+        The session's FFAI_AzureOpenAI, held in memory for the duration of the block:
+
+            with manager.session(user_id) as ffai:
+                ffai.generate_response(prompt)
+                history = ffai.get_interaction_history()
+        """
+        if not isinstance(session_id, str) or not SESSION_ID_PATTERN.match(session_id):
+            raise ValueError(f"Invalid session_id: {Preview(session_id)}")
+
+        session = self._checkout(session_id)
+        try:
+            yield session.ffai
+        finally:
+            with self._lock:
+                session.in_use -= 1
+                session.last_used = time.monotonic()
+
+    def generate_response(self, session_id: str, prompt: str, **kwargs) -> str:
+        """FFAI_AzureOpenAI.generate_response within the session"""
+        with self.session(session_id) as ffai:
+            return ffai.generate_response(prompt, **kwargs)
+
+    # ======================================================================================
+    # EVICTION
+    # ======================================================================================
+    def _select_victims(self) -> List[tuple]:
+        """Remove idle and least recently used sessions over capacity (call with the lock held)"""
+        victims = []
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            over_capacity = len(self._sessions) > self.max_sessions
+            idle = self.idle_ttl is not None and now - session.last_used > self.idle_ttl
+            if not (over_capacity or idle):
+                break  # sessions are in LRU order, so the rest are newer
+            if session.in_use:
+                continue
+            del self._sessions[session_id]
+            self._evicting[session_id] = session
+            victims.append((session_id, session))
+        return victims
+
+    def _save(self, session_id: str, session: _Session, evicted: bool = False) -> int:
+        # saves export the live state, so serializing them means the last write is the newest state
+        with session.lock:
+            with self._lock:
+                # closed, or evicted and saved since (and maybe loaded again as a new session)
+                current = self._sessions.get(session_id) is session or self._evicting.get(session_id) is session
+            if not current or session.ffai is None:
+                return 0
+            ffai = session.ffai
+            state = {'conversation': ffai.client.messages, 'histories': ffai.export_state()}
+            data = zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+            self.store.save(session_id, data)
+            if evicted:
+                with self._lock:
+                    if self._evicting.get(session_id) is session:
+                        del self._evicting[session_id]
+        return len(data)
+
+    def _save_victims(self, victims: List[tuple]) -> None:
+        """Save evicted sessions outside the manager lock; a request meanwhile reclaims the session"""
+        for session_id, session in victims:
+            size = self._save(session_id, session, evicted=True)
+            with self._lock:
+                self.stats['evicted'] += 1
+            logger.debug("Evicted session %s (%d bytes)", session_id, size)
+
+    def evict_idle(self) -> int:
+        """Evict sessions idle for longer than idle_ttl; returns how many were evicted"""
+        with self._lock:
+            victims = self._select_victims()
+        self._save_victims(victims)
+        return len(victims)
+
+    def flush(self) -> None:
+        """Save every in-memory session to the store (they stay in memory)"""
+        with self._lock:
+            sessions = list(self._sessions.items())
+        for session_id, session in sessions:
+            self._save(session_id, session)
+
+    def close_session(self, session_id: str) -> None:
+        """Forget a session, in memory and in the store"""
+        # requests for the session wait on the marker's lock until it is gone from the store
+        marker = _Session()
+        marker.lock.acquire()
+        with self._lock:
+            sessions = [self._sessions.pop(session_id, None), self._evicting.pop(session_id, None)]
+            self._evicting[session_id] = marker
+
+        try:
+            for session in sessions:
+                if session is not None:
+                    # waits for a save in progress; later ones find the session gone
+                    with session.lock:
+                        pass
+            self.store.delete(session_id)
+        finally:
+            with self._lock:
+                if self._evicting.get(session_id) is marker:
+                    del self._evicting[session_id]
+                if self._sessions.get(session_id) is marker and not marker.in_use:
+                    del self._sessions[session_id]
+            marker.lock.release()
+
+    def active_sessions(self) -> List[str]:
+        """Session ids in memory, least recently used first"""
+        with self._lock:
+            return list(self._sessions)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
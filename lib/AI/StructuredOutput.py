@@ -0,0 +1,118 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from typing import Optional, Dict, Any
+import json
+import logging
+import re
+
+from pydantic import BaseModel, TypeAdapter
+
+from .ResponseParser import extract_json_text
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class StructuredOutput:
+    """
+    A response type prepared once for structured output.
+
+    Holds the JSON schema generated from a Pydantic model (or any type pydantic can adapt),
+    its compiled validator, and the request fragments each provider expects. Use
+    StructuredOutput.for_model() so every client shares one instance per type:
+
+        class Answer(BaseModel):
+            city: str
+            confidence: float
+
+        answer_format = StructuredOutput.for_model(Answer)
+        client.generate_response(prompt, response_format=answer_format)
+        answer = answer_format.validate_json(response)
+    """
+
+    _registry: Dict[Any, 'StructuredOutput'] = {}
+
+    def __init__(self, model: Any, name: Optional[str] = None):
+        self.model = model
+        self.adapter = TypeAdapter(model)  # compiled once, reused for every validation
+        self.schema: Dict[str, Any] = self.adapter.json_schema()
+
+        raw_name = name or getattr(model, '__name__', None) or 'response'
+        # provider schema/tool names allow only [a-zA-Z0-9_-], up to 64 chars
+        self.name = re.sub(r'[^a-zA-Z0-9_-]', '_', raw_name)[:64]
+
+        self._openai_format = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": self.name,
+                "schema": self.schema
+            }
+        }
+        self._anthropic_tool = {
+            "name": self.name,
+            "description": f"Record the response as a {self.name} object.",
+            "input_schema": self.schema
+        }
+
+    @classmethod
+    def for_model(cls, model: Any, name: Optional[str] = None) -> 'StructuredOutput':
+        """Get the shared StructuredOutput for a type, building its schema and validator on first use"""
+        key = (model, name)
+        structured = cls._registry.get(key)
+        if structured is None:
+            logger.debug("Building structured output schema for %s", model)
+            structured = cls._registry[key] = cls(model, name)
+        return structured
+
+    # ==================================================================================
+    # PROVIDER REQUEST FORMATS
+    # ==================================================================================
+    def openai_response_format(self) -> Dict[str, Any]:
+        """response_format for OpenAI, Azure OpenAI and the Gemini OpenAI-compatible endpoint"""
+        return self._openai_format
+
+    def anthropic_tool(self) -> Dict[str, Any]:
+        """A tool whose input schema is the response schema"""
+        return self._anthropic_tool
+
+    def anthropic_tool_choice(self) -> Dict[str, Any]:
+        """Forces Claude to answer by calling the response tool"""
+        return {"type": "tool", "name": self.name}
+
+    # ==================================================================================
+    # VALIDATION
+    # ==================================================================================
+    def validate_json(self, text: str) -> Any:
+        """Validate a JSON response (fenced or bare) into the response type"""
+        return self.adapter.validate_json(extract_json_text(text) or text)
+
+    def validate_python(self, data: Any) -> Any:
+        """Validate already-parsed data into the response type"""
+        return self.adapter.validate_python(data)
+
+
+def resolve_structured_output(response_format: Any) -> Optional[StructuredOutput]:
+    """Return the StructuredOutput for a StructuredOutput or Pydantic model; None for raw formats"""
+    if isinstance(response_format, StructuredOutput):
+        return response_format
+    if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+        return StructuredOutput.for_model(response_format)
+    return None
+
+
+def openai_response_format(response_format: Any) -> Any:
+    """Translate a response_format argument for OpenAI-style APIs; raw dicts and strings pass through"""
+    structured = resolve_structured_output(response_format)
+    return structured.openai_response_format() if structured else response_format
+
+
+def anthropic_tool_response(response: Any) -> str:
+    """
+    Return the tool input of a forced tool-use response as JSON text. Raises ValueError when
+    there is none, e.g. when the response stopped at max_tokens before the tool call.
+    """
+    for block in response.content:
+        if getattr(block, 'type', None) == 'tool_use':
+            return json.dumps(block.input)
+    raise ValueError(f"Response has no structured output (stop_reason: {getattr(response, 'stop_reason', None)})")
@@ -0,0 +1,231 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from typing import Optional, List, Dict, Any
+import logging
+import math
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class TraceHook:
+    """
+    Base class for tracing hooks. Override the callbacks you need.
+
+    start_span() may return any context object; it is handed back to end_span().
+    """
+
+    def start_span(self, name: str, attributes: Dict[str, Any]) -> Any:
+        return None
+
+    def start_span_under(self, name: str, attributes: Dict[str, Any], parent: Any) -> Any:
+        """
+        Like start_span(), for a span that belongs to an earlier span, which may have ended;
+        parent is the context start_span() returned for it.
+        """
+        return self.start_span(name, attributes)
+
+    def end_span(self, name: str, context: Any, duration: float, attributes: Dict[str, Any]) -> None:
+        pass
+
+
+class Span:
+    """An open span. Use as a context manager; attributes set before exit are passed to end_span()"""
+    __slots__ = ('tracer', 'name', 'attributes', 'parent', 'contexts', 'start_time')
+
+    def __init__(self, tracer: 'Tracer', name: str, attributes: Dict[str, Any], parent: Optional['Span'] = None):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.contexts = []
+        self.start_time = 0.0
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> 'Span':
+        contexts = []
+        parent_contexts = self.parent.contexts if self.parent is not None else []
+        for position, hook in enumerate(self.tracer.hooks):
+            parent = parent_contexts[position] if position < len(parent_contexts) else None
+            try:
+                if parent is None:
+                    contexts.append(hook.start_span(self.name, self.attributes))
+                else:
+                    contexts.append(hook.start_span_under(self.name, self.attributes, parent))
+            except Exception as e:
+                logger.warning("Tracing hook %s failed: %s", type(hook).__name__, e)
+                contexts.append(None)
+        self.contexts = contexts
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        duration = time.perf_counter() - self.start_time
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        for hook, context in zip(self.tracer.hooks, self.contexts):
+            try:
+                hook.end_span(self.name, context, duration, self.attributes)
+            except Exception as e:
+                logger.warning("Tracing hook %s failed: %s", type(hook).__name__, e)
+        return False
+
+
+class _NullSpan:
+    """Shared no-op span used when tracing is disabled"""
+    __slots__ = ()
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+    Fans span callbacks out to a list of hooks.
+
+    FFAI_AzureOpenAI opens a generate_response span per call, with the build_prompt,
+    cache_lookup, client_call and record_history stages inside it. JSON responses are parsed
+    later, when clean_history or prompt_attr_history is first read, so clean_response is not a
+    per-call stage: it runs after generate_response has ended and is not part of its time. It
+    is opened with its call's span as parent, so hooks can still attach it to that call.
+    """
+
+    def __init__(self, hooks: Optional[List[TraceHook]] = None):
+        self.hooks: List[TraceHook] = list(hooks or [])
+
+    def add_hook(self, hook: TraceHook) -> None:
+        self.hooks.append(hook)
+
+    def span(self, name: str, parent: Optional[Span] = None, **attributes: Any) -> Span:
+        """A span; with parent, one that belongs to that (possibly ended) span (see TraceHook.start_span_under)"""
+        return Span(self, name, attributes, parent)
+
+
+class StageTimingCollector(TraceHook):
+    """
+    Low-overhead hook that aggregates per-stage timings.
+
+    Durations go into log2 buckets of microseconds, so memory is constant per stage
+    and percentiles are approximate (within a factor of 2). One collector may be shared
+    by threads.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+
+    def end_span(self, name: str, context: Any, duration: float, attributes: Dict[str, Any]) -> None:
+        micros = duration * 1_000_000
+        bucket = math.frexp(micros)[1] if micros >= 1 else 0
+
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'count': 0, 'total': 0.0, 'min': duration, 'max': duration, 'buckets': {}}
+
+            stage['count'] += 1
+            stage['total'] += duration
+            if duration < stage['min']:
+                stage['min'] = duration
+            if duration > stage['max']:
+                stage['max'] = duration
+            stage['buckets'][bucket] = stage['buckets'].get(bucket, 0) + 1
+
+    def percentile(self, name: str, p: float) -> Optional[float]:
+        """Approximate percentile in seconds (upper bound of the matching bucket)"""
+        with self._lock:
+            stage = self.stages.get(name)
+            if not stage:
+                return None
+
+            target = math.ceil(p / 100 * stage['count'])
+            seen = 0
+            for bucket in sorted(stage['buckets']):
+                seen += stage['buckets'][bucket]
+                if seen >= target:
+                    return min(2 ** bucket / 1_000_000, stage['max'])
+            return stage['max']
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Per-stage count, total/mean/min/max and approximate p50/p90/p99, in seconds"""
+        with self._lock:
+            return {
+                name: {
+                    'count': stage['count'],
+                    'total': stage['total'],
+                    'mean': stage['total'] / stage['count'],
+                    'min': stage['min'],
+                    'max': stage['max'],
+                    'p50': self.percentile(name, 50),
+                    'p90': self.percentile(name, 90),
+                    'p99': self.percentile(name, 99)
+                }
+                for name, stage in self.stages.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stages = {}
+
+
+class OpenTelemetryHook(TraceHook):
+    """
+    Emits each stage as an OpenTelemetry span. Requires opentelemetry-api.
+
+    Stage spans are nested under the enclosing generate_response span, clean_response too,
+    although it runs after that span has ended (see Tracer).
+    """
+
+    def __init__(self, tracer: Any = None, span_prefix: str = "ffai."):
+        try:
+            from opentelemetry import trace, context
+        except ImportError as e:
+            logger.error("opentelemetry-api is not installed")
+            raise ImportError("OpenTelemetryHook requires the 'opentelemetry-api' package") from e
+
+        self._trace = trace
+        self._context = context
+        self.tracer = tracer or trace.get_tracer(__name__)
+        self.span_prefix = span_prefix
+
+    @staticmethod
+    def _otel_attributes(attributes: Dict[str, Any]) -> Dict[str, Any]:
+        # OpenTelemetry accepts only primitive values
+        return {
+            key: value if isinstance(value, (str, bool, int, float)) else str(value)
+            for key, value in attributes.items() if value is not None
+        }
+
+    def start_span(self, name: str, attributes: Dict[str, Any]) -> Any:
+        span = self.tracer.start_span(self.span_prefix + name, attributes=self._otel_attributes(attributes))
+        token = self._context.attach(self._trace.set_span_in_context(span))
+        return span, token
+
+    def start_span_under(self, name: str, attributes: Dict[str, Any], parent: Any) -> Any:
+        parent_span, _ = parent
+        span = self.tracer.start_span(self.span_prefix + name, context=self._trace.set_span_in_context(parent_span),
+                                      attributes=self._otel_attributes(attributes))
+        token = self._context.attach(self._trace.set_span_in_context(span))
+        return span, token
+
+    def end_span(self, name: str, context: Any, duration: float, attributes: Dict[str, Any]) -> None:
+        span, token = context
+        span.set_attributes(self._otel_attributes(attributes))
+        if 'error' in attributes:
+            span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, attributes['error']))
+        span.end()
+        self._context.detach(token)
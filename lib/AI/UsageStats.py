@@ -0,0 +1,258 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from typing import Optional, List, Dict, Any
+import logging
+import math
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# context_tokens_saved: conversation tokens a stateless call did not re-send (see FFAI_AzureOpenAI stateless)
+# cache_write_tokens: prompt tokens written to the provider's prompt cache (Anthropic), priced at a premium
+USAGE_FIELDS = ('prompt_tokens', 'completion_tokens', 'cached_tokens', 'finish_reason', 'latency',
+                'context_tokens_saved', 'cache_write_tokens')
+
+# Anthropic bills 5-minute cache writes at 1.25x the prompt price
+DEFAULT_CACHE_WRITE_MULTIPLIER = 1.25
+
+# latency histogram buckets grow by 2%, so percentiles are within 2% of the recorded latency
+LATENCY_BUCKET_GROWTH = 1.02
+_LOG_LATENCY_BUCKET_GROWTH = math.log(LATENCY_BUCKET_GROWTH)
+
+
+def _get(obj: Any, name: str, default: Any = None) -> Any:
+    """Read an attribute from an SDK object or a key from a dict"""
+    if obj is None:
+        return default
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def usage_from_openai(response: Any, latency: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Extract usage from an OpenAI-style chat completion (OpenAI, Azure OpenAI, Perplexity, Gemini).
+
+    prompt_tokens includes cached prompt tokens; cached_tokens is the cached share.
+    """
+    usage = _get(response, 'usage')
+    choices = _get(response, 'choices') or []
+    details = _get(usage, 'prompt_tokens_details')
+
+    return {
+        'prompt_tokens': _get(usage, 'prompt_tokens'),
+        'completion_tokens': _get(usage, 'completion_tokens'),
+        'cached_tokens': _get(details, 'cached_tokens'),
+        'finish_reason': _get(choices[0], 'finish_reason') if choices else None,
+        'latency': latency
+    }
+
+
+def usage_from_anthropic(response: Any, latency: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Extract usage from an Anthropic message.
+
+    Anthropic reports cache reads and writes separately from input_tokens; they are folded
+    into prompt_tokens so that totals are comparable with OpenAI-style usage. cached_tokens
+    and cache_write_tokens are their shares, so cost can price each.
+    """
+    usage = _get(response, 'usage')
+    input_tokens = _get(usage, 'input_tokens')
+    cache_read = _get(usage, 'cache_read_input_tokens') or 0
+    cache_write = _get(usage, 'cache_creation_input_tokens') or 0
+
+    return {
+        'prompt_tokens': input_tokens + cache_read + cache_write if input_tokens is not None else None,
+        'completion_tokens': _get(usage, 'output_tokens'),
+        'cached_tokens': cache_read,
+        'finish_reason': _get(response, 'stop_reason'),
+        'latency': latency,
+        'cache_write_tokens': cache_write
+    }
+
+
+def _apportion(total: int, weights: List[float]) -> List[int]:
+    """Split an integer total in proportion to weights, largest remainders first, so the parts sum to total"""
+    weight_sum = sum(weights)
+    if not weight_sum:
+        weights, weight_sum = [1] * len(weights), len(weights)
+    exact = [total * weight / weight_sum for weight in weights]
+    parts = [math.floor(share) for share in exact]
+    by_remainder = sorted(range(len(weights)), key=lambda i: parts[i] - exact[i])
+    for i in by_remainder[:total - sum(parts)]:
+        parts[i] += 1
+    return parts
+
+
+def split_usage(usage: Optional[Dict[str, Any]], prompt_weights: List[float],
+                completion_weights: List[float]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Divide the usage of one request that answered several prompts among them.
+
+    Prompt-side tokens (prompt, cached, cache write, context saved) are split by prompt_weights, completion
+    tokens by completion_weights, and the parts sum to the request's totals. finish_reason
+    and latency are the request's own.
+    """
+    if not usage:
+        return [usage] * len(prompt_weights)
+
+    shares = [dict(usage) for _ in prompt_weights]
+    for field, weights in (('prompt_tokens', prompt_weights), ('cached_tokens', prompt_weights),
+                           ('context_tokens_saved', prompt_weights), ('cache_write_tokens', prompt_weights),
+                           ('completion_tokens', completion_weights)):
+        if usage.get(field) is None:
+            continue
+        for share, part in zip(shares, _apportion(usage[field], weights)):
+            share[field] = part
+    return shares
+
+
+class LatencyHistogram:
+    """
+    Latencies in log-spaced buckets: constant-time adds, memory bounded by the range of
+    latencies rather than their number, and mergeable. Percentiles are within 2%.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.buckets: Dict[int, int] = {}
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def add(self, latency: float) -> None:
+        # bucket i holds latencies in (growth ** (i - 1), growth ** i]; zero and below share one
+        bucket = math.ceil(math.log(latency) / _LOG_LATENCY_BUCKET_GROWTH) if latency > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Nearest-rank percentile, in seconds"""
+        if not self.count:
+            return None
+        target = max(1, math.ceil(p / 100 * self.count))
+        seen = self.buckets.get(None, 0)
+        if seen >= target:
+            return self.min
+        for bucket in sorted(bucket for bucket in self.buckets if bucket is not None):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(max(LATENCY_BUCKET_GROWTH ** bucket, self.min), self.max)
+        return self.max
+
+
+class UsageTotals:
+    """Running token, latency and call totals for one group of interactions (a model or a prompt_name)"""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cache_write_tokens = 0
+        self.context_tokens_saved = 0
+        self.latencies = LatencyHistogram()
+        # [prompt, completion, cached, cache write] token totals by model, so cost can be
+        # priced without rescanning interactions
+        self.tokens_by_model: Dict[str, List[int]] = {}
+
+    def add(self, model: str, usage: Optional[Dict[str, Any]]) -> None:
+        self.calls += 1
+        if not usage:
+            return
+
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        completion_tokens = usage.get('completion_tokens') or 0
+        cached_tokens = usage.get('cached_tokens') or 0
+        cache_write_tokens = usage.get('cache_write_tokens') or 0
+
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cached_tokens += cached_tokens
+        self.cache_write_tokens += cache_write_tokens
+        self.context_tokens_saved += usage.get('context_tokens_saved') or 0
+
+        model_tokens = self.tokens_by_model.setdefault(model, [0, 0, 0, 0])
+        model_tokens[0] += prompt_tokens
+        model_tokens[1] += completion_tokens
+        model_tokens[2] += cached_tokens
+        model_tokens[3] += cache_write_tokens
+
+        if usage.get('latency') is not None:
+            self.latencies.add(usage['latency'])
+
+    @classmethod
+    def copy_of(cls, other: 'UsageTotals') -> 'UsageTotals':
+        """An independent copy of other"""
+        totals = cls()
+        totals.merge(other)
+        return totals
+
+    def merge(self, other: 'UsageTotals') -> None:
+        self.calls += other.calls
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cached_tokens += other.cached_tokens
+        self.cache_write_tokens += other.cache_write_tokens
+        self.context_tokens_saved += other.context_tokens_saved
+        self.latencies.merge(other.latencies)
+        for model, tokens in other.tokens_by_model.items():
+            model_tokens = self.tokens_by_model.setdefault(model, [0, 0, 0, 0])
+            for i in range(4):
+                model_tokens[i] += tokens[i]
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Nearest-rank percentile of recorded latencies, in seconds (within 2%)"""
+        return self.latencies.percentile(p)
+
+    def cost(self, price_table: Dict[str, Dict[str, float]]) -> Optional[float]:
+        """
+        Estimated cost in the price table's currency.
+
+        price_table maps model -> {'prompt': x, 'completion': y, 'cached': z, 'cache_write': w},
+        priced per 1M tokens. 'cached' defaults to the prompt price, 'cache_write' to 1.25x the
+        prompt price. Returns None if no model in this group is priced.
+        """
+        total = None
+        for model, (prompt_tokens, completion_tokens, cached_tokens, cache_write_tokens) in self.tokens_by_model.items():
+            prices = price_table.get(model)
+            if not prices:
+                continue
+            prompt_price = prices.get('prompt', 0.0)
+            cached_price = prices.get('cached', prompt_price)
+            cache_write_price = prices.get('cache_write', prompt_price * DEFAULT_CACHE_WRITE_MULTIPLIER)
+            total = (total or 0.0) + (
+                (prompt_tokens - cached_tokens - cache_write_tokens) * prompt_price +
+                cached_tokens * cached_price +
+                cache_write_tokens * cache_write_price +
+                completion_tokens * prices.get('completion', 0.0)
+            ) / 1_000_000
+        return total
+
+    def to_dict(self, price_table: Optional[Dict[str, Dict[str, float]]] = None) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cached_tokens': self.cached_tokens,
+            'cache_write_tokens': self.cache_write_tokens,
+            'total_tokens': self.prompt_tokens + self.completion_tokens,
+            'context_tokens_saved': self.context_tokens_saved,
+            'latency_p50': self.percentile(50),
+            'latency_p90': self.percentile(90),
+            'latency_p99': self.percentile(99),
+            'estimated_cost': self.cost(price_table or {})
+        }
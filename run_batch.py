@@ -0,0 +1,58 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+"""
+Run a file of prompts through FFAI_AzureOpenAI.
+
+The input is a CSV, XLSX or JSONL file with the columns prompt_name, prompt, history and
+model (only prompt is required). history lists the prompt_names whose latest responses are
+included with the prompt, as a JSON list or separated by commas.
+
+Results are appended to the output file as rows finish. Run the same command again after a
+crash or Ctrl-C: rows already answered are not sent again.
+
+    python run_batch.py prompts.csv -o results.jsonl --concurrency 8
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+from lib.AI.FFAI_AzureOpenAI import FFAI_AzureOpenAI
+from lib.AI.FFAzureOpenAI import FFAzureOpenAI
+from lib.AI.BatchRunner import BatchRunner, read_rows
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help="CSV, XLSX or JSONL file of prompts")
+    parser.add_argument('-o', '--output', help="JSONL or CSV results file, also the checkpoint (default: <input>.results.jsonl)")
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help="rows sent at the same time (default: 4)")
+    parser.add_argument('--model', help="deployment for rows without a model (default: AZUREOPENAI_MODEL)")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.input)[0] + '.results.jsonl'
+    rows = read_rows(args.input)
+
+    config = {'model': args.model} if args.model else {}
+    ffai = FFAI_AzureOpenAI(FFAzureOpenAI(config))
+    runner = BatchRunner(ffai, concurrency=args.concurrency)
+
+    try:
+        summary = runner.run(rows, output)
+    except KeyboardInterrupt:
+        logger.warning("Aborted; rerun to resume from %s", output)
+        sys.exit(130)
+
+    print(f"{summary['resumed']} resumed, {summary['ok']} answered, {summary['error']} failed, "
+          f"{summary['skipped']} skipped, {summary['not_run']} not run -> {output}")
+    sys.exit(0 if summary['error'] == summary['skipped'] == summary['not_run'] == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -105,6 +105,22 @@ response = ffai.generate_response("What is the level of difficulty of the questi
 
 logger.info(f"Final response: {response}")
 
+logger.info("======================================================================================")
+# the same comparison, with the three models asked at once: takes as long as the slowest one
+responses = ffai.generate_responses("What is the level of difficulty of the question asked?",
+                                    models=['o1-mini', 'gpt-4o', 'gpt-4o-mini'],
+                                    prompt_name='difficulty comparison',
+                                    history=["final query"])
+for model, model_response in responses.items():
+    logger.info(f"{model}: {model_response}")
+
+# or just the first answer to come back
+model, response = ffai.generate_first_response("What is the level of difficulty of the question asked?",
+                                               models=['o1-mini', 'gpt-4o', 'gpt-4o-mini'],
+                                               prompt_name='difficulty quick',
+                                               history=["final query"])
+logger.info(f"First answer, from {model}: {response}")
+
 logger.info("=============================================================================================================================================================================")
 response = ffai.generate_response("what did you say to the question? Also, how do i spell cat? Respond with a JSON dict.", prompt_name='really final query', history=["final query"])
 logger.info(f"Final response: {response}")
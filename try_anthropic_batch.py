@@ -0,0 +1,30 @@
+# Copyright (c) 2024 Antonio Quinonez
+# Licensed under the MIT License. See LICENSE in the project root for license information.
+
+from lib.AI.FFAnthropic import FFAnthropic
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def main():
+    logger.info("Starting Anthropic message batch run")
+
+    ai = FFAnthropic({'max_tokens': 500, 'temperature': 0.2})
+
+    # keys are our own IDs; they come back with each result
+    prompts = {
+        f"capital_{i}": f"What is the capital of {country}? Answer with the city name only."
+        for i, country in enumerate(["France", "Japan", "Peru", "Kenya"])
+    }
+
+    # re-running the script after a crash resumes from the persisted batch IDs
+    for result in ai.generate_batch(prompts, state_path="anthropic_batch_state.json"):
+        if result['status'] == 'succeeded':
+            print(f"{result['custom_id']}: {result['response']}")
+        else:
+            logger.error("%s failed: %s (%s)", result['custom_id'], result['status'], result['error'])
+
+if __name__ == "__main__":
+    main()
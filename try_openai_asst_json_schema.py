@@ -2,6 +2,7 @@
 # Licensed under the MIT License. See LICENSE in the project root for license information.
 
 from lib.AI.FFOpenAIAssistant import FFOpenAIAssistant
+from lib.AI.StructuredOutput import StructuredOutput
 import logging
 from enum import Enum
 from pydantic import BaseModel
@@ -21,19 +22,14 @@ class Messages(BaseModel):
 def main():
     logger.info("Starting OpenAI command-line interface")
 
-    # Define the JSON schema for the response
+    # Define the JSON schema for the response; the schema and validator are built once and cached
+    messages_format = StructuredOutput.for_model(Messages, name="test_schema")
 
     config = {
         'max_tokens': 1000,
         'temperature': 0.7,
         'assistant_name': 'test_cd',
-        'response_format':{
-            "type": "json_schema",
-            "json_schema": {
-                "name": "test_schema",
-                "schema": Messages.model_json_schema()
-            }
-        },
+        'response_format': messages_format,
         'system_instructions': "Always respond in JSON format according to the provided schema."
     }
 
@@ -66,6 +62,10 @@ def main():
             logger.debug("Generating response for user input: %s", user_input)
             response = ai.generate_response(user_input)
             print("Assistant:", response)
+
+            # validate into typed objects without regenerating the schema
+            for message in messages_format.validate_json(response).messages:
+                print(f"  [{message.confidence:.2f}] {message.user_question} -> {message.ai_response}")
             logger.info("Response generated and displayed to user")
         except Exception as e:
             logger.error("An error occurred while generating response: %s", str(e))